@@ -0,0 +1,126 @@
+# Compares the cost of scanning comment bodies for /-commands, with and
+# without the prefilter + memoization in snekomatic.gh.parse_commands, and
+# with the line scanner instead of the full markdown parse.
+#
+# Run from the top of the source tree:
+#
+#   python benchmarks/parse_commands.py
+
+import json
+from pathlib import Path
+import timeit
+
+from snekomatic import gh
+from snekomatic.autoinvite import invite_message
+
+SAMPLE_DATA_DIR = (
+    Path(__file__).absolute().parent.parent / "tests/sample-data"
+)
+
+TRACEBACK = """\
+Traceback (most recent call last):
+  File "/home/runner/work/trio/trio/trio/_core/_run.py", line 1896, in run
+    raise runner.main_task_outcome.error
+  File "/usr/lib/python3.8/site-packages/pytest/main.py", line 191, in wrap
+    session.exitstatus = doit(config, session) or 0
+RuntimeError: can't start new thread
+"""
+
+PR_DESCRIPTION_SECTION = f"""\
+## Summary
+
+This reworks how we handle cancellation inside `open_tcp_stream`, so that
+when one of the happy-eyeballs attempts fails we don't leak the socket. See
+#1234 and #1250 for background. *Lots* of the diff is just moving code
+around; the interesting part is in `_highlevel_open_tcp_stream.py`.
+
+- [x] tests
+- [ ] docs
+- [ ] newsfragment
+
+Here's the failure we were seeing on CI:
+
+```
+{TRACEBACK}
+```
+
+> I think this was also reported on gitter, but I can't find the link.
+
+/home/njs/trio/trio/_highlevel_open_tcp_stream.py has the main changes.
+
+"""
+
+
+def corpus():
+    bodies = []
+    for path in sorted(SAMPLE_DATA_DIR.glob("*.json")):
+        payload = json.loads(path.read_text())
+        for field in ["issue", "pull_request", "comment", "review"]:
+            body = payload.get(field, {}).get("body")
+            if body:
+                bodies.append(body)
+    bodies += [
+        "LGTM, thanks!",
+        "Looks good!\n/test-command\n\n\n  /test-command   hello  ",
+        "Could you add a newsfragment? Otherwise this looks ready to go.",
+        invite_message.format(username="julia"),
+        # Real-world PR descriptions can run to tens of kilobytes
+        PR_DESCRIPTION_SECTION * 10,
+        PR_DESCRIPTION_SECTION * 40 + "\n/ping\n",
+        TRACEBACK,
+    ]
+    return bodies
+
+
+def time_it(fn, bodies, number):
+    def run():
+        for body in bodies:
+            for _ in fn(body):
+                pass
+
+    return min(timeit.repeat(run, number=number, repeat=5)) / number
+
+
+def main():
+    bodies = corpus()
+    total_kib = sum(len(body) for body in bodies) / 1024
+    print(f"Corpus: {len(bodies)} bodies, {total_kib:.1f} KiB total")
+    number = 20
+
+    old = time_it(gh._parse_commands_markdown, bodies, number)
+
+    def cold(body):
+        gh._PARSED_COMMANDS_CACHE.clear()
+        return gh.parse_commands(body)
+
+    new_cold = time_it(cold, bodies, number)
+    new_warm = time_it(gh.parse_commands, bodies, number)
+    scanner = time_it(gh._scan_commands, bodies, number)
+
+    def scanner_cold(body):
+        gh._PARSED_COMMANDS_CACHE.clear()
+        return gh.parse_commands(body, scanner=True)
+
+    new_scanner_cold = time_it(scanner_cold, bodies, number)
+
+    print(f"marko parse every time:     {old * 1e3:8.3f} ms per corpus pass")
+    print(
+        f"prefilter, cache cold:      {new_cold * 1e3:8.3f} ms "
+        f"({old / new_cold:.1f}x faster)"
+    )
+    print(
+        f"prefilter, cache warm:      {new_warm * 1e3:8.3f} ms "
+        f"({old / new_warm:.1f}x faster)"
+    )
+    print(
+        f"line scanner every time:    {scanner * 1e3:8.3f} ms "
+        f"({old / scanner:.1f}x faster)"
+    )
+    print(
+        f"prefilter + scanner, cold:  {new_scanner_cold * 1e3:8.3f} ms "
+        f"({old / new_scanner_cold:.1f}x faster)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,515 @@
+# Measures how many webhook deliveries per second one snekomatic process can
+# handle. This runs the real app (snekomatic.app.main), except that instead
+# of talking to Github, it talks to a fake Github API that lives in the same
+# process, and then it hammers /webhook/github with signed deliveries at a
+# fixed rate and reports how long they took:
+#
+# - "ack" latency: from sending the delivery until we get our HTTP response
+# - "handled" latency: from sending the delivery until its handlers finish
+#
+# It still needs a database, the same as the tests do; so it works offline,
+# but you need a postgres running locally. For example:
+#
+#   docker run --rm -p 5432:5432 -e POSTGRES_HOST_AUTH_METHOD=trust postgres:alpine
+#   createdb -h localhost -U postgres snekomatic_bench
+#
+# Then, from the top of the source tree:
+#
+#   DATABASE_URL=postgresql://postgres@localhost/snekomatic_bench \
+#       python benchmarks/webhook_throughput.py --rate 50 --duration 30
+#
+# Run with --help for the knobs (Github latency, rate limits, what kinds of
+# deliveries to send, ...).
+
+import argparse
+from base64 import b64encode
+from collections import Counter
+from contextlib import redirect_stdout
+import json
+import os
+from pathlib import Path
+import random
+import re
+import secrets
+import socket
+import sys
+
+import asks
+import attr
+from nacl.public import PrivateKey
+import pendulum
+import trio
+
+# So we can reuse the helpers in tests/util.py
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+
+from tests.credentials import (
+    TEST_APP_ID,
+    TEST_PRIVATE_KEY,
+    TEST_USER_AGENT,
+    TEST_WEBHOOK_SECRET,
+)
+from tests.util import FakeResponse, fake_webhook
+
+API = "https://api.github.com"
+ORG = "bench-org"
+REPO = f"{ORG}/bench-repo"
+
+
+def _route_regex(route):
+    # {id} matches (and captures) a number, {...} matches anything, and any
+    # other {placeholder} matches one path segment.
+    regex = route.replace("{id}", r"(\d+)").replace("{...}", ".*")
+    return re.sub(r"\{\w+\}", "[^/]+", regex)
+
+
+@attr.s
+class FakeGithubAPI:
+    """Stands in for the asks.Session that GithubApp uses to talk to Github.
+
+    It knows just enough endpoints to keep our handlers happy. Every request
+    takes 'latency' seconds (give or take 'jitter'). Each installation gets
+    'rate_limit' requests per hour, and a 'secondary_limit' fraction of
+    requests are turned away with a Retry-After, like Github's secondary
+    rate limits.
+
+    """
+
+    latency = attr.ib(default=0.05)
+    jitter = attr.ib(default=0.5)
+    rate_limit = attr.ib(default=5000)
+    secondary_limit = attr.ib(default=0.0)
+    # (method, route) -> count
+    calls = attr.ib(factory=Counter)
+    _remaining = attr.ib(factory=dict)
+    _reset = attr.ib(default=None)
+    # The worker encrypts secrets with this, so it has to be a real key
+    _secrets_key = attr.ib(
+        factory=lambda: b64encode(bytes(PrivateKey.generate().public_key))
+    )
+
+    def _routes(self):
+        return [
+            ("POST", "/app/installations/{id}/access_tokens", self._token),
+            ("GET", "/repos/{owner}/{repo}/installation", self._installation),
+            ("GET", "/installation/repositories", self._repositories),
+            ("GET", "/orgs/{org}/memberships/{user}", self._membership),
+            ("PUT", "/orgs/{org}/memberships/{user}", self._invite),
+            (
+                "GET",
+                "/repos/{owner}/{repo}/actions/secrets/public-key",
+                self._public_key,
+            ),
+            (
+                "PUT",
+                "/repos/{owner}/{repo}/actions/secrets/{name}",
+                self._created,
+            ),
+            ("POST", "/repos/{owner}/{repo}/dispatches", self._no_content),
+            (
+                "GET",
+                "/repos/{owner}/{repo}/check-suites/{id}",
+                self._check_suite,
+            ),
+            ("POST", "{...}/comments", self._created),
+            ("POST", "{...}/reactions", self._created),
+        ]
+
+    def _token(self, installation_id):
+        expires_at = pendulum.now().add(hours=1).to_iso8601_string()
+        token = f"token-{installation_id}-{secrets.token_hex(8)}"
+        return 201, {"token": token, "expires_at": expires_at}
+
+    def _installation(self):
+        return 200, {"id": 1}
+
+    def _repositories(self):
+        return 200, {"total_count": 1, "repositories": [{"full_name": REPO}]}
+
+    def _membership(self):
+        # Mostly strangers, who'll get invited
+        if random.random() < 0.8:
+            return 404, {"message": "Not Found"}
+        return 200, {"state": "active"}
+
+    def _invite(self):
+        return 200, {"state": "pending"}
+
+    def _public_key(self):
+        return 200, {"key": self._secrets_key.decode(), "key_id": "1"}
+
+    def _check_suite(self, check_suite_id):
+        return 200, {"status": "completed", "conclusion": "success"}
+
+    def _created(self):
+        return 201, {}
+
+    def _no_content(self):
+        return 204, None
+
+    def _rate_limit_headers(self, installation_id):
+        now = pendulum.now()
+        if self._reset is None or now.int_timestamp >= self._reset:
+            self._reset = now.add(hours=1).int_timestamp
+            self._remaining.clear()
+        remaining = self._remaining.get(installation_id, self.rate_limit)
+        self._remaining[installation_id] = max(0, remaining - 1)
+        return remaining, {
+            "x-ratelimit-limit": str(self.rate_limit),
+            "x-ratelimit-remaining": str(max(0, remaining - 1)),
+            "x-ratelimit-reset": str(self._reset),
+        }
+
+    async def request(self, method, url, *, headers, data):
+        await trio.sleep(
+            self.latency * random.uniform(1 - self.jitter, 1 + self.jitter)
+        )
+        path = url[len(API) :].split("?")[0]
+        for route_method, route, handler in self._routes():
+            match = re.fullmatch(_route_regex(route), path)
+            if route_method == method and match is not None:
+                break
+        else:
+            route, handler, match = path, None, None
+        self.calls[method, route] += 1
+
+        response_headers = {"content-type": "application/json"}
+        authorization = headers.get("authorization", "")
+        if authorization.startswith("token "):
+            # The fake tokens say which installation they're for
+            installation_id = authorization.split("-")[1]
+            remaining, rate_headers = self._rate_limit_headers(
+                installation_id
+            )
+            response_headers.update(rate_headers)
+            if remaining == 0:
+                self.calls["403", "rate limited"] += 1
+                content = {"message": "API rate limit exceeded"}
+                return self._response(403, response_headers, content)
+            if random.random() < self.secondary_limit:
+                self.calls["403", "secondary rate limited"] += 1
+                response_headers["retry-after"] = "1"
+                content = {"message": "You have exceeded a secondary limit"}
+                return self._response(403, response_headers, content)
+
+        if handler is None:
+            return self._response(
+                404, response_headers, {"message": "Not Found"}
+            )
+        status, content = handler(*match.groups())
+        return self._response(status, response_headers, content)
+
+    def _response(self, status, headers, content):
+        if content is None:
+            body = b""
+        else:
+            body = json.dumps(content).encode("utf-8")
+        return FakeResponse(status, headers, body)
+
+
+def _ping_comment(installation_id, n):
+    issue_url = f"{API}/repos/{REPO}/issues/{n}"
+    return (
+        "issue_comment",
+        {
+            "action": "created",
+            "installation": {"id": installation_id},
+            "repository": {"full_name": REPO},
+            "issue": {
+                "url": issue_url,
+                "comments_url": issue_url + "/comments",
+            },
+            "comment": {
+                "url": f"{API}/repos/{REPO}/issues/comments/{n}",
+                "body": "Thanks!\n\n/ping\n",
+            },
+        },
+    )
+
+
+def _plain_comment(installation_id, n):
+    event_type, payload = _ping_comment(installation_id, n)
+    payload["comment"]["body"] = "Looks good to me " * 20
+    return event_type, payload
+
+
+def _merged_pr(installation_id, n):
+    pr_url = f"{API}/repos/{REPO}/pulls/{n}"
+    return (
+        "pull_request",
+        {
+            "action": "closed",
+            "installation": {"id": installation_id},
+            "organization": {"login": ORG},
+            "repository": {"full_name": REPO},
+            "pull_request": {
+                "merged": True,
+                # Someone new every time, so the database doesn't remember
+                # them from the last run
+                "user": {"login": f"contributor-{secrets.token_hex(6)}"},
+                "comments_url": f"{API}/repos/{REPO}/issues/{n}/comments",
+                "url": pr_url,
+            },
+        },
+    )
+
+
+def _push(installation_id, n):
+    return (
+        "push",
+        {
+            "ref": "refs/heads/master",
+            "installation": {"id": installation_id},
+            "repository": {"full_name": REPO},
+            "commits": [{"id": secrets.token_hex(20)} for _ in range(20)],
+        },
+    )
+
+
+DELIVERY_KINDS = {
+    "ping": _ping_comment,
+    "comment": _plain_comment,
+    "merged": _merged_pr,
+    "push": _push,
+}
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in DELIVERY_KINDS:
+            raise argparse.ArgumentTypeError(
+                f"unknown delivery kind {kind!r}"
+            )
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+def percentiles(samples):
+    if not samples:
+        return "(none)"
+    samples = sorted(samples)
+
+    def pick(fraction):
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+    return " ".join(
+        f"p{int(fraction * 100)}={pick(fraction) * 1000:.1f}ms"
+        for fraction in [0.5, 0.95, 0.99]
+    )
+
+
+async def run_benchmark(args, report):
+    import snekomatic.app
+
+    github_app = snekomatic.app.github_app
+    fake_api = FakeGithubAPI(
+        args.api_latency,
+        rate_limit=args.rate_limit,
+        secondary_limit=args.secondary_limit,
+    )
+    github_app._session = fake_api
+    if args.no_dispatch_delay:
+        github_app.dispatch_delays.update(
+            {key: 0 for key in ["issue_comment", "pull_request", "push"]}
+        )
+
+    sent_at = {}
+    handled_at = {}
+    original_dispatch_event = github_app._dispatch_event
+
+    async def timed_dispatch_event(event):
+        try:
+            await original_dispatch_event(event)
+        finally:
+            handled_at[event.delivery_id] = trio.current_time()
+
+    github_app._dispatch_event = timed_dispatch_event
+
+    ack_latencies = []
+    statuses = Counter()
+    kinds = list(args.mix)
+    weights = [args.mix[kind] for kind in kinds]
+
+    async with trio.open_nursery() as nursery:
+        urls = await nursery.start(snekomatic.app.main)
+        webhook_url = f"http://127.0.0.1:{args.port}/webhook/github"
+        report(f"App is listening at {urls}; sending to {webhook_url}")
+        session = asks.Session(connections=args.connections)
+
+        async def send(headers, body):
+            delivery_id = headers["x-github-delivery"]
+            sent_at[delivery_id] = start = trio.current_time()
+            try:
+                response = await session.post(
+                    webhook_url, headers=headers, data=body
+                )
+            except Exception as exc:
+                statuses[type(exc).__name__] += 1
+                return
+            ack_latencies.append(trio.current_time() - start)
+            statuses[response.status_code] += 1
+
+        total = int(args.rate * args.duration)
+        start = trio.current_time()
+        async with trio.open_nursery() as senders:
+            for n in range(total):
+                await trio.sleep_until(start + n / args.rate)
+                kind = random.choices(kinds, weights)[0]
+                installation_id = n % args.installations + 1
+                event_type, payload = DELIVERY_KINDS[kind](installation_id, n)
+                headers, body = fake_webhook(
+                    event_type, payload, TEST_WEBHOOK_SECRET
+                )
+                senders.start_soon(send, headers, body)
+        send_seconds = trio.current_time() - start
+
+        # Give the handlers a chance to catch up
+        with trio.move_on_after(args.drain):
+            while (await github_app.stats())["admission"]["admitted"]:
+                await trio.sleep(0.1)
+        stats = await github_app.stats()
+        nursery.cancel_scope.cancel()
+
+    handled_latencies = [
+        handled_at[delivery_id] - sent_at[delivery_id]
+        for delivery_id in handled_at
+        if delivery_id in sent_at
+    ]
+    report("")
+    report(
+        f"Sent {total} deliveries in {send_seconds:.1f}s "
+        f"({total / send_seconds:.1f}/s; asked for {args.rate}/s)"
+    )
+    report(f"Responses: {dict(statuses)}")
+    report(f"Ack latency:     {percentiles(ack_latencies)}")
+    report(
+        f"Handled latency: {percentiles(handled_latencies)} "
+        f"({len(handled_latencies)} deliveries had handlers)"
+    )
+    report("Github API calls:")
+    for (method, route), count in sorted(
+        fake_api.calls.items(), key=lambda item: -item[1]
+    ):
+        report(f"  {count:6d}  {method} {route}")
+    if args.show_stats:
+        report("App stats:")
+        report(json.dumps(stats, indent=2, default=str))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Webhook throughput benchmark for snekomatic"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=20, help="deliveries per second"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=10, help="seconds to send for"
+    )
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default="ping=1,comment=3,merged=1,push=5",
+        help=(
+            "relative frequency of each kind of delivery "
+            f"(kinds: {', '.join(DELIVERY_KINDS)})"
+        ),
+    )
+    parser.add_argument(
+        "--installations",
+        type=int,
+        default=1,
+        help="spread deliveries over this many installations",
+    )
+    parser.add_argument(
+        "--api-latency",
+        type=float,
+        default=0.05,
+        help="seconds per fake Github API request",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=int,
+        default=5000,
+        help=(
+            "fake Github API requests per installation per hour (the app "
+            "holds back the last 100 for interactive requests)"
+        ),
+    )
+    parser.add_argument(
+        "--secondary-limit",
+        type=float,
+        default=0.0,
+        help="fraction of requests that hit a secondary rate limit",
+    )
+    parser.add_argument(
+        "--no-dispatch-delay",
+        action="store_true",
+        help="don't wait for Github's eventual consistency",
+    )
+    parser.add_argument(
+        "--consumers",
+        type=int,
+        default=0,
+        help="use the database-backed webhook queue, with this many consumers",
+    )
+    parser.add_argument(
+        "--connections",
+        type=int,
+        default=100,
+        help="how many connections to send deliveries over",
+    )
+    parser.add_argument(
+        "--drain",
+        type=float,
+        default=60,
+        help="how long to wait for handlers to finish at the end",
+    )
+    parser.add_argument(
+        "--show-stats", action="store_true", help="dump the app's /stats"
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the app's own output"
+    )
+    args = parser.parse_args()
+    if isinstance(args.mix, str):
+        args.mix = parse_mix(args.mix)
+
+    if "DATABASE_URL" not in os.environ:
+        parser.error("DATABASE_URL must point to a (disposable) postgres db")
+    args.port = free_port()
+    os.environ.update(
+        {
+            "PORT": str(args.port),
+            "GITHUB_USER_AGENT": TEST_USER_AGENT,
+            "GITHUB_APP_ID": TEST_APP_ID,
+            "GITHUB_PRIVATE_KEY": TEST_PRIVATE_KEY,
+            "GITHUB_WEBHOOK_SECRET": TEST_WEBHOOK_SECRET,
+            "SNEKOMATIC_WORKER_REPO": REPO,
+            "SNEKOMATIC_WEBHOOK_CONSUMERS": str(args.consumers),
+            "HEROKU_SLUG_COMMIT": "benchmark",
+        }
+    )
+
+    stdout = sys.stdout
+
+    def report(line):
+        print(line, file=stdout, flush=True)
+
+    if args.verbose:
+        trio.run(run_benchmark, args, report)
+    else:
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            trio.run(run_benchmark, args, report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import json
 import sys
 import os
 import trio
@@ -7,16 +8,80 @@ import hypercorn.trio
 import quart
 from quart import request
 from quart_trio import QuartTrio
+import gidgethub
 from gidgethub.sansio import accept_format
 
-from .db import SentInvitation, retry_txn
-from .gh import GithubApp, reply_url, reaction_url
+from .db import (
+    SentInvitation,
+    retry_txn,
+    run_in_db_thread,
+    delivery_check_and_set,
+    forget_seen_delivery,
+    expire_seen_deliveries,
+    load_cached_response,
+    save_cached_response,
+    expire_cached_responses,
+)
+from .gh import GithubApp, Overloaded, reply_url, reaction_url
+from .webhook_queue import enqueue_webhook_delivery, run_webhook_consumers
+from .token_store import PostgresTokenStore, TOKEN_STORE_KEY_ENVVAR
+from .webhook_archive import WebhookArchive, WEBHOOK_ARCHIVE_ENVVAR
+from .metrics import Histogram, REGISTRY
+from . import tracing
+
+# snekomatic.tracing keeps the current delivery id in a contextvar; we should
+# include it in logging too. also maybe structlog? eh print is so handy for
+# now
+
+# Github only redelivers webhooks from the last few days
+SEEN_DELIVERY_TTL = 7 * 24 * 60 * 60
+
+
+async def _seen_delivery_in_db(delivery_id):
+    return await run_in_db_thread(
+        delivery_check_and_set, delivery_id, SEEN_DELIVERY_TTL
+    )
+
+
+async def _forget_delivery_in_db(delivery_id):
+    await run_in_db_thread(forget_seen_delivery, delivery_id)
+
+
+# Cached Github API responses that nobody has refreshed in this long are
+# probably not going to be useful again.
+CACHED_RESPONSE_MAX_AGE = 7 * 24 * 60 * 60
+
+
+class _ResponseCacheInDB:
+    async def load(self, segment, url):
+        return await run_in_db_thread(load_cached_response, str(segment), url)
+
+    async def save(self, segment, url, entry):
+        await run_in_db_thread(save_cached_response, str(segment), url, entry)
+
+
+# Setting this makes us respond to Github as soon as a delivery is verified,
+# and run its handlers later, in the background (see
+# GithubApp.run_dispatch_scheduler). Otherwise, handlers have finished by the
+# time we respond.
+def _delayed_dispatch():
+    return bool(os.environ.get("SNEKOMATIC_DELAYED_DISPATCH"))
+
+
+# Setting this makes our Github API response cache persistent, at the cost of
+# a database write for every cacheable response.
+def _response_cache_in_db():
+    return bool(os.environ.get("SNEKOMATIC_PERSIST_RESPONSE_CACHE"))
 
-# we should stash the delivery id in a contextvar and include it in logging
-# also maybe structlog? eh print is so handy for now
 
 quart_app = QuartTrio(__name__)
-github_app = GithubApp()
+github_app = GithubApp(
+    delivery_dedup_backend=_seen_delivery_in_db,
+    delivery_dedup_forget=_forget_delivery_in_db,
+    # XX Completely untuned
+    max_in_flight=20,
+    max_waiting=200,
+)
 
 if "SENTRY_DSN" in os.environ:
     import sentry_sdk
@@ -34,17 +99,94 @@ if "SENTRY_DSN" in os.environ:
         else:
             print(f"NOT logging error to sentry: {exception!r}")
 
+    # Webhook handlers run by the dispatch scheduler aren't inside a request
+    def dispatch_error_handler(exception):
+        print(f"Logging webhook handler error to sentry: {exception!r}")
+        sentry_sdk.capture_exception(exception)
+
+    github_app.on_dispatch_error = dispatch_error_handler
+
 
 @quart_app.route("/")
 async def index():
     return "Hi! 🐍🐍🐍"
 
 
+@quart_app.route("/stats")
+async def stats():
+    return quart.jsonify(await github_app.stats())
+
+
+# Which handlers have been spending each installation's Github API quota
+@quart_app.route("/stats/quota")
+async def quota_stats():
+    top = request.args.get("top", 10, type=int)
+    return quart.jsonify(await github_app.quota_report(top))
+
+
+@quart_app.route("/metrics")
+async def metrics():
+    return (
+        REGISTRY.render(),
+        200,
+        {"Content-Type": "text/plain; version=0.0.4"},
+    )
+
+
+WEBHOOK_ACK = Histogram(
+    "snekomatic_webhook_ack_seconds",
+    "Time to respond to Github's webhook deliveries",
+    ["event", "status"],
+)
+
+
+# Setting these turns on tracing of webhook deliveries (see
+# snekomatic.tracing): spans get appended to a local JSON-lines file, and/or
+# sent to an OpenTelemetry collector, e.g. http://localhost:4318/v1/traces
+TRACE_FILE_ENVVAR = "SNEKOMATIC_TRACE_FILE"
+OTLP_ENDPOINT_ENVVAR = "SNEKOMATIC_OTLP_ENDPOINT"
+
+
+# JSON mapping routes (e.g. "snekomatic.app.handle_ping") to how many Github
+# API requests they can make per installation per hour; see GithubApp's
+# route_budgets=. Over-budget requests fail with gh.BudgetExceeded.
+ROUTE_BUDGETS_ENVVAR = "SNEKOMATIC_ROUTE_BUDGETS"
+
+
+# If this is set, then webhook deliveries are written to a queue in the
+# database and we respond to Github right away; this many background tasks
+# then work through the queue. Otherwise, we dispatch deliveries directly
+# while Github waits for our response.
+def _webhook_consumer_count():
+    return int(os.environ.get("SNEKOMATIC_WEBHOOK_CONSUMERS", "0"))
+
+
 @quart_app.route("/webhook/github", methods=["POST"])
 async def webhook_github():
-    body = await request.get_data()
-    await github_app.dispatch_webhook(request.headers, body)
-    return ""
+    start = trio.current_time()
+    event_type = request.headers.get("x-github-event", "")
+    status = "error"
+    try:
+        body = await request.get_data()
+        if _webhook_consumer_count():
+            await enqueue_webhook_delivery(github_app, request.headers, body)
+        else:
+            try:
+                await github_app.dispatch_webhook(request.headers, body)
+            except Overloaded as exc:
+                print(f"Shedding webhook delivery: {exc}")
+                status = "503"
+                return "", 503, {"Retry-After": str(exc.retry_after)}
+        status = "200"
+        return ""
+    except gidgethub.ValidationFailure:
+        # Anyone can put anything in the headers, so don't let them make up
+        # new labels.
+        event_type = ""
+        status = "invalid"
+        raise
+    finally:
+        WEBHOOK_ACK.observe(trio.current_time() - start, event_type, status)
 
 
 @github_app.route_command("ping")
@@ -91,13 +233,53 @@ from .worker import worker_routes, run_worker_task_idem
 github_app.add_routes(worker_routes)
 
 
+async def expire_old_rows_periodically():
+    while True:
+        await run_in_db_thread(expire_seen_deliveries)
+        await run_in_db_thread(
+            expire_cached_responses, CACHED_RESPONSE_MAX_AGE
+        )
+        await trio.sleep(60 * 60)
+
+
 async def main(*, task_status=trio.TASK_STATUS_IGNORED):
     print("~~~ Starting up! ~~~")
     # Make sure database connection works, schema is up to date, run any
-    # required migrations, etc.
+    # required migrations, etc. (Nothing else is running yet, so there's no
+    # need to get this off the event loop.)
     with retry_txn() as attempts:
         for session in attempts:
             pass
+    # Share installation tokens with other dynos, and our future selves
+    if TOKEN_STORE_KEY_ENVVAR in os.environ:
+        print("Using the shared installation token store")
+        github_app.token_store = PostgresTokenStore()
+    if _response_cache_in_db():
+        print("Persisting the Github API response cache")
+        github_app.response_cache.backend = _ResponseCacheInDB()
+    # For replaying with 'python -m snekomatic.replay'
+    webhook_archive = None
+    if WEBHOOK_ARCHIVE_ENVVAR in os.environ:
+        path = os.environ[WEBHOOK_ARCHIVE_ENVVAR]
+        print(f"Archiving webhook deliveries to {path}")
+        webhook_archive = WebhookArchive(path)
+        github_app.webhook_archive = webhook_archive
+    if ROUTE_BUDGETS_ENVVAR in os.environ:
+        budgets = json.loads(os.environ[ROUTE_BUDGETS_ENVVAR])
+        print(f"Github API budgets per route: {budgets}")
+        github_app.route_quotas.budgets.update(budgets)
+    jsonl_exporter = None
+    if TRACE_FILE_ENVVAR in os.environ:
+        path = os.environ[TRACE_FILE_ENVVAR]
+        print(f"Writing traces to {path}")
+        jsonl_exporter = tracing.JsonlExporter(path)
+        tracing.add_exporter(jsonl_exporter)
+    otlp_exporter = None
+    if OTLP_ENDPOINT_ENVVAR in os.environ:
+        endpoint = os.environ[OTLP_ENDPOINT_ENVVAR]
+        print(f"Sending traces to {endpoint}")
+        otlp_exporter = tracing.OtlpExporter(endpoint)
+        tracing.add_exporter(otlp_exporter)
     # On Heroku, have to bind to whatever $PORT says:
     # https://devcenter.heroku.com/articles/dynos#local-environment-variables
     port = os.environ.get("PORT", 8000)
@@ -110,6 +292,23 @@ async def main(*, task_status=trio.TASK_STATUS_IGNORED):
             # Setting this just silences a warning:
             worker_class="trio",
         )
+        if _delayed_dispatch():
+            print("Dispatching webhooks in the background")
+            await nursery.start(github_app.run_dispatch_scheduler)
+        await nursery.start(github_app.run_token_refresher)
+        nursery.start_soon(expire_old_rows_periodically)
+        if webhook_archive is not None:
+            nursery.start_soon(webhook_archive.run)
+        if jsonl_exporter is not None:
+            nursery.start_soon(jsonl_exporter.run)
+        if otlp_exporter is not None:
+            nursery.start_soon(otlp_exporter.run)
+        consumer_count = _webhook_consumer_count()
+        if consumer_count:
+            print(f"Starting {consumer_count} webhook queue consumers")
+            await nursery.start(
+                run_webhook_consumers, github_app, consumer_count
+            )
         urls = await nursery.start(hypercorn.trio.serve, quart_app, config)
         print("Accepting HTTP requests at:", urls)
         task_status.started(urls)
@@ -25,7 +25,12 @@ import gidgethub
 import textwrap
 from glom import glom
 
-from .db import retry_txn, SentInvitation
+from .db import (
+    retry_txn,
+    retry_serialization_failures,
+    run_in_db_thread,
+    SentInvitation,
+)
 from .gh import GithubRoutes
 
 autoinvite_routes = GithubRoutes()
@@ -102,6 +107,7 @@ async def _member_state(gh_client, org, member):
         return glom(response, "state")
 
 
+@retry_serialization_failures
 def already_sent_invitation(name):
     with retry_txn() as attempts:
         for session in attempts:
@@ -110,6 +116,7 @@ def already_sent_invitation(name):
     return result
 
 
+@retry_serialization_failures
 def record_sent_invitation(name):
     with retry_txn() as attempts:
         for session in attempts:
@@ -117,17 +124,15 @@ def record_sent_invitation(name):
 
 
 # There's no "merged" event; instead you get action=closed + merged=True
-@autoinvite_routes.route_webhook("pull_request", action="closed")
+@autoinvite_routes.route_webhook(
+    "pull_request", action="closed", **{"pull_request.merged": True}
+)
 async def pull_request_merged(event_type, payload, gh_client):
-    print("PR closed")
-    if not glom(payload, "pull_request.merged"):
-        print("but not merged, so never mind")
-        return
     creator = glom(payload, "pull_request.user.login")
     org = glom(payload, "organization.login")
     print(f"PR by {creator} was merged!")
 
-    if already_sent_invitation(creator):
+    if await run_in_db_thread(already_sent_invitation, creator):
         print("The database says we already sent an invitation")
         return
 
@@ -135,7 +140,7 @@ async def pull_request_merged(event_type, payload, gh_client):
     if state is not None:
         # Remember for later so we don't keep checking the Github API over and
         # over.
-        record_sent_invitation(creator)
+        await run_in_db_thread(record_sent_invitation, creator)
         print(f"They already have member state {state}; not inviting")
         return
 
@@ -147,7 +152,7 @@ async def pull_request_merged(event_type, payload, gh_client):
         data={"role": "member"},
     )
     # Record that we did
-    record_sent_invitation(creator)
+    await run_in_db_thread(record_sent_invitation, creator)
     # Welcome them
     await gh_client.post(
         glom(payload, "pull_request.comments_url"),
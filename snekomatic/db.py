@@ -1,19 +1,27 @@
+import functools
 import os
+import time
 from pathlib import Path
 from contextlib import contextmanager
+import contextvars
 import pprint
+import threading
 import attr
+import trio
 from sqlalchemy import (
     create_engine,
     MetaData,
     Column,
     String,
     Integer,
+    BigInteger,
     ForeignKey,
     Boolean,
     DateTime,
+    LargeBinary,
     text,
     Sequence,
+    or_,
 )
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.dialects.postgresql import JSONB
@@ -24,6 +32,10 @@ import alembic.command
 import alembic.migration
 import alembic.autogenerate
 from psycopg2.errors import SerializationFailure
+import pendulum
+
+from .metrics import Counter, Histogram
+from . import tracing
 
 # Required to make sure that constraints like ForeignKey get a stable name so
 # migration can be supported.
@@ -124,10 +136,43 @@ class Already(Base):
     item = Column(String, primary_key=True)
 
 
+def _is_serialization_failure(exc):
+    return (
+        isinstance(exc, OperationalError)
+        and isinstance(exc.orig, SerializationFailure)
+        and exc.orig.pgcode == "40001"
+    )
+
+
+def retry_serialization_failures(fn):
+    """Decorator for functions that do a retry_txn, to re-run the whole thing
+    if one of its statements hits a serialization failure.
+
+    retry_txn retries failed commits itself. But Postgres can also reject a
+    query partway through a transaction ("canceled on conflict out to
+    pivot"), and that exception escapes the 'for' block, so retry_txn can't
+    restart it. The decorated function can't have any side effects outside
+    the database, since it may be run more than once.
+
+    """
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        while True:
+            try:
+                return fn(*args, **kwargs)
+            except OperationalError as exc:
+                if not _is_serialization_failure(exc):
+                    raise
+
+    return wrapper
+
+
 # Returns True if we already did this.
 # Returns False if we haven't done it, and as a side-effect sets the flag to
 # say we've done it. The flag auto-expires after the given time. (Mostly
 # intended to allow GC later.)
+@retry_serialization_failures
 def already_check_and_set(domain: str, item: str) -> bool:
     with retry_txn() as attempts:
         for session in attempts:
@@ -144,6 +189,249 @@ def already_check_and_set(domain: str, item: str) -> bool:
     return result
 
 
+class QueuedWebhook(Base):
+    __tablename__ = "webhook_queue"
+
+    id = Column(Integer, primary_key=True)
+    delivery_id = Column(String, nullable=False)
+    event_type = Column(String, nullable=False)
+    # Lowercased header names -> values
+    headers = Column(JSONB, nullable=False)
+    # The raw body, exactly as we received it, so the signature still checks
+    # out when we dispatch it.
+    body = Column(LargeBinary, nullable=False)
+    received_at = Column(DateTime(timezone=True), nullable=False)
+    # While a consumer is working on a delivery, it holds a lease on it. If
+    # the consumer dies (e.g. because heroku restarted the dyno), then the
+    # lease eventually expires and someone else will pick it up.
+    leased_until = Column(DateTime(timezone=True), nullable=True)
+    attempts = Column(Integer, nullable=False)
+
+
+@retry_serialization_failures
+def enqueue_webhook(delivery_id, event_type, headers, body):
+    with retry_txn() as attempts:
+        for session in attempts:
+            session.add(
+                QueuedWebhook(
+                    delivery_id=delivery_id,
+                    event_type=event_type,
+                    headers=headers,
+                    body=body,
+                    received_at=pendulum.now(),
+                    attempts=0,
+                )
+            )
+
+
+# Grabs the oldest unleased delivery from the queue and leases it for
+# 'lease_seconds'. Returns None if there's nothing to do, or else a
+# QueuedWebhook object. (It's detached from any session, so don't try to
+# mutate it.)
+@retry_serialization_failures
+def claim_queued_webhook(lease_seconds):
+    with retry_txn() as attempts:
+        for session in attempts:
+            now = pendulum.now()
+            claimed = (
+                session.query(QueuedWebhook)
+                .filter(
+                    or_(
+                        QueuedWebhook.leased_until.is_(None),
+                        QueuedWebhook.leased_until < now,
+                    )
+                )
+                .order_by(QueuedWebhook.id)
+                .with_for_update(skip_locked=True)
+                .first()
+            )
+            if claimed is not None:
+                claimed.leased_until = now.add(seconds=lease_seconds)
+                claimed.attempts += 1
+                session.flush()
+                session.expunge(claimed)
+    return claimed
+
+
+@retry_serialization_failures
+def finish_queued_webhook(queue_id):
+    with retry_txn() as attempts:
+        for session in attempts:
+            session.query(QueuedWebhook).filter_by(id=queue_id).delete()
+
+
+class SeenDelivery(Base):
+    __tablename__ = "seen_delivery"
+
+    delivery_id = Column(String, primary_key=True)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+
+# Like already_check_and_set, but for webhook delivery ids, and entries
+# actually do expire: Github only redelivers recent webhooks, so there's no
+# point in remembering delivery ids forever.
+@retry_serialization_failures
+def delivery_check_and_set(delivery_id: str, ttl_seconds) -> bool:
+    with retry_txn() as attempts:
+        for session in attempts:
+            now = pendulum.now()
+            existing = (
+                session.query(SeenDelivery)
+                .filter_by(delivery_id=delivery_id)
+                .one_or_none()
+            )
+            if existing is not None and existing.expires_at > now:
+                result = True
+            else:
+                expires_at = now.add(seconds=ttl_seconds)
+                if existing is None:
+                    session.add(
+                        SeenDelivery(
+                            delivery_id=delivery_id, expires_at=expires_at
+                        )
+                    )
+                else:
+                    existing.expires_at = expires_at
+                result = False
+    return result
+
+
+# For when we failed to handle a delivery, and want Github's redelivery of it
+# to go through.
+@retry_serialization_failures
+def forget_seen_delivery(delivery_id: str):
+    with retry_txn() as attempts:
+        for session in attempts:
+            session.query(SeenDelivery).filter_by(
+                delivery_id=delivery_id
+            ).delete()
+
+
+@retry_serialization_failures
+def expire_seen_deliveries():
+    with retry_txn() as attempts:
+        for session in attempts:
+            session.query(SeenDelivery).filter(
+                SeenDelivery.expires_at < pendulum.now()
+            ).delete()
+
+
+class InstallationToken(Base):
+    __tablename__ = "installation_token"
+
+    installation_id = Column(BigInteger, primary_key=True)
+    # The token, encrypted by the caller. NULL if we've never stored one, and
+    # the row only exists to hold a lease.
+    token_ciphertext = Column(LargeBinary, nullable=True)
+    expires_at = Column(DateTime(timezone=True), nullable=True)
+    # Whoever holds the lease is busy minting a new token, so everyone else
+    # should wait for them instead of minting their own.
+    leased_until = Column(DateTime(timezone=True), nullable=True)
+
+
+# Returns (token_ciphertext, expires_at), or None if we don't have a token for
+# this installation.
+@retry_serialization_failures
+def load_installation_token(installation_id):
+    with retry_txn() as attempts:
+        for session in attempts:
+            row = session.query(InstallationToken).get(installation_id)
+            if row is None or row.token_ciphertext is None:
+                result = None
+            else:
+                result = (row.token_ciphertext, row.expires_at)
+    return result
+
+
+# Returns True if we got the lease, or False if someone else has it.
+@retry_serialization_failures
+def lease_installation_token(installation_id, lease_seconds) -> bool:
+    with retry_txn() as attempts:
+        for session in attempts:
+            now = pendulum.now()
+            row = session.query(InstallationToken).get(installation_id)
+            if row is None:
+                row = InstallationToken(installation_id=installation_id)
+                session.add(row)
+            if row.leased_until is not None and row.leased_until > now:
+                result = False
+            else:
+                row.leased_until = now.add(seconds=lease_seconds)
+                result = True
+    return result
+
+
+# Stores a new token, and releases the lease.
+@retry_serialization_failures
+def save_installation_token(installation_id, token_ciphertext, expires_at):
+    with retry_txn() as attempts:
+        for session in attempts:
+            session.merge(
+                InstallationToken(
+                    installation_id=installation_id,
+                    token_ciphertext=token_ciphertext,
+                    expires_at=expires_at,
+                    leased_until=None,
+                )
+            )
+
+
+@retry_serialization_failures
+def release_installation_token_lease(installation_id):
+    with retry_txn() as attempts:
+        for session in attempts:
+            session.query(InstallationToken).filter_by(
+                installation_id=installation_id
+            ).update({"leased_until": None})
+
+
+class CachedResponse(Base):
+    __tablename__ = "cached_response"
+
+    # Which credentials the response was fetched with (see
+    # gh.SegmentedCacheOverlay)
+    segment = Column(String, primary_key=True)
+    url = Column(String, primary_key=True)
+    # gidgethub's cache entry, JSON-encoded by gh.ResponseCache
+    entry = Column(LargeBinary, nullable=False)
+    stored_at = Column(DateTime(timezone=True), nullable=False)
+
+
+@retry_serialization_failures
+def load_cached_response(segment, url):
+    with retry_txn() as attempts:
+        for session in attempts:
+            row = session.query(CachedResponse).get((segment, url))
+            result = None if row is None else row.entry
+    return result
+
+
+@retry_serialization_failures
+def save_cached_response(segment, url, entry):
+    with retry_txn() as attempts:
+        for session in attempts:
+            session.merge(
+                CachedResponse(
+                    segment=segment,
+                    url=url,
+                    entry=entry,
+                    stored_at=pendulum.now(),
+                )
+            )
+
+
+# Unlike the in-memory cache, the table isn't bounded in size, so we throw
+# away entries that haven't been refreshed in a while.
+@retry_serialization_failures
+def expire_cached_responses(max_age_seconds):
+    with retry_txn() as attempts:
+        for session in attempts:
+            session.query(CachedResponse).filter(
+                CachedResponse.stored_at
+                < pendulum.now().subtract(seconds=max_age_seconds)
+            ).delete()
+
+
 @attr.s(frozen=True)
 class CachedEngine:
     engine = attr.ib()
@@ -151,9 +439,17 @@ class CachedEngine:
 
 
 CACHED_ENGINE = CachedEngine(None, None)
+# Transactions can run in worker threads (see run_in_db_thread), and we don't
+# want two of them running migrations at the same time.
+_ENGINE_LOCK = threading.Lock()
 
 
 def _get_session():
+    with _ENGINE_LOCK:
+        return _get_session_locked()
+
+
+def _get_session_locked():
     global CACHED_ENGINE
     if CACHED_ENGINE.database_url != os.environ["DATABASE_URL"]:
         engine = create_engine(
@@ -204,6 +500,21 @@ def _get_session():
     return Session(bind=CACHED_ENGINE.engine)
 
 
+DB_TRANSACTION_ATTEMPTS = Counter(
+    "snekomatic_db_transaction_attempts_total",
+    "Attempts at running a retry_txn block",
+)
+DB_SERIALIZATION_FAILURES = Counter(
+    "snekomatic_db_serialization_failures_total",
+    "retry_txn commits that Postgres rejected, and so had to be retried",
+)
+DB_TRANSACTIONS = Histogram(
+    "snekomatic_db_transaction_seconds",
+    "retry_txn blocks, from the start of the first attempt to the end",
+    ["outcome"],
+)
+
+
 @contextmanager
 def retry_txn():
     """Helper for retrying database transactions.
@@ -256,42 +567,122 @@ def retry_txn():
               result = session.query(...).one().some_attr
       return result
 
+    Postgres can also reject a statement before the commit. That exception
+    escapes the 'with' block, so put functions that use retry_txn under
+    @retry_serialization_failures to retry those too.
+
+    This blocks while it talks to the database, so from async code, use
+    run_txn instead (or run_in_db_thread, to call one of the helpers in this
+    module).
+
     """
     committed = False
     pending_session = None
+    attempt_span = None
 
     def session_gen():
-        nonlocal committed, pending_session
+        nonlocal committed, pending_session, attempt_span
+        attempt = 0
         while True:
             if pending_session is not None:
                 try:
                     pending_session.commit()
                 except OperationalError as exc:
-                    if (
-                        isinstance(exc.orig, SerializationFailure)
-                        and exc.orig.pgcode == "40001"
-                    ):
+                    if _is_serialization_failure(exc):
                         # The commit() failed because of SERIALIZABLE
                         # isolation level, and should be retried.
-                        pass
+                        DB_SERIALIZATION_FAILURES.inc()
+                        attempt_span.finish(outcome="serialization_failure")
                     else:
                         raise
                 else:
                     committed = True
+                    attempt_span.finish(outcome="committed")
                     break
                 pending_session.close()
                 pending_session = None
             pending_session = _get_session()
+            DB_TRANSACTION_ATTEMPTS.inc()
+            attempt += 1
+            attempt_span = tracing.start_span(
+                "db.transaction", attempt=attempt
+            )
             yield pending_session
 
+    start = time.perf_counter()
+    outcome = "error"
     try:
         yield session_gen()
         if not committed:
             raise AssertionError("retry_txn loop exited early, data lost")
-    except:
+        outcome = "committed"
+    except BaseException as exc:
         if pending_session is not None:
             pending_session.rollback()
+        if _is_serialization_failure(exc):
+            # A statement failed, rather than the commit; see
+            # retry_serialization_failures.
+            DB_SERIALIZATION_FAILURES.inc()
+            if attempt_span is not None:
+                attempt_span.finish(outcome="serialization_failure")
         raise
     finally:
         if pending_session is not None:
             pending_session.close()
+        if attempt_span is not None:
+            # Does nothing if it already finished
+            attempt_span.finish(outcome="error")
+        DB_TRANSACTIONS.observe(time.perf_counter() - start, outcome)
+
+
+# How many database calls async code can have running at once. Each one ties
+# up a worker thread and a connection, so this should stay under
+# SQLAlchemy's default connection pool size + overflow (5 + 10).
+DB_THREADS = 10
+# Created on first use, since it has to belong to a trio run
+_DB_THREAD_LIMITER = None
+
+
+async def run_in_db_thread(fn, *args):
+    """Calls fn(*args) in a worker thread, and returns its result.
+
+    Everything else in this module blocks while it talks to Postgres (and
+    retry_txn can make several round trips), so async code should use this
+    to call it, rather than freezing the event loop:
+
+      if await run_in_db_thread(already_check_and_set, domain, item):
+          ...
+
+    At most DB_THREADS calls run at once; the rest wait their turn. Once
+    started, a call can't be cancelled, so transactions never get abandoned
+    halfway through. The call sees the caller's contextvars, so its
+    transactions show up in the caller's trace.
+
+    """
+    global _DB_THREAD_LIMITER
+    if _DB_THREAD_LIMITER is None:
+        _DB_THREAD_LIMITER = trio.CapacityLimiter(DB_THREADS)
+    context = contextvars.copy_context()
+    return await trio.to_thread.run_sync(
+        context.run, fn, *args, limiter=_DB_THREAD_LIMITER
+    )
+
+
+async def run_txn(fn, *args):
+    """The async version of retry_txn: calls fn(session, *args) inside a
+    transaction, in a worker thread, retrying it as necessary.
+
+    Returns whatever fn returned on the attempt that committed. Since fn may
+    be called more than once, it shouldn't have any side effects outside the
+    database.
+
+    """
+
+    @retry_serialization_failures
+    def txn():
+        with retry_txn() as attempts:
+            for session in attempts:
+                result = fn(session, *args)
+        return result
+
+    return await run_in_db_thread(txn)
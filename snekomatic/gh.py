@@ -12,6 +12,13 @@ Basic setup:
       # 'gh_client' is a gidgethub-style github API client that automatically
       # uses the right credentials for this webhook event.
 
+  # Restrictions can look at nested fields too:
+  @gh_app.route_webhook(
+      "pull_request", action="closed", **{"pull_request.merged": True}
+  )
+  async def handler(event_type, payload, gh_client):
+      ...
+
   @gh_app.route_command("/ping")
   async def handler(command, event_type, payload, gh_client):
       assert command[0] == "/ping"
@@ -23,9 +30,23 @@ Integrate into webapp:
   async def handler():
       headers = request.headers
       body = await request.get_body()
-      await gh_app.dispatch_webhook(headers, body)
+      try:
+          await gh_app.dispatch_webhook(headers, body)
+      except Overloaded as exc:
+          return "", 503, {"Retry-After": str(exc.retry_after)}
       return ""
 
+By default, dispatch_webhook waits a second (to give Github's eventual
+consistency time to catch up), and then runs the handlers before returning.
+If you run the scheduler in the background, then dispatch_webhook returns
+immediately, and handlers are run later by the scheduler:
+
+  nursery.start_soon(gh_app.run_dispatch_scheduler)
+
+To avoid drowning in a burst of deliveries, pass max_in_flight= (how many
+deliveries can have handlers running at once) and max_waiting= (how many more
+we'll accept and hold onto). Beyond that, dispatch_webhook raises Overloaded.
+
 If you want to collect up some routing rules as a bundle and then add them to
 an app, like a Flask "blueprint":
 
@@ -44,6 +65,51 @@ webhook, then use one of these:
   client = gh_app.client_for_installation_id(installation_id)
   client = await gh_app.client_for_repo(repo)
 
+Installation clients are pooled: asking for the same installation (with the
+same priority= and route=) gives back the same client, until it's been idle
+for client_idle_ttl seconds.
+
+Requests for each installation (and for the app itself) go through a
+rate-limit-aware scheduler. When an installation runs low on quota, requests
+queue up until it resets, except that PRIORITY_INTERACTIVE requests can use
+the last few. Command handlers get an interactive client; for your own
+requests, pass priority= to client_for_installation_id/client_for_repo.
+Identical GETs that are in flight at the same time (even from different
+clients, as long as they have the same priority and route) are merged into
+a single request; pass coalesce=False to
+getitem/getiter to opt out. And getiter fetches pages of long listings
+concurrently (see its prefetch= argument).
+
+For GraphQL, there's 'await client.graphql(query, **variables)'. Or, for
+one-off lookups that lots of handlers might be doing at once:
+
+  user = await client.graphql_lookup('user(login: $login) { name }', login=x)
+
+Lookups made through the same installation within a few milliseconds of
+each other are sent together, as a single query.
+
+Requests time out after request_timeout seconds, and requests that are safe
+to repeat are retried after timeouts, connection errors and 5xx responses.
+With hedge_requests=True, unusually slow GETs also get a second copy sent.
+
+Github API requests, token renewals and handler run times are recorded as
+Prometheus-style metrics (see snekomatic.metrics), labelled by URL template
+and handler name. If any snekomatic.tracing exporters are set up, then each
+delivery also gets a trace, with spans for its handlers, API requests and
+token renewals.
+
+Every request is also charged to the route (handler) that made it, per
+installation; 'await gh_app.quota_report()' shows who's been spending each
+installation's quota. Requests made outside of a handler can name
+themselves with client_for_repo(..., route="name"). To stop one route from
+starving the rest, pass route_budgets={route: requests per hour}; requests
+from routes over their budget fail with BudgetExceeded. (Or, with
+route_budget_action="defer", they wait for the next hour -- but the handler
+keeps its delivery's admission slot all the while.)
+
+To keep a record of incoming deliveries (e.g. for replaying them later),
+pass webhook_archive= (see snekomatic.webhook_archive).
+
 You can also get an installation token with 'await gh_app.token_for(...)',
 which is useful in case you want to run git commands directly using those
 credentials.
@@ -62,7 +128,6 @@ Some notes on how this compares to octomachinery, which has overlapping goals:
 * We insist that you configure a webhook secret, since anything else is
   totally insecure
 * No utility functions that call yaml.load and thus execute arbitrary code
-* About 10x fewer lines-of-code
 
 Many thanks to Sviat for octomachinery though, because I would never have
 figured out how to do any of this stuff without studying his code.
@@ -72,15 +137,35 @@ here.
 
 """
 
-from collections import defaultdict
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+import contextvars
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import math
 import os
+import random
+import re
+import traceback
+import urllib.parse
 from typing import Mapping, Tuple
 
 import anyio
+import anyio.exceptions
 import asks
+import asks.errors
+import asks.request_object
 import attr
 import cachetools
-from gidgethub.sansio import Event, accept_format
+from gidgethub.sansio import (
+    Event,
+    accept_format,
+    format_url,
+    validate_event,
+)
 import gidgethub.abc
 from glom import glom
 import jwt
@@ -88,7 +173,19 @@ import pendulum
 import marko
 from marko.ext.gfm import gfm
 
-__all__ = ["GithubApp", "GithubRoutes"]
+from .metrics import Counter, Histogram
+from . import tracing
+
+__all__ = [
+    "GithubApp",
+    "GithubRoutes",
+    "Overloaded",
+    "BudgetExceeded",
+    "GraphQLError",
+    "PRIORITY_INTERACTIVE",
+    "PRIORITY_NORMAL",
+    "PRIORITY_BACKGROUND",
+]
 
 # XX TODO: should we catch exceptions in webhook handlers, the same way flask
 # etc. catch exceptions in request handlers? right now the first exception
@@ -110,6 +207,296 @@ def _too_close_for_comfort(expires_at):
     return pendulum.now() + MAX_CLOCK_SKEW > expires_at
 
 
+# Github won't accept app JWTs that are valid for longer than this. Signing
+# one is relatively expensive (RS256), so we keep reusing the same one until
+# it gets close to expiring.
+APP_JWT_LIFETIME = pendulum.Duration(minutes=10)
+
+
+# When there's a shared token store, whoever is minting a new token for an
+# installation holds a lease on it, and everyone else polls until the new
+# token shows up (or the lease expires, in case the minter died).
+TOKEN_LEASE_SECONDS = 30
+TOKEN_LEASE_POLL_INTERVAL = 1
+
+# The background token refresher (see GithubApp.run_token_refresher) renews
+# tokens for installations we've used recently, a while before they expire,
+# so that token_for almost never has to wait on Github. Each renewal is due
+# at a random point in a window, so that tokens that were minted together
+# (e.g. right after a restart) don't all come due together again.
+TOKEN_REFRESH_INTERVAL = 60
+TOKEN_REFRESH_AHEAD = pendulum.Duration(minutes=10)
+TOKEN_REFRESH_JITTER = pendulum.Duration(minutes=5)
+# Installations we haven't needed a token for in this long are left alone;
+# if they come back, token_for renews on demand like before.
+TOKEN_REFRESH_ACTIVE_WINDOW = pendulum.Duration(hours=1)
+# Renewals in one pass run concurrently, but only this many at a time, and
+# each one gets this many seconds (enough to wait out another process's
+# lease) before we give up on it until the next pass.
+TOKEN_REFRESH_CONCURRENCY = 10
+TOKEN_REFRESH_TIMEOUT = 2 * TOKEN_LEASE_SECONDS
+
+
+def _refresh_due_at(expires_at):
+    jitter = TOKEN_REFRESH_JITTER.total_seconds() * random.random()
+    return (
+        expires_at - TOKEN_REFRESH_AHEAD - pendulum.Duration(seconds=jitter)
+    )
+
+
+# How many pages of a listing getiter fetches at once
+PAGE_PREFETCH = 8
+
+_LINK_RE = re.compile(r'<(?P<uri>[^>]+)>;\s*rel="(?P<rel>\w+)"')
+
+
+# Given the URL of the next page of a listing, and the Link header that it
+# came from, returns the URLs of all the pages from there to the last one, or
+# None if we can't tell what they are. Github's page URLs only differ in their
+# page= parameter (except for the ones that use cursors, which we can't
+# predict).
+def _page_urls(next_url, link):
+    if next_url is None or link is None:
+        return None
+    last_url = None
+    for match in _LINK_RE.finditer(link):
+        if match.group("rel") == "last":
+            last_url = match.group("uri")
+    if last_url is None:
+        return None
+    next_parts = urllib.parse.urlsplit(next_url)
+    last_parts = urllib.parse.urlsplit(last_url)
+    next_query = urllib.parse.parse_qsl(
+        next_parts.query, keep_blank_values=True
+    )
+    last_query = urllib.parse.parse_qsl(
+        last_parts.query, keep_blank_values=True
+    )
+    next_page = dict(next_query).get("page", "")
+    last_page = dict(last_query).get("page", "")
+    if not (next_page.isdigit() and last_page.isdigit()):
+        return None
+
+    def without_page(parts, query):
+        return (
+            parts._replace(query=""),
+            [(key, value) for (key, value) in query if key != "page"],
+        )
+
+    if without_page(next_parts, next_query) != without_page(
+        last_parts, last_query
+    ):
+        return None
+    urls = []
+    for page in range(int(next_page), int(last_page) + 1):
+        query = urllib.parse.urlencode(
+            [
+                (key, str(page) if key == "page" else value)
+                for (key, value) in next_query
+            ]
+        )
+        urls.append(urllib.parse.urlunsplit(next_parts._replace(query=query)))
+    return urls
+
+
+# graphql_lookup waits this long for other lookups to send along with it,
+# and sends at most this many in one query.
+GRAPHQL_BATCH_WINDOW = 0.01
+GRAPHQL_MAX_BATCH = 50
+
+_GRAPHQL_VALUE_RE = re.compile(r"\$(\w+)")
+
+
+def _graphql_literal(value):
+    # JSON's syntax for these is also valid GraphQL
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return json.dumps(value)
+    raise TypeError(f"can't put {value!r} in a GraphQL query")
+
+
+def _fill_graphql_values(selection, values):
+    return _GRAPHQL_VALUE_RE.sub(
+        lambda match: _graphql_literal(values[match.group(1)]), selection
+    )
+
+
+# Priorities for Github API requests; lower numbers go first. See
+# RateLimitScheduler.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+# How many times to retry a request that hit a secondary rate limit (after
+# waiting as long as Github's Retry-After says).
+RATE_LIMIT_RETRIES = 2
+
+
+# Requests that fail with one of these errors or statuses are retried (with
+# jittered exponential backoff), as long as it's safe to send them twice.
+RETRYABLE_ERRORS = (OSError, asks.errors.AsksException)
+RETRYABLE_STATUSES = {500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+REQUEST_TIMEOUT = 30
+REQUEST_RETRIES = 2
+RETRY_BACKOFF = 0.5
+# If hedging is on, then once we've seen this many GETs, any GET that takes
+# longer than HEDGE_PERCENTILE of recent ones gets a second copy sent.
+HEDGE_MIN_SAMPLES = 20
+HEDGE_PERCENTILE = 0.95
+
+
+def _secondary_rate_limited(status_code, headers):
+    return status_code in (403, 429) and "retry-after" in headers
+
+
+# Github has separate rate limits for separate parts of its API (its
+# x-ratelimit-resource header): GraphQL spends "points" out of a different
+# budget, and search has a small per-minute one. Everything else is "core".
+def _rate_limit_resource(url):
+    path = urllib.parse.urlsplit(url).path
+    if path == "/graphql":
+        return "graphql"
+    if path.startswith("/search/"):
+        return "search"
+    return "core"
+
+
+GITHUB_REQUESTS = Histogram(
+    "snekomatic_github_request_seconds",
+    "Github API requests, including retries, by URL template and status",
+    ["method", "url", "status"],
+)
+GITHUB_REQUEST_RETRIES = Counter(
+    "snekomatic_github_request_retries_total",
+    "Github API requests that we retried, by why (timeout, error, status)",
+    ["reason"],
+)
+GITHUB_REQUEST_TIMEOUTS = Counter(
+    "snekomatic_github_request_timeouts_total",
+    "Github API request attempts that got no response in time",
+)
+GITHUB_REQUEST_HEDGES = Counter(
+    "snekomatic_github_request_hedges_total",
+    "Hedged Github API requests, by whether the hedge won or lost",
+    ["outcome"],
+)
+GITHUB_TOKEN_REFRESHES = Counter(
+    "snekomatic_github_token_refreshes_total",
+    "Installation token renewals, by what triggered them",
+    ["trigger"],
+)
+GITHUB_TOKENS = Counter(
+    "snekomatic_github_tokens_total",
+    "Installation tokens we got, by where they came from",
+    ["source"],
+)
+HANDLER_DURATION = Histogram(
+    "snekomatic_handler_seconds",
+    "Webhook and command handler run times",
+    ["event", "handler", "outcome"],
+)
+GITHUB_ROUTE_REQUESTS = Counter(
+    "snekomatic_github_route_requests_total",
+    "Github API requests by the route that made them, and what became of "
+    "them (sent, not_modified, deferred, rejected)",
+    ["route", "outcome"],
+)
+
+# Path segments that come right after one of these are names, not structure.
+_NAMED_BY_NEXT_SEGMENT = {
+    "orgs": "{org}",
+    "users": "{user}",
+    "members": "{user}",
+    "memberships": "{user}",
+    "collaborators": "{user}",
+    "secrets": "{name}",
+    "labels": "{name}",
+    "branches": "{branch}",
+}
+_SHA_RE = re.compile("[0-9a-f]{40}")
+
+
+def _url_template(url):
+    """Turns a Github API URL back into something like a URL template.
+
+    So '/repos/python-trio/trio/issues/123/comments' becomes
+    '/repos/{owner}/{repo}/issues/{id}/comments'. It's a best-effort guess,
+    but it keeps metric labels from growing without bound.
+
+    """
+    path = urllib.parse.urlsplit(url).path
+    segments = path.split("/")
+    i = 0
+    while i < len(segments):
+        segment = segments[i]
+        if segment.isdigit():
+            segments[i] = "{id}"
+        elif _SHA_RE.fullmatch(segment):
+            segments[i] = "{sha}"
+        elif segment == "repos" and i + 2 < len(segments):
+            segments[i + 1 : i + 3] = ["{owner}", "{repo}"]
+            i += 2
+        elif (
+            segment in _NAMED_BY_NEXT_SEGMENT
+            and i + 1 < len(segments)
+            and segments[i + 1] != "public-key"
+        ):
+            segments[i + 1] = _NAMED_BY_NEXT_SEGMENT[segment]
+            i += 1
+        i += 1
+    return "/".join(segments)
+
+
+# asks treats every 3xx response as a redirect, so when Github answers a
+# conditional request with 304 Not Modified (which has no Location header),
+# it crashes with KeyError: 'location'. That's
+#   https://github.com/theelous3/asks/issues/133
+# and it's why gidgethub's cache was disabled for a long time. Newer versions
+# of asks let you turn off redirects, but they need a newer anyio. So until
+# then, we teach asks that a 304 is just a response.
+def _work_around_asks_issue_133():
+    RequestProcessor = asks.request_object.RequestProcessor
+    original_redirect = RequestProcessor._redirect
+    if getattr(original_redirect, "_passes_304_through", False):
+        return
+
+    async def _redirect(self, response_obj):
+        if response_obj.status_code == 304:
+            return response_obj
+        return await original_redirect(self, response_obj)
+
+    _redirect._passes_304_through = True
+    RequestProcessor._redirect = _redirect
+
+
+_work_around_asks_issue_133()
+
+
+# Github's API is only eventually consistent, so if we react to a webhook
+# immediately we sometimes see stale data. By default we wait a bit before
+# dispatching each webhook, but some events don't need that, because they
+# report on something that's already finished. Keys are either "event_type"
+# or "event_type.action"; the more specific one wins.
+DEFAULT_DISPATCH_DELAY = 1
+DEFAULT_DISPATCH_DELAYS = {
+    "check_run.completed": 0,
+    "check_suite.completed": 0,
+    "status": 0,
+    # These invalidate our installation cache, so the sooner the better
+    "installation": 0,
+    "installation_repositories": 0,
+}
+
+
+class _TaskStatusIgnored:
+    def started(self, value=None):
+        pass
+
+
+# Like trio.TASK_STATUS_IGNORED, but we don't want to depend on trio here.
+TASK_STATUS_IGNORED = _TaskStatusIgnored()
+
+
 def _lazy_env_fallback(name):
     def getter(self):
         attr_name = f"_{name}"
@@ -127,18 +514,54 @@ def _lazy_env_fallback(name):
     return property(getter)
 
 
-def _all_match(data, restrictions):
-    for key, value in restrictions.items():
-        if key not in data or data[key] != value:
-            return False
-    return True
+_MISSING = object()
+
+
+def _lookup_path(data, path):
+    for key in path:
+        if not isinstance(data, dict) or key not in data:
+            return _MISSING
+        data = data[key]
+    return data
 
 
 # This should maybe move into gidgethub
 class BaseGithubClient(gidgethub.abc.GitHubAPI):
-    def __init__(self, session, *args, **kwargs):
+    def __init__(
+        self,
+        session,
+        *args,
+        rate_limiter=None,
+        rate_limit_key=None,
+        priority=PRIORITY_NORMAL,
+        coalescer=None,
+        graphql_batcher=None,
+        retry_policy=None,
+        route_quotas=None,
+        route=None,
+        **kwargs,
+    ):
         self._session = session
+        self._retry_policy = retry_policy
+        self._route_quotas = route_quotas
+        # Who to charge our requests to; if None, it's whichever handler
+        # we're running in (see RouteQuotas).
+        self.route = route
+        self._coalescer = coalescer
+        self._graphql_batcher = graphql_batcher
+        self._rate_limiter = rate_limiter
+        self._rate_limit_key = rate_limit_key
+        self.priority = priority
         super().__init__(*args, **kwargs)
+        # gidgethub also accepts a plain mapping as the cache; only ours needs
+        # the extra hooks below.
+        if isinstance(self._cache, SegmentedCacheOverlay):
+            self._response_cache = self._cache
+        else:
+            self._response_cache = None
+        # gidgethub only tells us about the "next" page, so getiter looks
+        # here for the rest of the Link header. Maps URL -> Link header.
+        self._links = cachetools.LRUCache(16)
 
     async def _request(
         self,
@@ -147,15 +570,356 @@ class BaseGithubClient(gidgethub.abc.GitHubAPI):
         headers: Mapping[str, str],
         body: bytes = b"",
     ) -> Tuple[int, Mapping[str, str], bytes]:
-        response = await self._session.request(
-            method, url, headers=headers, data=body
+        status = "error"
+        template = _url_template(url)
+        start = await anyio.current_time()
+        with tracing.span(
+            "github.request", method=method, url=template
+        ) as span:
+            try:
+                response = await self._request_with_retries(
+                    method, url, headers, body
+                )
+                status = str(response[0])
+                return response
+            finally:
+                span.set(status=status)
+                GITHUB_REQUESTS.observe(
+                    await anyio.current_time() - start,
+                    method,
+                    template,
+                    status,
+                )
+
+    async def _request_with_retries(self, method, url, headers, body):
+        policy = self._retry_policy
+        rate_limit_retries = 0
+        failures = 0
+        while True:
+            try:
+                if method == "GET" and policy is not None:
+                    hedge_after = policy.hedge_after()
+                else:
+                    hedge_after = None
+                if hedge_after is not None:
+                    response = await self._hedged_request(
+                        method, url, headers, body, hedge_after
+                    )
+                else:
+                    response = await self._request_once(
+                        method, url, headers, body
+                    )
+            except RETRYABLE_ERRORS as exc:
+                if not self._should_retry(method, failures):
+                    raise
+                print(f"{method} {url} failed ({exc!r}); will retry")
+                if isinstance(exc, TimeoutError):
+                    reason = "timeout"
+                else:
+                    reason = "error"
+            else:
+                status_code, lower_headers, content = response
+                # Without a scheduler, there's nobody to make this retry wait.
+                if (
+                    _secondary_rate_limited(status_code, lower_headers)
+                    and self._rate_limiter is not None
+                    and rate_limit_retries < RATE_LIMIT_RETRIES
+                ):
+                    rate_limit_retries += 1
+                    print(f"Secondary rate limit for {url}; will retry")
+                    continue
+                if status_code not in RETRYABLE_STATUSES:
+                    break
+                if not self._should_retry(method, failures):
+                    break
+                print(f"{method} {url} got {status_code}; will retry")
+                reason = "status"
+            await policy.backoff(failures, reason)
+            failures += 1
+        if status_code == 304 and self._response_cache is not None:
+            self._response_cache.not_modified()
+        if "link" in lower_headers:
+            self._links[url] = lower_headers["link"]
+        return status_code, lower_headers, content
+
+    def _should_retry(self, method, failures):
+        policy = self._retry_policy
+        return (
+            policy is not None
+            and method in IDEMPOTENT_METHODS
+            and failures < policy.max_retries
         )
-        # asks stores headers in a regular dict. They're probably lowercase
-        # already, but let's be 100% certain.
-        lower_headers = {
-            key.lower(): value for (key, value) in response.headers.items()
-        }
-        return response.status_code, lower_headers, response.content
+
+    async def _hedged_request(self, method, url, headers, body, hedge_after):
+        # Whichever attempt finishes first wins, and the other is cancelled.
+        outcomes = []
+        hedged = False
+
+        async def attempt(delay):
+            nonlocal hedged
+            if delay:
+                await anyio.sleep(delay)
+                hedged = True
+                self._retry_policy.hedges += 1
+            try:
+                response = await self._request_once(
+                    method, url, headers, body
+                )
+            except RETRYABLE_ERRORS as exc:
+                outcomes.append((delay, None, exc))
+                # If the hedge hasn't gone out yet, don't wait for it; let
+                # the usual retry logic take over.
+                if not hedged:
+                    await tg.cancel_scope.cancel()
+            else:
+                outcomes.append((delay, response, None))
+                await tg.cancel_scope.cancel()
+
+        async with anyio.create_task_group() as tg:
+            await tg.spawn(attempt, 0)
+            await tg.spawn(attempt, hedge_after)
+        for delay, response, _ in outcomes:
+            if response is not None:
+                if delay:
+                    self._retry_policy.hedge_wins += 1
+                if hedged:
+                    GITHUB_REQUEST_HEDGES.inc("won" if delay else "lost")
+                return response
+        if hedged:
+            GITHUB_REQUEST_HEDGES.inc("lost")
+        raise outcomes[0][2]
+
+    def _charged_route(self):
+        return self.route or _current_route.get() or UNATTRIBUTED
+
+    async def _request_once(self, method, url, headers, body):
+        limiter = self._rate_limiter
+        policy = self._retry_policy
+        timeout = None if policy is None else policy.timeout
+        quotas = self._route_quotas
+        if quotas is not None:
+            route = self._charged_route()
+            await quotas.acquire(self._rate_limit_key, route)
+        if limiter is not None:
+            resource = _rate_limit_resource(url)
+            await limiter.acquire(
+                self._rate_limit_key, self.priority, resource
+            )
+        status_code = None
+        lower_headers = {}
+        try:
+            start = await anyio.current_time()
+            # The timeout doesn't include waiting for the rate limiter
+            async with anyio.move_on_after(timeout) as scope:
+                response = await self._session.request(
+                    method, url, headers=headers, data=body
+                )
+            if scope.cancel_called:
+                policy.timeouts += 1
+                GITHUB_REQUEST_TIMEOUTS.inc()
+                raise TimeoutError(
+                    f"no response to {method} {url} after {timeout} seconds"
+                )
+            status_code = response.status_code
+            # asks stores headers in a regular dict. They're probably
+            # lowercase already, but let's be 100% certain.
+            lower_headers = {
+                key.lower(): value
+                for (key, value) in response.headers.items()
+            }
+        finally:
+            if limiter is not None:
+                await limiter.release(
+                    self._rate_limit_key, status_code, lower_headers, resource
+                )
+        if policy is not None and method == "GET" and status_code < 500:
+            policy.record_latency(await anyio.current_time() - start)
+        if quotas is not None and status_code == 304:
+            quotas.refund(self._rate_limit_key, route)
+        return status_code, lower_headers, response.content
+
+    async def _make_request(
+        self, method, url, url_vars, data, accept, *, coalesce=True, **kwargs
+    ):
+        coalescer = self._coalescer
+        if (
+            coalescer is None
+            or not coalesce
+            or method != "GET"
+            or data != b""
+        ):
+            return await self._make_uncoalesced_request(
+                method, url, url_vars, data, accept, **kwargs
+            )
+        # Same URL, same Accept, same credentials -> same answer. But the
+        # request is queued at its runner's priority and charged to its
+        # runner's route, so only merge requests that agree on those too;
+        # otherwise an interactive request could end up waiting behind a
+        # background one, or spend another route's budget.
+        oauth_token = kwargs.get("oauth_token") or self.oauth_token
+        key = (
+            format_url(url, url_vars),
+            accept,
+            kwargs.get("jwt"),
+            oauth_token,
+            self.priority,
+            self._charged_route(),
+        )
+        return await coalescer.run(
+            key,
+            functools.partial(
+                self._make_uncoalesced_request,
+                method,
+                url,
+                url_vars,
+                data,
+                accept,
+                **kwargs,
+            ),
+        )
+
+    async def _make_uncoalesced_request(
+        self, method, url, url_vars, data, accept, **kwargs
+    ):
+        # gidgethub's cache interface is synchronous, so if the cache has a
+        # backend, we have to do its I/O before and after the request.
+        cache = self._response_cache
+        if cache is not None and method == "GET" and data == b"":
+            await cache.prefetch(format_url(url, url_vars))
+        result = await super()._make_request(
+            method, url, url_vars, data, accept, **kwargs
+        )
+        if cache is not None:
+            await cache.flush()
+        return result
+
+    # These are the same as gidgethub's, except that they take coalesce=. By
+    # default, identical GETs that are in flight at the same time are merged
+    # into a single request, and everyone gets the same result object (so
+    # don't mutate it). Pass coalesce=False to always make your own request.
+
+    async def getitem(
+        self,
+        url,
+        url_vars={},
+        *,
+        accept=accept_format(),
+        jwt=None,
+        oauth_token=None,
+        coalesce=True,
+    ):
+        data, _ = await self._make_request(
+            "GET",
+            url,
+            url_vars,
+            b"",
+            accept,
+            jwt=jwt,
+            oauth_token=oauth_token,
+            coalesce=coalesce,
+        )
+        return data
+
+    async def getiter(
+        self,
+        url,
+        url_vars={},
+        *,
+        accept=accept_format(),
+        jwt=None,
+        oauth_token=None,
+        coalesce=True,
+        prefetch=PAGE_PREFETCH,
+    ):
+        """Like gidgethub's getiter, except that once Github tells us how many
+        pages there are, we fetch up to 'prefetch' of them at a time,
+        concurrently. Items still come out in order, and if you stop early,
+        we stop fetching pages.
+
+        """
+
+        async def get_page(page_url):
+            data, more = await self._make_request(
+                "GET",
+                page_url,
+                {},
+                b"",
+                accept,
+                jwt=jwt,
+                oauth_token=oauth_token,
+                coalesce=coalesce,
+            )
+            if isinstance(data, dict) and "items" in data:
+                data = data["items"]
+            return data, more
+
+        url = format_url(url, url_vars)
+        self._links.pop(url, None)
+        data, more = await get_page(url)
+        for item in data:
+            yield item
+        page_urls = None
+        if prefetch > 1:
+            page_urls = _page_urls(more, self._links.pop(url, None))
+        if page_urls is not None:
+            for i in range(0, len(page_urls), prefetch):
+                batch = page_urls[i : i + prefetch]
+                pages = [None] * len(batch)
+
+                async def fetch(j):
+                    pages[j] = await get_page(batch[j])
+
+                # We don't yield inside the task group, because the consumer
+                # might stop iterating at any point.
+                async with anyio.create_task_group() as tg:
+                    for j in range(len(batch)):
+                        await tg.spawn(fetch, j)
+                for data, more in pages:
+                    for item in data:
+                        yield item
+        # Either we couldn't predict the page URLs, or the listing grew while
+        # we were fetching it, so now there are pages past the "last" one.
+        while more:
+            data, more = await get_page(more)
+            for item in data:
+                yield item
+
+    async def _graphql_request(self, query, variables={}):
+        data, _ = await self._make_request(
+            "POST",
+            "/graphql",
+            {},
+            {"query": query, "variables": variables},
+            accept_format(),
+        )
+        return data
+
+    async def graphql(self, query, **variables):
+        """Run a GraphQL query, and return its data.
+
+        Raises GraphQLError if Github reports any errors.
+
+        """
+        response = await self._graphql_request(query, variables)
+        if response.get("errors"):
+            raise GraphQLError(response["errors"])
+        return response["data"]
+
+    async def graphql_lookup(self, selection, **values):
+        """Look up a single top-level field with GraphQL, and return it.
+
+        Anything like $name in the selection is replaced by the 'name'
+        keyword argument (a string, number, bool, or None). Lookups from
+        concurrent tasks get batched into a single query (see GraphQLBatcher),
+        but each caller only sees its own result, or its own GraphQLError.
+
+        """
+        selection = _fill_graphql_values(selection, values)
+        batcher = self._graphql_batcher
+        if batcher is None:
+            batcher = GraphQLBatcher(window=0)
+        # Only lookups with the same credentials can go together
+        return await batcher.lookup(self._rate_limit_key, self, selection)
 
     # Why does gidgethub make this mandatory? it's not used for anything
     async def sleep(self, seconds):
@@ -173,42 +937,378 @@ class SegmentedCacheOverlay:
     def __setitem__(self, key, value):
         self._underlying[self._segment, key] = value
 
+    async def prefetch(self, key):
+        await self._underlying.prefetch(self._segment, key)
+
+    async def flush(self):
+        await self._underlying.flush()
+
+    def not_modified(self):
+        self._underlying.not_modified()
+
+
+class ResponseCache:
+    """The conditional-request cache that our gidgethub clients share.
+
+    gidgethub stores (etag, last_modified, data, more) tuples under each URL
+    it GETs, and sends the etag back next time; if Github says 304 Not
+    Modified, we get the data for free, without using up any rate limit.
+    Each client sees the cache through a SegmentedCacheOverlay, because
+    different installations can see different things at the same URL.
+
+    The size limit is in bytes (of JSON), because responses range from tiny
+    to huge. Optionally, there's also a backend, with async methods:
+
+      load(segment, url) -> bytes or None
+      save(segment, url, bytes)
+
+    e.g. backed by a database, so the cache survives restarts.
+
+    """
+
+    def __init__(self, max_bytes, backend=None):
+        # Values are (entry, size)
+        self._entries = cachetools.LRUCache(
+            max_bytes, getsizeof=lambda value: value[1]
+        )
+        self.backend = backend
+        self._unsaved = []
+        self._stats = {
+            "stores": 0,
+            "conditional_requests": 0,
+            "not_modified": 0,
+            "backend_loads": 0,
+            "backend_failures": 0,
+        }
+
+    def __getitem__(self, key):
+        entry, _ = self._entries[key]
+        self._stats["conditional_requests"] += 1
+        return entry
+
+    def __setitem__(self, key, entry):
+        encoded = json.dumps(entry).encode("utf-8")
+        self._store(key, entry, len(encoded))
+        self._stats["stores"] += 1
+        if self.backend is not None:
+            self._unsaved.append((key, encoded))
+
+    def _store(self, key, entry, size):
+        # LRUCache raises ValueError for anything bigger than the whole
+        # cache; those just don't get cached.
+        if size <= self._entries.maxsize:
+            self._entries[key] = (tuple(entry), size)
+
+    def not_modified(self):
+        self._stats["not_modified"] += 1
+
+    async def prefetch(self, segment, url):
+        if self.backend is None or (segment, url) in self._entries:
+            return
+        try:
+            encoded = await self.backend.load(segment, url)
+        except Exception as exc:
+            self._stats["backend_failures"] += 1
+            print(f"Loading {url} from response cache failed: {exc!r}")
+            return
+        if encoded is not None:
+            self._stats["backend_loads"] += 1
+            self._store((segment, url), json.loads(encoded), len(encoded))
+
+    async def flush(self):
+        while self._unsaved:
+            (segment, url), encoded = self._unsaved.pop(0)
+            try:
+                await self.backend.save(segment, url, encoded)
+            except Exception as exc:
+                # It's only a cache
+                self._stats["backend_failures"] += 1
+                print(f"Saving {url} to response cache failed: {exc!r}")
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self._entries.currsize,
+            **self._stats,
+        }
+
+
+@attr.s
+class _Flight:
+    done = attr.ib()
+    finished = attr.ib(default=False)
+    result = attr.ib(default=None)
+    error = attr.ib(default=None)
+
+
+@attr.s
+class RequestCoalescer:
+    """Merges identical requests that are in flight at the same time.
+
+    The first caller with a given key actually runs the request; anyone who
+    shows up with the same key before it finishes waits for it, and gets
+    the same result (or exception). If the first caller is cancelled, the
+    others start over.
+
+    """
+
+    _flights = attr.ib(factory=dict)
+    requests = attr.ib(default=0)
+    coalesced = attr.ib(default=0)
+
+    async def run(self, key, async_fn):
+        counted = False
+        while key in self._flights:
+            flight = self._flights[key]
+            if not counted:
+                self.coalesced += 1
+                counted = True
+            await flight.done.wait()
+            if flight.finished:
+                if flight.error is not None:
+                    raise flight.error
+                return flight.result
+        flight = _Flight(anyio.create_event())
+        self._flights[key] = flight
+        self.requests += 1
+        try:
+            flight.result = await async_fn()
+            flight.finished = True
+        except Exception as exc:
+            flight.error = exc
+            flight.finished = True
+            raise
+        finally:
+            del self._flights[key]
+            async with anyio.open_cancel_scope(shield=True):
+                await flight.done.set()
+        return flight.result
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._flights),
+        }
+
+
+@attr.s
+class RetryPolicy:
+    """How hard our clients try to get an answer out of Github.
+
+    Each attempt at a request gives up after 'timeout' seconds. Idempotent
+    requests that time out, fail to connect, or get a 5xx response are
+    retried up to max_retries times. If 'hedge' is True, then GETs that are
+    slower than usual (see HEDGE_PERCENTILE) get a second copy sent, and we
+    take whichever answer comes back first.
+
+    """
+
+    timeout = attr.ib(default=REQUEST_TIMEOUT)
+    max_retries = attr.ib(default=REQUEST_RETRIES)
+    backoff_base = attr.ib(default=RETRY_BACKOFF)
+    hedge = attr.ib(default=False)
+    _latencies = attr.ib(factory=lambda: deque(maxlen=200))
+    retries = attr.ib(default=0)
+    timeouts = attr.ib(default=0)
+    hedges = attr.ib(default=0)
+    hedge_wins = attr.ib(default=0)
+
+    def record_latency(self, seconds):
+        self._latencies.append(seconds)
+
+    def hedge_after(self):
+        if not self.hedge or len(self._latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(self._latencies)
+        index = min(
+            len(latencies) - 1, int(len(latencies) * HEDGE_PERCENTILE)
+        )
+        return latencies[index]
+
+    async def backoff(self, failures, reason):
+        self.retries += 1
+        GITHUB_REQUEST_RETRIES.inc(reason)
+        delay = self.backoff_base * 2 ** failures
+        await anyio.sleep(random.uniform(0, delay))
+
+    def stats(self):
+        return {
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedge_after": self.hedge_after(),
+        }
+
+
+class GraphQLError(Exception):
+    """Raised when Github reports errors in a GraphQL query.
+
+    The errors are in .errors, in the format Github sent them.
+
+    """
+
+    def __init__(self, errors):
+        super().__init__(
+            "; ".join(error.get("message", repr(error)) for error in errors)
+        )
+        self.errors = errors
+
+
+@attr.s
+class _GraphQLBatch:
+    # The selections to send, one per lookup
+    lookups = attr.ib()
+    # Set when the batch is too big to wait for any more lookups
+    full = attr.ib()
+    done = attr.ib()
+    finished = attr.ib(default=False)
+    data = attr.ib(default=None)
+    errors = attr.ib(default=())
+    # If the whole request failed
+    error = attr.ib(default=None)
+
+    def result(self, index):
+        if self.error is not None:
+            raise self.error
+        alias = f"q{index}"
+        errors = [
+            error
+            for error in self.errors
+            if not error.get("path") or error["path"][0] == alias
+        ]
+        if errors:
+            raise GraphQLError(errors)
+        return self.data.get(alias)
+
+
+@attr.s
+class GraphQLBatcher:
+    """Combines GraphQL lookups into batches.
+
+    The first lookup for a key (i.e., a set of credentials) waits 'window'
+    seconds for others to join it, and then sends them all as one query,
+    each under its own alias:
+
+      query {
+        q0: user(login: "alice") { name }
+        q1: user(login: "bob") { name }
+      }
+
+    A batch is sent early if it reaches max_batch lookups. If the task
+    sending a batch is cancelled, the other lookups start over.
+
+    """
+
+    window = attr.ib(default=GRAPHQL_BATCH_WINDOW)
+    max_batch = attr.ib(default=GRAPHQL_MAX_BATCH)
+    _pending = attr.ib(factory=dict)
+    lookups = attr.ib(default=0)
+    batches = attr.ib(default=0)
+    largest_batch = attr.ib(default=0)
+
+    async def lookup(self, key, client, selection):
+        self.lookups += 1
+        while key in self._pending:
+            batch = self._pending[key]
+            index = len(batch.lookups)
+            batch.lookups.append(selection)
+            if len(batch.lookups) >= self.max_batch:
+                del self._pending[key]
+                await batch.full.set()
+            await batch.done.wait()
+            if batch.finished:
+                return batch.result(index)
+        batch = _GraphQLBatch(
+            [selection], anyio.create_event(), anyio.create_event()
+        )
+        if self.max_batch > 1:
+            self._pending[key] = batch
+        try:
+            async with anyio.move_on_after(self.window):
+                await batch.full.wait()
+            if self._pending.get(key) is batch:
+                del self._pending[key]
+            self.batches += 1
+            self.largest_batch = max(self.largest_batch, len(batch.lookups))
+            query = "".join(
+                f"  q{i}: {lookup}\n"
+                for (i, lookup) in enumerate(batch.lookups)
+            )
+            try:
+                response = await client._graphql_request(
+                    f"query {{\n{query}}}"
+                )
+            except Exception as exc:
+                batch.error = exc
+            else:
+                batch.data = response.get("data") or {}
+                batch.errors = response.get("errors") or ()
+            batch.finished = True
+        finally:
+            if self._pending.get(key) is batch:
+                del self._pending[key]
+            async with anyio.open_cancel_scope(shield=True):
+                await batch.done.set()
+        return batch.result(0)
+
+    def stats(self):
+        return {
+            "lookups": self.lookups,
+            "batches": self.batches,
+            "largest_batch": self.largest_batch,
+        }
+
+
+def _sign_app_jwt(claims, private_key):
+    return jwt.encode(claims, key=private_key, algorithm="RS256").decode(
+        "ascii"
+    )
+
 
 class AppGithubClient(BaseGithubClient):
     def __init__(self, app):
         self.app = app
-        # Temporarily disabled because of:
-        #   https://github.com/theelous3/asks/issues/133
-        # cache = SegmentedCacheOverlay(app._cache, None)
-        cache = None
-        super().__init__(app._session, requester=app.user_agent, cache=cache)
+        cache = SegmentedCacheOverlay(app.response_cache, None)
+        super().__init__(
+            app._session,
+            requester=app.user_agent,
+            cache=cache,
+            rate_limiter=app._rate_limits,
+            rate_limit_key=None,
+            coalescer=app._coalescer,
+            graphql_batcher=app._graphql_batcher,
+            retry_policy=app._retry_policy,
+            route_quotas=app.route_quotas,
+        )
 
     async def _make_request(self, *args, **kwargs):
-        now = pendulum.now()
-        jwt_app_token = jwt.encode(
-            {
-                "iat": (now - MAX_CLOCK_SKEW).int_timestamp,
-                "exp": (now + MAX_CLOCK_SKEW).int_timestamp,
-                "iss": self.app.app_id,
-            },
-            key=self.app.private_key,
-            algorithm="RS256",
-        )
-        jwt_app_token = jwt_app_token.decode("ascii")
         kwargs["oauth_token"] = None
-        kwargs["jwt"] = jwt_app_token
+        kwargs["jwt"] = await self.app.app_jwt()
         return await super()._make_request(*args, **kwargs)
 
 
 class InstallationGithubClient(BaseGithubClient):
-    def __init__(self, app, installation_id):
+    def __init__(
+        self, app, installation_id, *, priority=PRIORITY_NORMAL, route=None
+    ):
         self.app = app
         self.installation_id = installation_id
-        # Temporarily disabled because of:
-        #   https://github.com/theelous3/asks/issues/133
-        # cache = SegmentedCacheOverlay(app._cache, installation_id)
-        cache = None
-        super().__init__(app._session, requester=app.user_agent, cache=cache)
+        cache = SegmentedCacheOverlay(app.response_cache, installation_id)
+        super().__init__(
+            app._session,
+            requester=app.user_agent,
+            cache=cache,
+            rate_limiter=app._rate_limits,
+            rate_limit_key=str(installation_id),
+            priority=priority,
+            coalescer=app._coalescer,
+            graphql_batcher=app._graphql_batcher,
+            retry_policy=app._retry_policy,
+            route_quotas=app.route_quotas,
+            route=route,
+        )
 
     async def _make_request(self, *args, **kwargs):
         token = await self.app.token_for(self.installation_id)
@@ -217,6 +1317,76 @@ class InstallationGithubClient(BaseGithubClient):
         return await super()._make_request(*args, **kwargs)
 
 
+@attr.s
+class ClientPool:
+    """Keeps installation clients around between deliveries.
+
+    Clients are keyed by (installation id, priority, route), so everything
+    that asks for the same kind of client shares one, along with the state
+    it picks up along the way (gidgethub's rate_limit, our Link header
+    cache). 'clients' should be a cachetools cache; with a TTLCache, clients
+    that haven't been asked for in a while get dropped.
+
+    """
+
+    _clients = attr.ib()
+    created = attr.ib(default=0)
+    reused = attr.ib(default=0)
+
+    def get(self, key, create):
+        client = self._clients.get(key)
+        if client is None:
+            self.created += 1
+            client = create()
+        else:
+            self.reused += 1
+        # Putting it back restarts the TTL, so it's idle clients that expire
+        self._clients[key] = client
+        return client
+
+    def discard(self, installation_id):
+        for key in list(self._clients.keys()):
+            if key[0] == installation_id:
+                self._clients.pop(key, None)
+
+    def stats(self):
+        return {
+            "pooled": len(self._clients),
+            "created": self.created,
+            "reused": self.reused,
+        }
+
+
+# Github sends us lots of webhooks we don't care about, and some of them are
+# big (e.g. 'push' and 'check_run'). So we hold onto the raw body, and only
+# decode it if someone actually looks at it.
+class _LazyEvent(Event):
+    def __init__(self, headers, body):
+        self.event = headers["x-github-event"]
+        self.delivery_id = headers["x-github-delivery"]
+        self._content_type = headers.get("content-type")
+        self._body = body
+        self._data = _MISSING
+        # The delivery's root tracing span, so the scheduler can put the
+        # handlers in the same trace.
+        self.span = None
+
+    @property
+    def data(self):
+        if self._data is _MISSING:
+            headers = {
+                "x-github-event": self.event,
+                "x-github-delivery": self.delivery_id,
+            }
+            if self._content_type is not None:
+                headers["content-type"] = self._content_type
+            # We already checked the signature, so this just decodes it (or
+            # raises BadRequest if it can't)
+            self._data = Event.from_http(headers, self._body).data
+            self._body = None
+        return self._data
+
+
 @attr.s
 class CachedInstallationToken:
     token = attr.ib(default="")
@@ -225,6 +1395,697 @@ class CachedInstallationToken:
     # if a refresh is already in progress, an anyio.Event
     # otherwise, None
     refresh_event = attr.ib(default=None)
+    # When token_for last handed this token out; None if it never has
+    last_used = attr.ib(default=None)
+    # When the background refresher should renew it
+    refresh_at = attr.ib(default=None)
+
+
+@attr.s
+class DispatchScheduler:
+    """Holds webhook deliveries until they're due to be dispatched.
+
+    Pending deliveries sit in a heap, ordered by due time, and a single task
+    sleeps until the next one is due. So waiting doesn't tie up a task (or an
+    HTTP request) per delivery.
+
+    """
+
+    _heap = attr.ib(factory=list)
+    _counter = attr.ib(factory=itertools.count)
+    _wakeup = attr.ib(default=None)
+    running = attr.ib(default=False)
+    # Deliveries that have been released, but whose handlers haven't
+    # finished yet
+    in_progress = attr.ib(default=0)
+    # How late the most recently released delivery was, in seconds
+    last_lag = attr.ib(default=0.0)
+
+    @property
+    def depth(self):
+        return len(self._heap)
+
+    async def submit(self, delay, item):
+        due = await anyio.current_time() + delay
+        heapq.heappush(self._heap, (due, next(self._counter), item))
+        if self._wakeup is not None:
+            await self._wakeup.set()
+
+    async def _run_one(self, dispatch_fn, item):
+        self.in_progress += 1
+        try:
+            await dispatch_fn(item)
+        finally:
+            self.in_progress -= 1
+
+    async def run(self, dispatch_fn, *, task_status=TASK_STATUS_IGNORED):
+        async with anyio.create_task_group() as tg:
+            self.running = True
+            task_status.started()
+            try:
+                while True:
+                    now = await anyio.current_time()
+                    while self._heap and self._heap[0][0] <= now:
+                        due, _, item = heapq.heappop(self._heap)
+                        self.last_lag = now - due
+                        await tg.spawn(self._run_one, dispatch_fn, item)
+                    if self._heap:
+                        timeout = self._heap[0][0] - now
+                    else:
+                        timeout = math.inf
+                    self._wakeup = anyio.create_event()
+                    async with anyio.move_on_after(timeout):
+                        await self._wakeup.wait()
+                    self._wakeup = None
+            finally:
+                self.running = False
+
+    async def stats(self):
+        if self._heap:
+            oldest_overdue = max(
+                0.0, await anyio.current_time() - self._heap[0][0]
+            )
+        else:
+            oldest_overdue = 0.0
+        return {
+            "depth": self.depth,
+            "in_progress": self.in_progress,
+            "last_lag": self.last_lag,
+            "oldest_overdue": oldest_overdue,
+        }
+
+
+@attr.s
+class DeliveryDeduplicator:
+    """Remembers which webhook deliveries we've already seen.
+
+    Github redelivers webhooks if we're slow to respond, and people can
+    redeliver them by hand. There's a bounded in-memory LRU of delivery ids
+    in front, and optionally a 'backend' behind it, which is an async
+    function that takes a delivery id, records it, and returns True if it
+    was already recorded. (E.g. something backed by a database, so that
+    redeliveries to a different process or after a restart are caught too.)
+    If there's a backend, there should also be a 'forget_backend', an async
+    function that erases a delivery id from it again.
+
+    """
+
+    _recent = attr.ib()
+    backend = attr.ib(default=None)
+    forget_backend = attr.ib(default=None)
+    memory_hits = attr.ib(default=0)
+    backend_hits = attr.ib(default=0)
+    misses = attr.ib(default=0)
+
+    async def is_duplicate(self, delivery_id):
+        if delivery_id in self._recent:
+            self.memory_hits += 1
+            return True
+        # Record it *before* checking the backend, so that if the same
+        # delivery arrives again while we're waiting, it's caught here.
+        self._recent[delivery_id] = True
+        try:
+            if self.backend is not None and await self.backend(delivery_id):
+                self.backend_hits += 1
+                return True
+        except BaseException:
+            # We don't know whether the backend recorded it, so make sure it
+            # didn't.
+            async with anyio.open_cancel_scope(shield=True):
+                await self.forget(delivery_id)
+            raise
+        self.misses += 1
+        return False
+
+    async def forget(self, delivery_id):
+        self._recent.pop(delivery_id, None)
+        if self.forget_backend is not None:
+            try:
+                await self.forget_backend(delivery_id)
+            except Exception as exc:
+                print(f"Failed to forget delivery {delivery_id}: {exc!r}")
+
+    def stats(self):
+        return {
+            "memory_hits": self.memory_hits,
+            "backend_hits": self.backend_hits,
+            "misses": self.misses,
+        }
+
+
+@attr.s
+class InstallationCache:
+    """Remembers which installation each repo belongs to, and which repos
+    each installation has.
+
+    GithubApp keeps this up to date using the installation and
+    installation_repositories webhooks, so normally looking up the client
+    for a repo doesn't need any API calls at all. Entries also expire after
+    a while, in case we miss a webhook.
+
+    """
+
+    # repo.lower() -> installation id
+    _installations = attr.ib()
+    # installation id -> list of repos
+    _repos = attr.ib()
+    hits = attr.ib(default=0)
+    misses = attr.ib(default=0)
+    invalidations = attr.ib(default=0)
+    # Bumped on every invalidation, so that a lookup that was already in
+    # flight doesn't put stale data back in the cache.
+    generation = attr.ib(default=0)
+
+    def _lookup(self, cache, key):
+        value = cache.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def installation_for_repo(self, repo):
+        return self._lookup(self._installations, repo.lower())
+
+    def repos_for_installation(self, installation_id):
+        return self._lookup(self._repos, installation_id)
+
+    def remember_repo(self, generation, repo, installation_id):
+        if generation == self.generation:
+            self._installations[repo.lower()] = installation_id
+
+    def remember_installation(self, generation, installation_id, repos):
+        if generation == self.generation:
+            self._repos[installation_id] = repos
+            for repo in repos:
+                self._installations[repo.lower()] = installation_id
+
+    def invalidate(self, installation_id, repos=()):
+        self.generation += 1
+        self.invalidations += 1
+        self._repos.pop(installation_id, None)
+        for repo in repos:
+            self._installations.pop(repo.lower(), None)
+        stale = [
+            repo
+            for (repo, cached_id) in self._installations.items()
+            if cached_id == installation_id
+        ]
+        for repo in stale:
+            self._installations.pop(repo, None)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+
+@attr.s
+class _QuotaState:
+    # What Github last told us, minus requests we've sent since then. None
+    # if we don't know (yet, or since the last reset).
+    remaining = attr.ib(default=None)
+    limit = attr.ib(default=None)
+    # These are all anyio clock times
+    reset_at = attr.ib(default=None)
+    blocked_until = attr.ib(default=None)
+    # (time, remaining) when we first heard about the current window; used to
+    # project when we'll run out.
+    window_start = attr.ib(default=None)
+    # Github's x-ratelimit-reset for the current window, to notice new ones
+    reset_epoch = attr.ib(default=None)
+    in_flight = attr.ib(default=0)
+    # Heap of (priority, seq) for requests waiting their turn
+    waiters = attr.ib(factory=list)
+    # Set (and replaced) whenever something changes that might let a waiter
+    # go ahead. Created on demand, since anyio needs to know which async
+    # library we're running under.
+    changed = attr.ib(default=None)
+
+
+def _exhausts_in(state, now):
+    if state.remaining is None or state.window_start is None:
+        return None
+    start_time, start_remaining = state.window_start
+    used = start_remaining - state.remaining
+    elapsed = now - start_time
+    if used <= 0 or elapsed <= 0:
+        return None
+    exhausts_in = state.remaining * elapsed / used
+    if exhausts_in >= state.reset_at - now:
+        # We'll get a fresh quota first
+        return None
+    return exhausts_in
+
+
+@attr.s
+class RateLimitScheduler:
+    """Keeps each installation's Github API requests inside its rate limits.
+
+    Every request is tagged with a key (the installation id, or None for the
+    app itself), a priority, and which of Github's rate limits it counts
+    against (see _rate_limit_resource). We track the remaining quota and
+    reset time for each key and resource from Github's x-ratelimit-*
+    headers. Once the quota is down to 'reserve', only PRIORITY_INTERACTIVE
+    requests are sent, and everything else waits for the reset. If Github
+    tells us to back off with a Retry-After (its "secondary" rate limits),
+    then everything for that key waits that long. And at most
+    max_concurrent requests per key and resource are sent at once.
+
+    Waiting requests go in priority order, first-come-first-served within
+    each priority.
+
+    """
+
+    reserve = attr.ib(default=100)
+    max_concurrent = attr.ib(default=10)
+    # Keyed by (str(installation id) or None for the app itself, resource)
+    _states = attr.ib(factory=lambda: defaultdict(_QuotaState))
+    _counter = attr.ib(factory=itertools.count)
+    # Requests that had to wait for something
+    throttled = attr.ib(default=0)
+    retry_afters = attr.ib(default=0)
+
+    def _delay(self, state, priority, now):
+        if state.blocked_until is not None and state.blocked_until > now:
+            return state.blocked_until - now
+        if state.reset_at is not None and state.reset_at <= now:
+            # New window; we don't know how much is left until Github tells
+            # us again.
+            state.remaining = None
+            state.reset_at = None
+            state.window_start = None
+        if state.remaining is not None:
+            if priority <= PRIORITY_INTERACTIVE:
+                reserve = 0
+            else:
+                reserve = self.reserve
+            if state.remaining <= reserve:
+                return state.reset_at - now
+        if state.in_flight >= self.max_concurrent:
+            return math.inf
+        return 0
+
+    async def _notify(self, state):
+        if state.changed is not None:
+            await state.changed.set()
+            state.changed = None
+
+    async def acquire(self, key, priority, resource="core"):
+        state = self._states[key, resource]
+        entry = (priority, next(self._counter))
+        heapq.heappush(state.waiters, entry)
+        try:
+            waited = False
+            while True:
+                now = await anyio.current_time()
+                if state.waiters[0] == entry:
+                    delay = self._delay(state, priority, now)
+                    if delay <= 0:
+                        break
+                else:
+                    delay = math.inf
+                if not waited:
+                    self.throttled += 1
+                    waited = True
+                if state.changed is None:
+                    state.changed = anyio.create_event()
+                changed = state.changed
+                async with anyio.move_on_after(delay):
+                    await changed.wait()
+        finally:
+            state.waiters.remove(entry)
+            heapq.heapify(state.waiters)
+            # Whoever's next might be able to go now
+            async with anyio.open_cancel_scope(shield=True):
+                await self._notify(state)
+        state.in_flight += 1
+        if state.remaining is not None:
+            state.remaining -= 1
+
+    async def release(self, key, status_code, headers, resource="core"):
+        """Call after each acquire, with the response's status and
+        (lowercased) headers, or None and {} if there wasn't a response.
+
+        """
+        state = self._states[key, resource]
+        state.in_flight -= 1
+        now = await anyio.current_time()
+        if (
+            "x-ratelimit-remaining" in headers
+            and "x-ratelimit-reset" in headers
+            # If we guessed wrong about which limit this counted against,
+            # then these numbers aren't about our state
+            and headers.get("x-ratelimit-resource", resource) == resource
+        ):
+            reset_epoch = int(headers["x-ratelimit-reset"])
+            remaining = int(headers["x-ratelimit-remaining"])
+            # Github's reset time is by its wall clock, so convert it to ours
+            reset_in = max(0, reset_epoch - pendulum.now().timestamp())
+            if reset_epoch != state.reset_epoch:
+                state.reset_epoch = reset_epoch
+                state.window_start = (now, remaining)
+            # Requests still in flight were already counted against our
+            # quota here, but (maybe) not yet by Github.
+            state.remaining = max(0, remaining - state.in_flight)
+            state.reset_at = now + reset_in
+            if "x-ratelimit-limit" in headers:
+                state.limit = int(headers["x-ratelimit-limit"])
+        if _secondary_rate_limited(status_code, headers):
+            try:
+                retry_after = int(headers["retry-after"])
+            except ValueError:
+                pass
+            else:
+                self.retry_afters += 1
+                blocked_until = now + retry_after
+                for (other_key, _), other in list(self._states.items()):
+                    if other_key != key:
+                        continue
+                    if other.blocked_until is None:
+                        other.blocked_until = blocked_until
+                    else:
+                        other.blocked_until = max(
+                            other.blocked_until, blocked_until
+                        )
+        await self._notify(state)
+
+    async def stats(self):
+        now = await anyio.current_time()
+        keys = {}
+        for (key, resource), state in self._states.items():
+            if state.reset_at is not None and state.reset_at > now:
+                resets_in = state.reset_at - now
+                remaining = state.remaining
+            else:
+                resets_in = None
+                remaining = None
+            if state.blocked_until is not None:
+                blocked_for = max(0, state.blocked_until - now)
+            else:
+                blocked_for = 0
+            name = "app" if key is None else str(key)
+            if resource != "core":
+                name = f"{name}/{resource}"
+            keys[name] = {
+                "remaining": remaining,
+                "limit": state.limit,
+                "resets_in": resets_in,
+                "blocked_for": blocked_for,
+                "in_flight": state.in_flight,
+                "waiting": len(state.waiters),
+                "exhausts_in": (
+                    None if remaining is None else _exhausts_in(state, now)
+                ),
+            }
+        return {
+            "waiting": sum(
+                len(state.waiters) for state in self._states.values()
+            ),
+            "throttled": self.throttled,
+            "retry_afters": self.retry_afters,
+            "installations": keys,
+        }
+
+
+class Overloaded(Exception):
+    """Raised by dispatch_webhook when we already have as many deliveries on
+    our hands as we're willing to take.
+
+    The webhook endpoint should respond with a 503, and a Retry-After header
+    of retry_after seconds.
+
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"too busy; retry after {retry_after} seconds")
+        self.retry_after = retry_after
+
+
+class BudgetExceeded(Exception):
+    """Raised by Github API requests when the route making them has used up
+    its hourly budget for this installation (unless the app was configured
+    with route_budget_action="defer").
+
+    The budget resets in retry_after seconds.
+
+    """
+
+    def __init__(self, route, installation, retry_after):
+        super().__init__(
+            f"{route} is over its Github API budget for installation "
+            f"{installation}; retry after {retry_after:.0f} seconds"
+        )
+        self.route = route
+        self.installation = installation
+        self.retry_after = retry_after
+
+
+# The handler the current task is running, which is who gets charged for its
+# Github API requests. Set by GithubApp._run_handler; trio copies it into
+# tasks that the handler spawns.
+_current_route = contextvars.ContextVar(
+    "snekomatic.gh.current_route", default=None
+)
+UNATTRIBUTED = "unattributed"
+ROUTE_BUDGET_WINDOW = 60 * 60
+
+
+@attr.s
+class _RouteUsage:
+    # anyio clock time when the current budget window started
+    window_start = attr.ib(default=None)
+    # Quota spent in the current window
+    window_spent = attr.ib(default=0)
+    # All time
+    spent = attr.ib(default=0)
+    sent = attr.ib(default=0)
+    not_modified = attr.ib(default=0)
+    deferred = attr.ib(default=0)
+    rejected = attr.ib(default=0)
+
+
+@attr.s
+class RouteQuotas:
+    """Accounts for each route's share of each installation's API quota.
+
+    A route is a handler (named like "module.function"), or whatever name was
+    passed to client_for_repo(route=...) for requests that don't come from a
+    handler; anything else is "unattributed". Requests are counted per
+    (installation, route); 304 responses are free on Github, so they don't
+    count against the quota.
+
+    'budgets' optionally maps route names to how many requests that route
+    may make per installation per hour. Once a route is over budget, its
+    requests either fail with BudgetExceeded ("reject"), or wait for the next
+    hour ("defer"). Waiting ties up whatever the caller is holding, like a
+    webhook delivery's admission slot, for up to an hour, so it's only for
+    routes that don't run in response to deliveries.
+
+    """
+
+    budgets = attr.ib(factory=dict)
+    action = attr.ib(default="reject")
+    window = attr.ib(default=ROUTE_BUDGET_WINDOW)
+    # Keyed by (rate limit key, route)
+    _usage = attr.ib(factory=lambda: defaultdict(_RouteUsage))
+
+    def __attrs_post_init__(self):
+        if self.action not in ("defer", "reject"):
+            raise ValueError(
+                f"route budget action must be 'defer' or 'reject', not "
+                f"{self.action!r}"
+            )
+
+    def _roll_window(self, usage, now):
+        if (
+            usage.window_start is None
+            or now - usage.window_start >= self.window
+        ):
+            usage.window_start = now
+            usage.window_spent = 0
+
+    async def acquire(self, key, route):
+        usage = self._usage[key, route]
+        budget = self.budgets.get(route)
+        deferred = False
+        while True:
+            now = await anyio.current_time()
+            self._roll_window(usage, now)
+            if budget is None or usage.window_spent < budget:
+                break
+            retry_after = usage.window_start + self.window - now
+            if self.action == "reject":
+                usage.rejected += 1
+                GITHUB_ROUTE_REQUESTS.inc(route, "rejected")
+                raise BudgetExceeded(
+                    route, "app" if key is None else key, retry_after
+                )
+            if not deferred:
+                usage.deferred += 1
+                GITHUB_ROUTE_REQUESTS.inc(route, "deferred")
+                deferred = True
+            await anyio.sleep(retry_after)
+        usage.window_spent += 1
+        usage.spent += 1
+        usage.sent += 1
+        GITHUB_ROUTE_REQUESTS.inc(route, "sent")
+
+    def refund(self, key, route):
+        usage = self._usage[key, route]
+        usage.window_spent = max(0, usage.window_spent - 1)
+        usage.spent -= 1
+        usage.not_modified += 1
+        GITHUB_ROUTE_REQUESTS.inc(route, "not_modified")
+
+    async def report(self, top=10):
+        """The 'top' routes for each installation, biggest spenders (in the
+        current hour) first.
+
+        """
+        now = await anyio.current_time()
+        by_key = defaultdict(list)
+        for (key, route), usage in self._usage.items():
+            self._roll_window(usage, now)
+            by_key["app" if key is None else str(key)].append(
+                {
+                    "route": route,
+                    "spent_this_hour": usage.window_spent,
+                    "budget": self.budgets.get(route),
+                    "spent": usage.spent,
+                    "sent": usage.sent,
+                    "not_modified": usage.not_modified,
+                    "deferred": usage.deferred,
+                    "rejected": usage.rejected,
+                }
+            )
+        return {
+            key: sorted(
+                routes,
+                key=lambda r: (
+                    -r["spent_this_hour"],
+                    -r["spent"],
+                    r["route"],
+                ),
+            )[:top]
+            for (key, routes) in by_key.items()
+        }
+
+    def stats(self):
+        totals = {"sent": 0, "not_modified": 0, "deferred": 0, "rejected": 0}
+        for usage in self._usage.values():
+            for field in totals:
+                totals[field] += getattr(usage, field)
+        return {
+            "routes": len({route for (_, route) in self._usage}),
+            **totals,
+        }
+
+
+@attr.s
+class _Occupancy:
+    limit = attr.ib()
+    # Created on first use, since anyio needs to know which async library
+    # we're running under
+    _limiter = attr.ib(default=None)
+    in_flight = attr.ib(default=0)
+    waiting = attr.ib(default=0)
+
+    @asynccontextmanager
+    async def hold(self):
+        if self.limit is None:
+            self.in_flight += 1
+            try:
+                yield
+            finally:
+                self.in_flight -= 1
+            return
+        if self._limiter is None:
+            self._limiter = anyio.create_capacity_limiter(self.limit)
+        self.waiting += 1
+        try:
+            await self._limiter.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            await self._limiter.release()
+
+    def stats(self):
+        return {"in_flight": self.in_flight, "waiting": self.waiting}
+
+
+@attr.s
+class AdmissionController:
+    """Limits how many webhook deliveries we take on at once.
+
+    At most max_in_flight deliveries have their handlers running at a time,
+    and at most max_waiting more can be admitted and wait their turn (this
+    includes deliveries that are waiting out their dispatch delay). After
+    that, we shed new deliveries by raising Overloaded. None means no limit.
+
+    Individual handlers can also have their own concurrency limits; see the
+    max_concurrency= argument to route_webhook/route_command.
+
+    """
+
+    max_in_flight = attr.ib(default=None)
+    max_waiting = attr.ib(default=None)
+    retry_after = attr.ib(default=30)
+    # Deliveries we've accepted whose handlers haven't finished
+    admitted = attr.ib(default=0)
+    shed = attr.ib(default=0)
+    _deliveries = attr.ib(default=None)
+    _handlers = attr.ib(factory=dict)
+
+    def __attrs_post_init__(self):
+        self._deliveries = _Occupancy(self.max_in_flight)
+
+    def admit(self):
+        if self.max_in_flight is not None and self.max_waiting is not None:
+            if self.admitted >= self.max_in_flight + self.max_waiting:
+                self.shed += 1
+                raise Overloaded(self.retry_after)
+        self.admitted += 1
+
+    def release(self):
+        self.admitted -= 1
+
+    def delivery_slot(self):
+        return self._deliveries.hold()
+
+    def handler_slot(self, async_fn, limit):
+        if async_fn not in self._handlers:
+            self._handlers[async_fn] = _Occupancy(limit)
+        return self._handlers[async_fn].hold()
+
+    def stats(self):
+        return {
+            "admitted": self.admitted,
+            "shed": self.shed,
+            **self._deliveries.stats(),
+            "handlers": {
+                _handler_name(async_fn): occupancy.stats()
+                for (async_fn, occupancy) in self._handlers.items()
+            },
+        }
+
+
+def _leaf_exceptions(exc):
+    if isinstance(exc, anyio.exceptions.ExceptionGroup):
+        for child in exc.exceptions:
+            yield from _leaf_exceptions(child)
+    else:
+        yield exc
+
+
+def _handler_name(async_fn):
+    return f"{async_fn.__module__}.{async_fn.__qualname__}"
 
 
 @attr.s(frozen=True)
@@ -232,6 +2093,34 @@ class WebhookRoute:
     restrictions = attr.ib()
     async_fn = attr.ib()
 
+    # Returns (action, matchers), where action is the required value of the
+    # payload's "action" field (or _MISSING if any action is OK), and
+    # matchers is a tuple of (path, value) pairs for all the other
+    # restrictions, with paths pre-split on dots.
+    def compile(self):
+        action = _MISSING
+        matchers = []
+        for key, value in self.restrictions.items():
+            if key == "action":
+                action = value
+            else:
+                matchers.append((tuple(key.split(".")), value))
+        return action, tuple(matchers)
+
+
+@attr.s(frozen=True)
+class _CompiledRoute:
+    seq = attr.ib()
+    matchers = attr.ib()
+    async_fn = attr.ib()
+
+    def matches(self, payload):
+        for path, value in self.matchers:
+            found = _lookup_path(payload, path)
+            if found is _MISSING or found != value:
+                return False
+        return True
+
 
 # List of webhooks that can carry /-commands. Not included currently:
 # - edits/deletions
@@ -244,43 +2133,146 @@ _COMMENT_EVENTS = {
     ("pull_request_review", "submitted"),
     ("pull_request_review_comment", "created"),
 }
+_COMMENT_EVENT_TYPES = {event_type for (event_type, _) in _COMMENT_EVENTS}
 
 
 @attr.s
 class GithubRoutes:
     _webhook_routes = attr.ib(factory=lambda: defaultdict(list))
     _command_routes = attr.ib(factory=dict)
+    # Maps handler function -> max number of simultaneous calls
+    _concurrency_limits = attr.ib(factory=dict)
+    # Lazily built from _webhook_routes, and thrown away whenever they
+    # change. Maps (event_type, action) -> list of _CompiledRoute, where
+    # action can be _MISSING for "any action".
+    _index = attr.ib(default=None)
+
+    def add_webhook(
+        self, async_fn, event_type, *, max_concurrency=None, **restrictions
+    ):
+        """Add a webhook handler.
 
-    def add_webhook(self, async_fn, event_type, **restrictions):
-        if len(restrictions) > 1:
-            raise TypeError("At most one restriction is allowed (for now)")
+        Restrictions are checked against the payload. Keys can be dotted
+        paths, to check nested fields:
+
+          routes.add_webhook(
+              handler, "pull_request", action="closed",
+              **{"pull_request.merged": True},
+          )
+
+        If max_concurrency is given, then at most that many calls to
+        async_fn will run at once; the rest wait their turn. The limit
+        applies to the handler function, across all of its routes.
+
+        """
+        self._set_concurrency_limit(async_fn, max_concurrency)
         self._webhook_routes[event_type].append(
             WebhookRoute(restrictions, async_fn)
         )
+        self._index = None
+
+    def _set_concurrency_limit(self, async_fn, max_concurrency):
+        if max_concurrency is None:
+            return
+        existing = self._concurrency_limits.setdefault(
+            async_fn, max_concurrency
+        )
+        if existing != max_concurrency:
+            raise ValueError(
+                f"{async_fn!r} already has max_concurrency={existing}"
+            )
+
+    def _get_index(self):
+        if self._index is None:
+            self._index = self._build_index()
+        return self._index
+
+    def _build_index(self):
+        by_event = defaultdict(lambda: defaultdict(list))
+        seq = itertools.count()
+        for event_type, routes in self._webhook_routes.items():
+            for route in routes:
+                action, matchers = route.compile()
+                by_event[event_type][action].append(
+                    _CompiledRoute(next(seq), matchers, route.async_fn)
+                )
+        index = {}
+        for event_type, by_action in by_event.items():
+            any_action = by_action.get(_MISSING, [])
+            index[event_type, _MISSING] = any_action
+            for action, routes in by_action.items():
+                if action is not _MISSING:
+                    # Keep the routes in the order they were added
+                    index[event_type, action] = sorted(
+                        routes + any_action, key=lambda route: route.seq
+                    )
+        return index
+
+    def webhook_handlers(self, event_type, payload):
+        """Returns a list of the async functions that should handle this
+        webhook.
+
+        """
+        index = self._get_index()
+        action = payload.get("action", _MISSING)
+        try:
+            candidates = index[event_type, action]
+        except (KeyError, TypeError):
+            # No routes for this specific action (or the action is something
+            # weird and unhashable, so it can't match one anyway)
+            candidates = index.get((event_type, _MISSING), ())
+        return [
+            route.async_fn for route in candidates if route.matches(payload)
+        ]
+
+    def wants_event_type(self, event_type):
+        """Returns False if no handler could possibly care about this type of
+        event, so there's no point in even looking at the payload.
+
+        """
+        # Every event type with any routes has an entry for "any action"
+        if (event_type, _MISSING) in self._get_index():
+            return True
+        return bool(self._command_routes) and (
+            event_type in _COMMENT_EVENT_TYPES
+        )
 
-    def route_webhook(self, event_type, **restrictions):
+    def route_webhook(
+        self, event_type, *, max_concurrency=None, **restrictions
+    ):
         def decorator(async_fn):
-            self.add_webhook(async_fn, event_type, **restrictions)
+            self.add_webhook(
+                async_fn,
+                event_type,
+                max_concurrency=max_concurrency,
+                **restrictions,
+            )
             return async_fn
 
         return decorator
 
-    def add_command(self, async_fn, command_name):
+    def add_command(self, async_fn, command_name, *, max_concurrency=None):
         if not command_name.startswith("/"):
             command_name = "/" + command_name
         assert command_name not in self._command_routes
+        self._set_concurrency_limit(async_fn, max_concurrency)
         self._command_routes[command_name] = async_fn
 
-    def route_command(self, command_name):
+    def route_command(self, command_name, *, max_concurrency=None):
         def decorator(async_fn):
-            self.add_command(async_fn, command_name)
+            self.add_command(
+                async_fn, command_name, max_concurrency=max_concurrency
+            )
             return async_fn
 
         return decorator
 
     def update(self, other_table):
+        for async_fn, limit in other_table._concurrency_limits.items():
+            self._set_concurrency_limit(async_fn, limit)
         for event_type, handlers in other_table._webhook_routes.items():
             self._webhook_routes[event_type] += handlers
+        self._index = None
         for command, handler in other_table._command_routes.items():
             self.add_command(handler, command)
 
@@ -295,7 +2287,31 @@ class GithubApp:
         private_key=None,
         webhook_secret=None,
         # XX Completely untuned; maybe this is too big, or too small.
-        cache_size=500,
+        cache_max_bytes=50 * 2 ** 20,
+        response_cache_backend=None,
+        dispatch_delays=None,
+        dedup_cache_size=10000,
+        delivery_dedup_backend=None,
+        delivery_dedup_forget=None,
+        command_scanner=False,
+        max_in_flight=None,
+        max_waiting=None,
+        overload_retry_after=30,
+        token_store=None,
+        installation_cache_size=1000,
+        installation_cache_ttl=60 * 60,
+        client_pool_size=1000,
+        client_idle_ttl=10 * 60,
+        rate_limit_reserve=100,
+        max_concurrent_requests=10,
+        graphql_batch_window=GRAPHQL_BATCH_WINDOW,
+        graphql_max_batch=GRAPHQL_MAX_BATCH,
+        request_timeout=REQUEST_TIMEOUT,
+        request_retries=REQUEST_RETRIES,
+        hedge_requests=False,
+        webhook_archive=None,
+        route_budgets=None,
+        route_budget_action="reject",
     ):
         if session is None:
             # We don't really need to limit simultaneous connections... we're
@@ -307,8 +2323,81 @@ class GithubApp:
         self._private_key = private_key
         self._webhook_secret = webhook_secret
         self._installation_tokens = defaultdict(CachedInstallationToken)
-        self._cache = cachetools.LRUCache(cache_size)
+        self._jwt = None
+        self._jwt_expires_at = None
+        # Created lazily, because anyio needs to know what async library
+        # we're using.
+        self._jwt_lock = None
+        self._jwt_stats = {"signed": 0, "reused": 0}
+        # Optional place to share installation tokens with other processes.
+        # It should have these async methods:
+        #   load(installation_id) -> (token, expires_at) or None
+        #   try_lease(installation_id, lease_seconds) -> bool
+        #   save(installation_id, token, expires_at)  [also drops the lease]
+        #   release(installation_id)
+        # See snekomatic.token_store for one backed by Postgres.
+        self.token_store = token_store
+        # Optional place to record incoming deliveries, for replaying later.
+        # It should have a (synchronous) method, which runs while Github
+        # waits for our response, so it shouldn't block:
+        #   record(headers, body)
+        # See snekomatic.webhook_archive for one that writes to a file.
+        self.webhook_archive = webhook_archive
+        self._token_stats = {
+            "minted": 0,
+            "from_store": 0,
+            # Renewals that a caller of token_for had to wait for
+            "on_demand_refreshes": 0,
+            "background_refreshes": 0,
+            "background_failures": 0,
+            "last_refresh_seconds": None,
+            "max_refresh_seconds": 0,
+        }
+        self.response_cache = ResponseCache(
+            cache_max_bytes, response_cache_backend
+        )
+        self._coalescer = RequestCoalescer()
+        self._retry_policy = RetryPolicy(
+            request_timeout, request_retries, hedge=hedge_requests
+        )
+        self._graphql_batcher = GraphQLBatcher(
+            graphql_batch_window, graphql_max_batch
+        )
+        self._rate_limits = RateLimitScheduler(
+            rate_limit_reserve, max_concurrent_requests
+        )
+        self.route_quotas = RouteQuotas(
+            dict(route_budgets or {}), route_budget_action
+        )
         self._routes = GithubRoutes()
+        self.dispatch_delays = dict(DEFAULT_DISPATCH_DELAYS)
+        if dispatch_delays is not None:
+            self.dispatch_delays.update(dispatch_delays)
+        self._scheduler = DispatchScheduler()
+        self._deduplicator = DeliveryDeduplicator(
+            cachetools.LRUCache(dedup_cache_size),
+            delivery_dedup_backend,
+            delivery_dedup_forget,
+        )
+        # Use _scan_commands instead of a full markdown parse to find
+        # commands in comments.
+        self.command_scanner = command_scanner
+        self._admission = AdmissionController(
+            max_in_flight, max_waiting, overload_retry_after
+        )
+        self._installation_cache = InstallationCache(
+            cachetools.TTLCache(
+                installation_cache_size, installation_cache_ttl
+            ),
+            cachetools.TTLCache(
+                installation_cache_size, installation_cache_ttl
+            ),
+        )
+        self._client_pool = ClientPool(
+            cachetools.TTLCache(client_pool_size, client_idle_ttl)
+        )
+        for event_type in ["installation", "installation_repositories"]:
+            self._routes.add_webhook(self._installation_changed, event_type)
 
     user_agent = _lazy_env_fallback("user_agent")
     app_id = _lazy_env_fallback("app_id")
@@ -320,23 +2409,127 @@ class GithubApp:
         return AppGithubClient(self)
 
     async def installation_id_for_repo(self, repo):
-        result = await self.app_client.getitem(
-            "/repos/{+repo}/installation",
-            url_vars={"repo": repo},
-            accept=accept_format(version="machine-man-preview"),
-        )
-        return glom(result, "id")
+        installation_id = self._installation_cache.installation_for_repo(repo)
+        if installation_id is None:
+            generation = self._installation_cache.generation
+            result = await self.app_client.getitem(
+                "/repos/{+repo}/installation",
+                url_vars={"repo": repo},
+                accept=accept_format(version="machine-man-preview"),
+            )
+            installation_id = glom(result, "id")
+            self._installation_cache.remember_repo(
+                generation, repo, installation_id
+            )
+        return installation_id
 
-    def client_for_installation_id(self, installation_id):
-        return InstallationGithubClient(self, installation_id)
+    async def repos_for_installation(self, installation_id):
+        """Returns a list of the full names of an installation's repos."""
+        repos = self._installation_cache.repos_for_installation(
+            installation_id
+        )
+        if repos is None:
+            generation = self._installation_cache.generation
+            client = self.client_for_installation_id(installation_id)
+            # Can't use getiter, because this endpoint wraps each page in a
+            # dict.
+            repos = []
+            url = "/installation/repositories?per_page=100"
+            while url:
+                data, url = await client._make_request(
+                    "GET",
+                    url,
+                    {},
+                    b"",
+                    accept_format(version="machine-man-preview"),
+                )
+                repos += [repo["full_name"] for repo in data["repositories"]]
+            self._installation_cache.remember_installation(
+                generation, installation_id, repos
+            )
+        return list(repos)
+
+    async def _installation_changed(self, event_type, payload, client):
+        repos = [
+            repo["full_name"]
+            for key in [
+                "repositories",
+                "repositories_added",
+                "repositories_removed",
+            ]
+            for repo in payload.get(key) or []
+        ]
+        print(
+            f"Installation {payload['installation']['id']} changed "
+            f"({event_type}.{payload.get('action')}); forgetting its repos"
+        )
+        self._installation_cache.invalidate(
+            payload["installation"]["id"], repos
+        )
+        if (
+            event_type == "installation"
+            and payload.get("action") == "deleted"
+        ):
+            self._client_pool.discard(payload["installation"]["id"])
+
+    def client_for_installation_id(
+        self, installation_id, *, priority=PRIORITY_NORMAL, route=None
+    ):
+        return self._client_pool.get(
+            (installation_id, priority, route),
+            lambda: InstallationGithubClient(
+                self, installation_id, priority=priority, route=route
+            ),
+        )
 
-    async def client_for_repo(self, repo):
+    async def client_for_repo(
+        self, repo, *, priority=PRIORITY_NORMAL, route=None
+    ):
         installation_id = await self.installation_id_for_repo(repo)
-        return self.client_for_installation_id(installation_id)
+        return self.client_for_installation_id(
+            installation_id, priority=priority, route=route
+        )
+
+    async def app_jwt(self):
+        """Returns a JWT for authenticating as the app itself.
+
+        The same JWT is reused until it's about to expire. Signing a new one
+        happens in a worker thread, so it doesn't stall the event loop.
+
+        """
+        if self._jwt is not None and not _too_close_for_comfort(
+            self._jwt_expires_at
+        ):
+            self._jwt_stats["reused"] += 1
+            return self._jwt
+        if self._jwt_lock is None:
+            self._jwt_lock = anyio.create_lock()
+        async with self._jwt_lock:
+            # Someone else might have signed a new one while we were waiting
+            # for the lock.
+            if self._jwt is None or _too_close_for_comfort(
+                self._jwt_expires_at
+            ):
+                now = pendulum.now()
+                expires_at = now + APP_JWT_LIFETIME - MAX_CLOCK_SKEW
+                claims = {
+                    "iat": (now - MAX_CLOCK_SKEW).int_timestamp,
+                    "exp": expires_at.int_timestamp,
+                    "iss": self.app_id,
+                }
+                self._jwt = await anyio.run_in_thread(
+                    _sign_app_jwt, claims, self.private_key
+                )
+                self._jwt_expires_at = expires_at
+                self._jwt_stats["signed"] += 1
+            else:
+                self._jwt_stats["reused"] += 1
+            return self._jwt
 
     async def token_for(self, installation_id):
         installation_id = int(installation_id)
         cit = self._installation_tokens[installation_id]
+        cit.last_used = pendulum.now()
 
         while _too_close_for_comfort(cit.expires_at):
             print(
@@ -349,26 +2542,74 @@ class GithubApp:
                 await cit.refresh_event.wait()
             else:
                 print(f"{installation_id}: Renewing now")
-                cit.refresh_event = anyio.create_event()
-                try:
-                    response = await self.app_client.post(
-                        "/app/installations/{installation_id}/access_tokens",
-                        url_vars={"installation_id": installation_id},
-                        accept=accept_format(version="machine-man-preview"),
-                        data={},
-                    )
-                    cit.token = response["token"]
-                    cit.expires_at = pendulum.parse(response["expires_at"])
-                    assert not _too_close_for_comfort(cit.expires_at)
-                    print(f"{installation_id}: Renewed successfully")
-                finally:
-                    # Make sure that even if we get cancelled, any other tasks
-                    # will still wake up (and can retry the operation)
-                    await cit.refresh_event.set()
-                    cit.refresh_event = None
+                self._token_stats["on_demand_refreshes"] += 1
+                GITHUB_TOKEN_REFRESHES.inc("on_demand")
+                await self._refresh_cached_token(installation_id, cit)
 
         return cit.token
 
+    async def _refresh_cached_token(self, installation_id, cit):
+        assert cit.refresh_event is None
+        cit.refresh_event = anyio.create_event()
+        try:
+            with tracing.span(
+                "github.token_refresh", installation_id=installation_id
+            ):
+                cit.token, cit.expires_at = await self._renew_token(
+                    installation_id, newer_than=cit.expires_at
+                )
+            assert not _too_close_for_comfort(cit.expires_at)
+            cit.refresh_at = _refresh_due_at(cit.expires_at)
+            print(f"{installation_id}: Renewed successfully")
+        finally:
+            # Make sure that even if we get cancelled, any other tasks
+            # will still wake up (and can retry the operation)
+            await cit.refresh_event.set()
+            cit.refresh_event = None
+
+    async def _renew_token(self, installation_id, *, newer_than):
+        if self.token_store is None:
+            return await self._mint_token(installation_id)
+        while True:
+            stored = await self.token_store.load(installation_id)
+            # If the stored token isn't newer than the one we have, then it's
+            # the one we're trying to replace.
+            if (
+                stored is not None
+                and stored[1] > newer_than
+                and not _too_close_for_comfort(stored[1])
+            ):
+                print(f"{installation_id}: Using token from the token store")
+                self._token_stats["from_store"] += 1
+                GITHUB_TOKENS.inc("store")
+                return stored
+            if await self.token_store.try_lease(
+                installation_id, TOKEN_LEASE_SECONDS
+            ):
+                break
+            print(f"{installation_id}: Another process is renewing; waiting")
+            await anyio.sleep(TOKEN_LEASE_POLL_INTERVAL)
+        try:
+            token, expires_at = await self._mint_token(installation_id)
+            await self.token_store.save(installation_id, token, expires_at)
+        except BaseException:
+            # Let someone else have a try
+            async with anyio.open_cancel_scope(shield=True):
+                await self.token_store.release(installation_id)
+            raise
+        return token, expires_at
+
+    async def _mint_token(self, installation_id):
+        response = await self.app_client.post(
+            "/app/installations/{installation_id}/access_tokens",
+            url_vars={"installation_id": installation_id},
+            accept=accept_format(version="machine-man-preview"),
+            data={},
+        )
+        self._token_stats["minted"] += 1
+        GITHUB_TOKENS.inc("minted")
+        return response["token"], pendulum.parse(response["expires_at"])
+
     def add_webhook(self, *args, **kwargs):
         return self._routes.add_webhook(*args, **kwargs)
 
@@ -384,37 +2625,365 @@ class GithubApp:
     def add_routes(self, routing_table):
         self._routes.update(routing_table)
 
+    def verify_webhook(self, headers, body):
+        """Check the webhook's signature.
+
+        Returns a gidgethub Event, or raises gidgethub.ValidationFailure if
+        the signature doesn't check out. This is useful if you want to stash
+        the delivery somewhere and dispatch it later. The payload isn't
+        decoded until you look at the Event's .data.
+
+        """
+        if "x-hub-signature" not in headers:
+            raise gidgethub.ValidationFailure("signature is missing")
+        validate_event(
+            body,
+            signature=headers["x-hub-signature"],
+            secret=self.webhook_secret,
+        )
+        return _LazyEvent(headers, body)
+
+    def wants_event_type(self, event_type):
+        return self._routes.wants_event_type(event_type)
+
+    def dispatch_delay(self, event_type, action):
+        for key in [f"{event_type}.{action}", event_type]:
+            if key in self.dispatch_delays:
+                return self.dispatch_delays[key]
+        return DEFAULT_DISPATCH_DELAY
+
+    async def run_dispatch_scheduler(
+        self, *, task_status=TASK_STATUS_IGNORED
+    ):
+        """Run the delayed-dispatch scheduler.
+
+        While this is running, dispatch_webhook returns as soon as the
+        delivery is verified, and handlers are run in this task's task group
+        once the delivery's delay (see dispatch_delays) has elapsed. If it
+        isn't running, dispatch_webhook waits out the delay and runs the
+        handlers itself.
+
+        """
+        await self._scheduler.run(
+            self._dispatch_scheduled_event, task_status=task_status
+        )
+
+    async def run_token_refresher(
+        self,
+        *,
+        interval=TOKEN_REFRESH_INTERVAL,
+        task_status=TASK_STATUS_IGNORED,
+    ):
+        """Keep tokens for recently-used installations fresh.
+
+        Every *interval* seconds, renews any token that will expire soon and
+        that token_for has handed out recently (see TOKEN_REFRESH_AHEAD and
+        TOKEN_REFRESH_ACTIVE_WINDOW), up to TOKEN_REFRESH_CONCURRENCY at a
+        time. Failures, including renewals that take longer than
+        TOKEN_REFRESH_TIMEOUT, are logged and retried on the next pass; in
+        the meantime token_for still renews on demand.
+
+        """
+        task_status.started()
+        while True:
+            await self._refresh_due_tokens()
+            await anyio.sleep(interval)
+
+    async def _refresh_due_tokens(self):
+        now = pendulum.now()
+        due = []
+        for installation_id, cit in list(self._installation_tokens.items()):
+            if cit.refresh_event is not None or cit.last_used is None:
+                continue
+            if now - cit.last_used > TOKEN_REFRESH_ACTIVE_WINDOW:
+                continue
+            if cit.refresh_at is None or now < cit.refresh_at:
+                continue
+            due.append((installation_id, cit))
+        limiter = anyio.create_capacity_limiter(TOKEN_REFRESH_CONCURRENCY)
+        async with anyio.create_task_group() as tg:
+            for installation_id, cit in due:
+                await tg.spawn(
+                    self._refresh_token_in_background,
+                    limiter,
+                    installation_id,
+                    cit,
+                )
+
+    async def _refresh_token_in_background(
+        self, limiter, installation_id, cit
+    ):
+        await limiter.acquire()
+        try:
+            # token_for might have got to it while we were waiting
+            if cit.refresh_event is not None:
+                return
+            print(f"{installation_id}: Refreshing token in the background")
+            GITHUB_TOKEN_REFRESHES.inc("background")
+            start = await anyio.current_time()
+            try:
+                async with anyio.move_on_after(
+                    TOKEN_REFRESH_TIMEOUT
+                ) as scope:
+                    await self._refresh_cached_token(installation_id, cit)
+                if scope.cancel_called:
+                    raise TimeoutError(
+                        f"no token after {TOKEN_REFRESH_TIMEOUT} seconds"
+                    )
+            except Exception as exc:
+                self._token_stats["background_failures"] += 1
+                print(
+                    f"{installation_id}: Background refresh failed: {exc!r}"
+                )
+                return
+            elapsed = await anyio.current_time() - start
+            self._token_stats["background_refreshes"] += 1
+            self._token_stats["last_refresh_seconds"] = elapsed
+            self._token_stats["max_refresh_seconds"] = max(
+                self._token_stats["max_refresh_seconds"], elapsed
+            )
+        finally:
+            await limiter.release()
+
+    async def stats(self):
+        return {
+            "scheduler": await self._scheduler.stats(),
+            "dedup": self._deduplicator.stats(),
+            "admission": self._admission.stats(),
+            "tokens": dict(self._token_stats),
+            "app_jwt": dict(self._jwt_stats),
+            "installations": self._installation_cache.stats(),
+            "response_cache": self.response_cache.stats(),
+            "rate_limits": await self._rate_limits.stats(),
+            "coalescing": self._coalescer.stats(),
+            "graphql": self._graphql_batcher.stats(),
+            "requests": self._retry_policy.stats(),
+            "routes": self.route_quotas.stats(),
+            "clients": self._client_pool.stats(),
+        }
+
+    async def quota_report(self, top=10):
+        """Per installation: its remaining Github API quota, and which routes
+        have been spending it.
+
+        """
+        rate_limits = (await self._rate_limits.stats())["installations"]
+        report = {}
+        for key, routes in (await self.route_quotas.report(top)).items():
+            quota = rate_limits.get(key, {})
+            report[key] = {
+                "remaining": quota.get("remaining"),
+                "limit": quota.get("limit"),
+                "resets_in": quota.get("resets_in"),
+                "top_routes": routes,
+            }
+        return report
+
+    async def is_duplicate_delivery(self, event):
+        """Returns True if we've already seen this delivery.
+
+        Otherwise, remembers it and returns False. dispatch_webhook calls
+        this for you; you only need it if you're stashing deliveries away to
+        dispatch with dispatch_webhook_inline later.
+
+        """
+        if await self._deduplicator.is_duplicate(event.delivery_id):
+            print(f"Delivery {event.delivery_id} is a duplicate; dropping it")
+            return True
+        return False
+
+    async def forget_delivery(self, delivery_id):
+        """Undoes is_duplicate_delivery, for a delivery that we failed to
+        handle, so that when it's redelivered we don't drop it.
+
+        dispatch_webhook calls this for you; you only need it if you're
+        stashing deliveries away to dispatch with dispatch_webhook_inline
+        later.
+
+        """
+        # We're probably on our way out with an exception, maybe a
+        # cancellation
+        async with anyio.open_cancel_scope(shield=True):
+            await self._deduplicator.forget(delivery_id)
+
+    def archive_delivery(self, headers, body):
+        """Records a verified delivery in our webhook_archive, if we have one.
+
+        dispatch_webhook calls this for you; you only need it if you're
+        stashing deliveries away to dispatch with dispatch_webhook_inline
+        later.
+
+        """
+        if self.webhook_archive is not None:
+            self.webhook_archive.record(headers, body)
+
+    # Handlers run by the scheduler don't have anyone to report errors to, so
+    # we report them here. Override this to send them somewhere more useful.
+    def on_dispatch_error(self, exc):
+        traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+    async def _dispatch_scheduled_event(self, event):
+        # Github already got its response, but if the handlers didn't
+        # finish, someone might redeliver it by hand; so we forget that we
+        # saw it.
+        try:
+            async with self._admission.delivery_slot():
+                await self._dispatch_event(event)
+        except anyio.get_cancelled_exc_class():
+            await self.forget_delivery(event.delivery_id)
+            raise
+        except anyio.exceptions.ExceptionGroup as group:
+            await self.forget_delivery(event.delivery_id)
+            # Several handlers failed at once. Report each of them, rather
+            # than letting the group take down the scheduler.
+            for exc in _leaf_exceptions(group):
+                if not isinstance(exc, anyio.get_cancelled_exc_class()):
+                    self.on_dispatch_error(exc)
+        except Exception as exc:
+            await self.forget_delivery(event.delivery_id)
+            self.on_dispatch_error(exc)
+        finally:
+            self._admission.release()
+
     async def dispatch_webhook(self, headers, body):
-        event = Event.from_http(headers, body, secret=self.webhook_secret)
+        event = self.verify_webhook(headers, body)
         print(
             f"GH webhook received: type={event.event}, delivery id={event.delivery_id}"
         )
-        # Wait a bit to give Github's eventual consistency time to catch up
-        await anyio.sleep(1)
+        self.archive_delivery(headers, body)
+        with tracing.trace(
+            "webhook", event.delivery_id, event=event.event
+        ) as event.span:
+            if not self.wants_event_type(event.event):
+                # Most deliveries end up here, so this should be cheap: in
+                # particular, we never decode the payload.
+                print(f"No routes for {event.event} webhooks; ignoring")
+                return
+            # This has to come before the duplicate check: if we shed the
+            # delivery, then Github's redelivery shouldn't count as a
+            # duplicate.
+            self._admission.admit()
+            admitted = True
+            try:
+                if await self.is_duplicate_delivery(event):
+                    return
+                try:
+                    delay = self.dispatch_delay(
+                        event.event, event.data.get("action")
+                    )
+                    if self._scheduler.running:
+                        await self._scheduler.submit(delay, event)
+                        # Now it's the scheduler's job to release it
+                        admitted = False
+                    else:
+                        # Wait a bit to give Github's eventual consistency
+                        # time to catch up
+                        await anyio.sleep(delay)
+                        async with self._admission.delivery_slot():
+                            await self._dispatch_event(event)
+                except BaseException:
+                    # Github will redeliver it, and we want that to go
+                    # through
+                    await self.forget_delivery(event.delivery_id)
+                    raise
+            finally:
+                if admitted:
+                    self._admission.release()
+
+    async def dispatch_webhook_inline(self, headers, body, *, age=0):
+        """Dispatch a webhook in the calling task, even if the scheduler is
+        running, and wait for all the handlers to finish.
+
+        'age' is how many seconds ago the delivery arrived; we only wait for
+        whatever part of the delay hasn't already elapsed. This doesn't check
+        for duplicate deliveries; see is_duplicate_delivery.
+
+        """
+        event = self.verify_webhook(headers, body)
+        print(
+            f"GH webhook dispatching: type={event.event}, delivery id={event.delivery_id}"
+        )
+        if not self.wants_event_type(event.event):
+            print(f"No routes for {event.event} webhooks; ignoring")
+            return
+        with tracing.trace(
+            "webhook", event.delivery_id, event=event.event, age=age
+        ) as event.span:
+            delay = self.dispatch_delay(event.event, event.data.get("action"))
+            if delay > age:
+                await anyio.sleep(delay - age)
+            async with self._admission.delivery_slot():
+                await self._dispatch_event(event)
+
+    async def _run_handler(self, event_type, async_fn, *args):
+        limit = self._routes._concurrency_limits.get(async_fn)
+        async with self._admission.handler_slot(async_fn, limit):
+            outcome = "cancelled"
+            name = _handler_name(async_fn)
+            start = await anyio.current_time()
+            route_token = _current_route.set(name)
+            try:
+                with tracing.span("handler", handler=name, event=event_type):
+                    await async_fn(*args)
+                outcome = "ok"
+            except Exception:
+                outcome = "error"
+                raise
+            finally:
+                _current_route.reset(route_token)
+                HANDLER_DURATION.observe(
+                    await anyio.current_time() - start,
+                    event_type,
+                    name,
+                    outcome,
+                )
+
+    async def _dispatch_event(self, event):
+        # For scheduled deliveries, the delivery's span has already finished,
+        # but that's still where the handlers belong.
+        with tracing.span("dispatch", parent=event.span):
+            await self._dispatch_event_traced(event)
+
+    async def _dispatch_event_traced(self, event):
         installation_id = glom(event.data, "installation.id", default=None)
         if installation_id is None:
             print("No associated installation; not dispatching")
             return
         client = self.client_for_installation_id(installation_id)
+        # Someone's waiting for the bot to reply to their command, so those
+        # get to jump the queue.
+        command_client = self.client_for_installation_id(
+            installation_id, priority=PRIORITY_INTERACTIVE
+        )
         # XX FIXME: do something cleverer about errors in handlers (e.g. don't
         # let one of them crashing cancel the others)
         async with anyio.create_task_group() as tg:
-            for route in self._routes._webhook_routes[event.event]:
-                if _all_match(event.data, route.restrictions):
-                    print(f"Routing to {route.async_fn!r}")
-                    await tg.spawn(
-                        route.async_fn, event.event, event.data, client
-                    )
+            for async_fn in self._routes.webhook_handlers(
+                event.event, event.data
+            ):
+                print(f"Routing to {async_fn!r}")
+                await tg.spawn(
+                    self._run_handler,
+                    event.event,
+                    async_fn,
+                    event.event,
+                    event.data,
+                    client,
+                )
             if (event.event, event.data.get("action")) in _COMMENT_EVENTS:
                 body = get_comment_body(event.event, event.data)
-                for command in parse_commands(body):
+                for command in parse_commands(
+                    body, scanner=self.command_scanner
+                ):
                     if command[0] in self._routes._command_routes:
                         await tg.spawn(
+                            self._run_handler,
+                            event.event,
                             self._routes._command_routes[command[0]],
                             command,
                             event.event,
                             event.data,
-                            client,
+                            command_client,
                         )
                     else:
                         # We silently ignore unrecognized commands, because lines
@@ -486,13 +3055,56 @@ def reaction_url(event_type, payload):
         raise ValueError(f"unknown event_type: {event_type!r}")
 
 
+# A command has to be on its own line, so if there's no '/' that's preceded
+# only by whitespace since the start of a line, there's no point in parsing
+# the markdown. (Or by a GFM task-list checkbox, which marko strips off the
+# front of any paragraph.) This errs on the side of matching: the set of
+# characters that count as line breaks is a superset of what marko uses.
+_COMMAND_CANDIDATE_RE = re.compile(
+    r"(?:\A|[\r\n\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029])"
+    r"\s*(?:\[[\sxX]\]\s*)?/"
+)
+
+# Bodies get parsed repeatedly: edits, redeliveries, bot-generated templates,
+# etc. Maps a hash of the body -> tuple of commands (each a tuple of words).
+_PARSED_COMMANDS_CACHE = cachetools.LRUCache(1000)
+
+
+def parse_commands(body_text, *, scanner=False):
+    """Yields each /-command in the comment body, as a list of words.
+
+    If scanner=True, uses a dedicated line scanner instead of a full markdown
+    parse. They should give the same results.
+
+    """
+    # This is effectively a memchr, so it's very cheap, and most comments
+    # don't contain a '/' at all.
+    if "/" not in body_text:
+        return
+    if _COMMAND_CANDIDATE_RE.search(body_text) is None:
+        return
+    key = hashlib.blake2b(
+        body_text.encode("utf-8", "surrogatepass"), digest_size=16
+    ).digest()
+    commands = _PARSED_COMMANDS_CACHE.get(key)
+    if commands is None:
+        if scanner:
+            parse = _scan_commands
+        else:
+            parse = _parse_commands_markdown
+        commands = tuple(tuple(command) for command in parse(body_text))
+        _PARSED_COMMANDS_CACHE[key] = commands
+    for command in commands:
+        yield list(command)
+
+
 # We use marko to parse the body as markdown, and then when scanning for
 # commands we only look at top-level paragraphs, plain text, rendered as
 # standalone lines.
 #
 # For a quick overview of how marko's AST represents some markdown, run:
 #   marko.ast_renderer.ASTRenderer().render(gfm.parse("..."))
-def parse_commands(body_text):
+def _parse_commands_markdown(body_text):
     ast = gfm.parse(body_text)
     for para in ast.children:
         # This makes us ignore commands inside blockquotes, lists, code
@@ -524,3 +3136,205 @@ def parse_commands(body_text):
                 line = child.children.strip()
                 if line.startswith("/"):
                     yield line.split()
+
+
+# The markdown parse is by far the most expensive part of handling a comment,
+# and it's mostly wasted: we only care about top-level paragraphs. So
+# _scan_commands walks the body line-by-line instead, tracking just enough
+# block structure to find places where it's safe to cut the body into
+# independent pieces:
+#
+# - A non-indented line after a blank line always starts a fresh top-level
+#   block, *unless* we're inside a top-level fenced code block or one of the
+#   HTML blocks that only ends at a specific marker (like <!-- ... -->). So we
+#   track those.
+# - But to know whether a fence/HTML line is at the top level, we have to know
+#   whether it's inside a list item or blockquote. We don't track those in
+#   detail. A line with no indentation is never inside one (fences and HTML
+#   blocks can't be lazy continuation lines), and an indented line is only
+#   inside one if there's been a list marker or '>' since the last cut.
+# - HTML blocks that end at a blank line (<div>, <span>, ...) and tables can
+#   swallow lines that would otherwise open a fence, and telling them apart
+#   from plain paragraphs is fiddly, so we don't try.
+#
+# Whenever we aren't sure, we stop cutting, and the rest of the body becomes
+# one big piece. Then each piece that might contain a command is either a
+# single paragraph of plain text, which we can split into lines ourselves, or
+# else we hand that piece (and only that piece) to marko. So in the worst case
+# we do the same work as _parse_commands_markdown, and in the common case --
+# a huge body with a few short paragraphs that start with '/' -- we only parse
+# those paragraphs.
+#
+# The regexes here are copied from marko's block parser, so they have to stay
+# in sync with it. test_scan_commands_matches_markdown fuzzes the two against
+# each other.
+
+# Link reference definitions affect inline parsing of the whole document, and
+# these characters mean that marko and the scanner would split lines
+# differently.
+_SCAN_COMMANDS_BAIL_RE = re.compile(r"\]:|[\r\x0c\x00]")
+_FENCE_OPEN_RE = re.compile(r"( {,3})(`{3,}|~{3,})[^\n\S]*(.*?)$")
+_FENCE_CLOSE_RE = re.compile(r" {,3}(~+|`+)[^\n\S]*$")
+_HTML_RAW_OPEN_RE = re.compile(
+    r"(?i) {,3}<(script|pre|style|textarea)(?:[>\s]|$)"
+)
+# Older versions of marko end a <script> block at *any* of these end tags.
+_HTML_RAW_END_RE = re.compile(r"(?i)</(?:script|pre|style)>")
+_HTML_MARKED_BLOCKS = [
+    (re.compile(r" {,3}<!--"), re.compile(r"-->")),
+    (re.compile(r" {,3}<\?"), re.compile(r"\?>")),
+    # This also catches <![CDATA[, same as marko.
+    (re.compile(r" {,3}<!"), re.compile(r">")),
+]
+_HTML_OTHER_OPEN_RE = re.compile(r" {,3}<")
+_CONTAINER_RE = re.compile(r"\s*(?:>|(?:\d{1,9}[.)]|[*+-])(?:\s|$))")
+_COMMAND_LINE_RE = re.compile(r"\s*(?:\[[\sxX]\]\s*)?/")
+# A line that's definitely a plain paragraph line, that marko will turn into a
+# single RawText: it doesn't start with anything that could be a block marker,
+# and doesn't contain anything that could be inline markup or an autolink.
+_PLAIN_LINE_RE = re.compile(
+    r"[ \t]*[^\s#=+\-*_>~`|<\[\d\\!&:@][^\\`*_\[\]<>!&~|:@]*"
+)
+_PLAIN_FIRST_LINE_RE = re.compile(r" {,3}\S")
+_AUTOLINK_WWW_RE = re.compile(r"(?i)www\.")
+
+
+def _iter_lines(text):
+    start = 0
+    while start < len(text):
+        end = text.find("\n", start)
+        if end < 0:
+            end = len(text)
+        yield start, text[start:end]
+        start = end + 1
+
+
+@attr.s
+class _ScanChunk:
+    start = attr.ib()
+    # Does anything in this chunk (outside of fenced code/HTML) look like it
+    # might be a command?
+    has_candidate = attr.ib(default=False)
+    has_content = attr.ib(default=False)
+    seen_blank = attr.ib(default=False)
+    # While plain is True, the chunk is a single paragraph of plain text
+    # lines, and plain_commands holds the commands in it.
+    plain = attr.ib(default=True)
+    plain_commands = attr.ib(factory=list)
+
+    def commands(self, body_text, end):
+        if not self.has_candidate:
+            return []
+        if self.plain:
+            return self.plain_commands
+        return _parse_commands_markdown(body_text[self.start : end])
+
+
+def _scan_commands(body_text):
+    """Yields the same commands as _parse_commands_markdown, but faster."""
+    body_text = body_text.replace("\r\n", "\n")
+    if _SCAN_COMMANDS_BAIL_RE.search(body_text) is not None:
+        yield from _parse_commands_markdown(body_text)
+        return
+
+    chunk = _ScanChunk(0)
+    # Top-level fenced code block: the opening fence
+    fence = None
+    # Top-level HTML block: the regex that ends it
+    html_end = None
+    prev_blank = True
+    # Might we be inside a list item or blockquote?
+    maybe_container = False
+    # Might we be inside an HTML block or table that ends at the next blank
+    # line?
+    maybe_html_or_table = False
+    # Once we're not sure where we are, we stop cutting chunks.
+    lost = False
+
+    for line_start, line in _iter_lines(body_text):
+        if lost:
+            chunk.plain = False
+            if _COMMAND_LINE_RE.match(line):
+                chunk.has_candidate = True
+            continue
+
+        if fence is not None:
+            match = _FENCE_CLOSE_RE.match(line)
+            if match is not None and fence in match.group(1):
+                fence = None
+            continue
+
+        if html_end is not None:
+            if html_end.search(line):
+                html_end = None
+            elif _HTML_RAW_END_RE.search(line):
+                lost = True
+            continue
+
+        if not line.strip():
+            prev_blank = True
+            maybe_html_or_table = False
+            if chunk.has_content:
+                chunk.seen_blank = True
+            continue
+
+        if prev_blank and chunk.has_content and not line[0].isspace():
+            yield from chunk.commands(body_text, line_start)
+            chunk = _ScanChunk(line_start)
+            maybe_container = False
+        prev_blank = False
+
+        if _CONTAINER_RE.match(line):
+            maybe_container = True
+        if "|" in line:
+            maybe_html_or_table = True
+
+        stripped = line.lstrip()
+        if stripped.startswith(("```", "~~~", "<")):
+            fence_match = _FENCE_OPEN_RE.match(line)
+            raw_match = _HTML_RAW_OPEN_RE.match(line)
+            if maybe_html_or_table or (maybe_container and line[0].isspace()):
+                lost = True
+            elif fence_match is not None:
+                fence, info = fence_match.group(2, 3)
+                if fence[0] == "`" and "`" in info:
+                    # Not actually a fence
+                    fence = None
+            elif raw_match is not None:
+                name = raw_match.group(1).lower()
+                if name == "textarea":
+                    # Older versions of marko don't treat this specially.
+                    lost = True
+                else:
+                    html_end = re.compile(rf"(?i)</{name}>")
+            elif _HTML_OTHER_OPEN_RE.match(line):
+                for open_re, end_re in _HTML_MARKED_BLOCKS:
+                    if open_re.match(line):
+                        html_end = end_re
+                        break
+                else:
+                    maybe_html_or_table = True
+            # The line that opens an HTML block can also close it.
+            if html_end is not None and html_end.search(line):
+                html_end = None
+
+        if _COMMAND_LINE_RE.match(line):
+            chunk.has_candidate = True
+        if chunk.plain:
+            if chunk.has_content:
+                line_ok = not chunk.seen_blank
+            else:
+                line_ok = _PLAIN_FIRST_LINE_RE.match(line) is not None
+            line_ok = (
+                line_ok
+                and _PLAIN_LINE_RE.fullmatch(line) is not None
+                and _AUTOLINK_WWW_RE.search(line) is None
+            )
+            if not line_ok:
+                chunk.plain = False
+                chunk.plain_commands = []
+            elif stripped.startswith("/"):
+                chunk.plain_commands.append(stripped.split())
+        chunk.has_content = True
+
+    yield from chunk.commands(body_text, len(body_text))
@@ -0,0 +1,176 @@
+# Minimal Prometheus-style metrics.
+#
+# We only need counters and histograms, and only need to render them in the
+# Prometheus text format, so rather than pulling in prometheus_client (and
+# its multiprocess machinery, which we don't use), we do it ourselves.
+#
+# These get recorded on every webhook, handler, Github API call and database
+# transaction, so recording has to be cheap: a dict lookup, plus a bisect for
+# histograms. All the cumulative-sum work happens in render(), when someone
+# actually scrapes /metrics. Database transactions run in worker threads
+# (see db.run_in_db_thread), so updates take a lock; nobody ever holds it for
+# long, so it's almost always uncontended.
+
+import bisect
+import math
+import threading
+
+__all__ = ["Counter", "Histogram", "Registry", "REGISTRY"]
+
+# Seconds. Covers everything from a cache hit to a handler that's waiting on
+# Github's eventual consistency.
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+
+def _escape(value):
+    return (
+        str(value)
+        .replace("\\", r"\\")
+        .replace("\n", r"\n")
+        .replace('"', r"\"")
+    )
+
+
+def _format_labels(labelnames, labelvalues, extra=""):
+    labels = [
+        f'{name}="{_escape(value)}"'
+        for (name, value) in zip(labelnames, labelvalues)
+    ]
+    if extra:
+        labels.append(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(labels) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"metric {metric.name!r} already registered")
+        self._metrics[metric.name] = metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=(), *, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # labelvalues -> count
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = (
+                self._values.get(labelvalues, 0) + amount
+            )
+
+    def value(self, *labelvalues):
+        return self._values.get(labelvalues, 0)
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        for labelvalues, count in values:
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield f"{self.name}{labels} {_format_value(count)}"
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(
+        self,
+        name,
+        help,
+        labelnames=(),
+        *,
+        buckets=DEFAULT_BUCKETS,
+        registry=REGISTRY,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labelvalues -> [per-bucket counts (the last is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def observe(self, value, *labelvalues):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labelvalues)
+            if entry is None:
+                entry = self._values[labelvalues] = [
+                    [0] * (len(self.buckets) + 1),
+                    0.0,
+                ]
+            entry[0][bucket] += 1
+            entry[1] += value
+
+    def count(self, *labelvalues):
+        entry = self._values.get(labelvalues)
+        if entry is None:
+            return 0
+        return sum(entry[0])
+
+    def render(self):
+        bounds = self.buckets + (math.inf,)
+        with self._lock:
+            values = [
+                (labelvalues, (list(counts), total))
+                for (labelvalues, (counts, total)) in self._values.items()
+            ]
+        for labelvalues, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                labels = _format_labels(
+                    self.labelnames,
+                    labelvalues,
+                    f'le="{_format_value(bound)}"',
+                )
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
@@ -0,0 +1,35 @@
+"""webhook queue
+
+Revision ID: 5c1d9a7e4b20
+Revises: 1479437ee1e2
+Create Date: 2026-10-16 10:12:41.118305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = "5c1d9a7e4b20"
+down_revision = "1479437ee1e2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "webhook_queue",
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("delivery_id", sa.String, nullable=False),
+        sa.Column("event_type", sa.String, nullable=False),
+        sa.Column("headers", postgresql.JSONB, nullable=False),
+        sa.Column("body", sa.LargeBinary, nullable=False),
+        sa.Column("received_at", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("leased_until", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("attempts", sa.Integer, nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table("webhook_queue")
@@ -0,0 +1,30 @@
+"""cached response
+
+Revision ID: 7e3c5a9b04d1
+Revises: d2f6b81c37a5
+Create Date: 2026-10-16 21:04:52.631907
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "7e3c5a9b04d1"
+down_revision = "d2f6b81c37a5"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "cached_response",
+        sa.Column("segment", sa.String, primary_key=True),
+        sa.Column("url", sa.String, primary_key=True),
+        sa.Column("entry", sa.LargeBinary, nullable=False),
+        sa.Column("stored_at", sa.DateTime(timezone=True), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table("cached_response")
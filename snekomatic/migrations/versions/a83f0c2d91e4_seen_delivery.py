@@ -0,0 +1,28 @@
+"""seen delivery
+
+Revision ID: a83f0c2d91e4
+Revises: 5c1d9a7e4b20
+Create Date: 2026-10-16 11:02:17.540981
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "a83f0c2d91e4"
+down_revision = "5c1d9a7e4b20"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "seen_delivery",
+        sa.Column("delivery_id", sa.String, primary_key=True),
+        sa.Column("expires_at", sa.DateTime(timezone=True), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table("seen_delivery")
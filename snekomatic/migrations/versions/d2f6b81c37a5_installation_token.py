@@ -0,0 +1,30 @@
+"""installation token
+
+Revision ID: d2f6b81c37a5
+Revises: a83f0c2d91e4
+Create Date: 2026-10-16 19:31:08.112374
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "d2f6b81c37a5"
+down_revision = "a83f0c2d91e4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "installation_token",
+        sa.Column("installation_id", sa.BigInteger, primary_key=True),
+        sa.Column("token_ciphertext", sa.LargeBinary, nullable=True),
+        sa.Column("expires_at", sa.DateTime(timezone=True), nullable=True),
+        sa.Column("leased_until", sa.DateTime(timezone=True), nullable=True),
+    )
+
+
+def downgrade():
+    op.drop_table("installation_token")
@@ -3,7 +3,12 @@ from weakref import WeakValueDictionary
 from glom import glom
 
 from .util import Pulse
-from .db import retry_txn, PDictDBEntry
+from .db import (
+    retry_txn,
+    retry_serialization_failures,
+    run_txn,
+    PDictDBEntry,
+)
 
 _UPDATE_PULSES = WeakValueDictionary()
 
@@ -51,52 +56,66 @@ class PDict:
     domain = attr.ib()
     item = attr.ib()
 
-    def update(self, new_value):
+    def _update_txn(self, session, new_value):
+        existing = (
+            session.query(PDictDBEntry)
+            .filter_by(domain=self.domain, item=self.item)
+            .with_for_update()
+            .one_or_none()
+        )
+        if existing is None:
+            session.add(
+                PDictDBEntry(
+                    domain=self.domain, item=self.item, value=new_value
+                )
+            )
+        else:
+            try:
+                existing.value = unify(existing.value, new_value)
+            except ValueError as exc:
+                raise ValueError(
+                    f"inconsistent values for PDict({self.domain}, {self.item}): "
+                    f"current={existing.value!r}, new={new_value!r}"
+                ) from exc
+
+    def _check_value(self, new_value):
         if not isinstance(new_value, dict):
             raise TypeError(
                 f"PDict value should be a dict, not {new_value!r}"
             )
+
+    @retry_serialization_failures
+    def update(self, new_value):
+        self._check_value(new_value)
         with retry_txn() as attempts:
             for session in attempts:
-                existing = (
-                    session.query(PDictDBEntry)
-                    .filter_by(domain=self.domain, item=self.item)
-                    .with_for_update()
-                    .one_or_none()
-                )
-                if existing is None:
-                    session.add(
-                        PDictDBEntry(
-                            domain=self.domain,
-                            item=self.item,
-                            value=new_value,
-                        )
-                    )
-                else:
-                    try:
-                        existing.value = unify(existing.value, new_value)
-                    except ValueError as exc:
-                        raise ValueError(
-                            f"inconsistent values for PDict({self.domain}, {self.item}): "
-                            f"current={existing.value!r}, new={new_value!r}"
-                        ) from exc
+                self._update_txn(session, new_value)
         _pulse_for(self.domain, self.item).pulse()
 
+    async def aupdate(self, new_value):
+        """Like update(), but talks to the database from a worker thread, so
+        it doesn't block the event loop. Use this from async code.
+
+        """
+        self._check_value(new_value)
+        await run_txn(self._update_txn, new_value)
+        _pulse_for(self.domain, self.item).pulse()
+
+    def _load_txn(self, session):
+        existing = (
+            session.query(PDictDBEntry)
+            .filter_by(domain=self.domain, item=self.item)
+            .one_or_none()
+        )
+        if existing is None:
+            return {}
+        return existing.value
+
     async def subscribe(self):
         """Yields a sequence of dict snapshots."""
         last_yield = None
         async for _ in _pulse_for(self.domain, self.item).subscribe():
-            with retry_txn() as attempts:
-                for session in attempts:
-                    existing = (
-                        session.query(PDictDBEntry)
-                        .filter_by(domain=self.domain, item=self.item)
-                        .one_or_none()
-                    )
-                    if existing is None:
-                        value = {}
-                    else:
-                        value = existing.value
+            value = await run_txn(self._load_txn)
             if value != last_yield:
                 yield value
                 last_yield = value
@@ -0,0 +1,173 @@
+# Replays webhook deliveries recorded by snekomatic.webhook_archive against a
+# running instance, e.g.:
+#
+#   python -m snekomatic.replay --url http://localhost:8000/webhook/github \
+#       --speed 10 archive.2 archive.1 archive
+#
+# Deliveries are sent with the same spacing they originally arrived with,
+# divided by --speed ("max" means: don't wait at all). Deliveries for the
+# same repository are sent one at a time, in their original order, so
+# handlers see events in the same order they did in production; different
+# repositories are replayed concurrently.
+#
+# Each delivery is re-signed with $GITHUB_WEBHOOK_SECRET (or --secret), and
+# gets a fresh delivery id, since otherwise the instance would recognize them
+# as redeliveries and drop them. Pass --keep-delivery-ids if you want that.
+
+import argparse
+from collections import Counter, defaultdict
+import hmac
+import json
+import os
+import sys
+import uuid
+
+import asks
+import asks.errors
+import trio
+
+from .webhook_archive import read_webhook_archive
+
+__all__ = ["replay"]
+
+
+# Partial duplicate of gidgethub.sansio.validate_event
+def _sign(body, secret):
+    hmaccer = hmac.new(secret.encode("ascii"), msg=body, digestmod="sha1")
+    return "sha1=" + hmaccer.hexdigest()
+
+
+def _repository(record):
+    try:
+        payload = json.loads(record["body"])
+    except ValueError:
+        return None
+    repository = payload.get("repository")
+    if not isinstance(repository, dict):
+        return None
+    return repository.get("full_name")
+
+
+async def replay(records, send, *, speed=1, concurrency=None):
+    """Calls send(record) for each record, with the original timing.
+
+    'records' must be in the order they were received. The gaps between
+    them are divided by 'speed'; None means send everything as fast as
+    possible. Either way, send is only called for a record once send has
+    returned for every earlier record from the same repository.
+
+    """
+    by_repository = defaultdict(list)
+    for record in records:
+        by_repository[_repository(record)].append(record)
+    if not by_repository:
+        return
+    first_received_at = min(
+        queue[0]["received_at"] for queue in by_repository.values()
+    )
+    if concurrency is None:
+        limiter = None
+    else:
+        limiter = trio.CapacityLimiter(concurrency)
+    start = trio.current_time()
+
+    async def replay_repository(queue):
+        for record in queue:
+            if speed is not None:
+                offset = record["received_at"] - first_received_at
+                await trio.sleep_until(start + offset / speed)
+            if limiter is None:
+                await send(record)
+            else:
+                async with limiter:
+                    await send(record)
+
+    async with trio.open_nursery() as nursery:
+        for queue in by_repository.values():
+            nursery.start_soon(replay_repository, queue)
+
+
+def _parse_speed(speed):
+    if speed == "max":
+        return None
+    speed = float(speed.rstrip("x"))
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive")
+    return speed
+
+
+async def main(args):
+    records = []
+    for path in args.archive:
+        records.extend(read_webhook_archive(path))
+    # Rotated archives can be given in any order
+    records.sort(key=lambda record: record["received_at"])
+    print(f"Replaying {len(records)} deliveries to {args.url}")
+
+    session = asks.Session(connections=args.concurrency or 100)
+    statuses = Counter()
+
+    async def send(record):
+        body = record["body"].encode("utf-8")
+        headers = dict(record["headers"])
+        headers["x-hub-signature"] = _sign(body, args.secret)
+        if not args.keep_delivery_ids:
+            headers["x-github-delivery"] = str(uuid.uuid4())
+        try:
+            response = await session.post(
+                args.url, headers=headers, data=body
+            )
+        except (OSError, asks.errors.AsksException) as exc:
+            print(f"Delivery {headers['x-github-delivery']} failed: {exc!r}")
+            statuses[type(exc).__name__] += 1
+        else:
+            statuses[response.status_code] += 1
+
+    start = trio.current_time()
+    await replay(
+        records, send, speed=args.speed, concurrency=args.concurrency
+    )
+    elapsed = trio.current_time() - start
+    print(f"Sent {len(records)} deliveries in {elapsed:.1f} seconds")
+    for status, count in sorted(statuses.items(), key=str):
+        print(f"  {status}: {count}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="python -m snekomatic.replay",
+        description="Replay archived webhook deliveries",
+    )
+    parser.add_argument("archive", nargs="+", help="archive file(s)")
+    parser.add_argument(
+        "--url",
+        default="http://localhost:8000/webhook/github",
+        help="where to send the deliveries",
+    )
+    parser.add_argument(
+        "--speed",
+        type=_parse_speed,
+        default=1,
+        help='how much faster than real time to go, or "max"',
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=None,
+        help="maximum deliveries in flight at once",
+    )
+    parser.add_argument(
+        "--secret",
+        default=os.environ.get("GITHUB_WEBHOOK_SECRET"),
+        help="webhook secret (default: $GITHUB_WEBHOOK_SECRET)",
+    )
+    parser.add_argument(
+        "--keep-delivery-ids",
+        action="store_true",
+        help="send the original delivery ids",
+    )
+    args = parser.parse_args()
+    if args.secret is None:
+        parser.error("need --secret or $GITHUB_WEBHOOK_SECRET")
+    sys.stdout.reconfigure(line_buffering=True)
+    trio.run(main, args)
@@ -0,0 +1,73 @@
+# Installation tokens, shared between processes.
+#
+# Installation tokens are good for an hour, but each process only keeps them
+# in memory, so every dyno restart (and Heroku restarts dynos at least once a
+# day) and every extra dyno means minting a whole new set. This keeps them in
+# Postgres instead, so a fresh process can pick up where the last one left
+# off. A lease in the same row makes sure that only one process at a time
+# mints a new token for a given installation; the others wait and then use
+# the one it stored.
+#
+# The tokens are encrypted before they go into the database, so that a
+# database dump doesn't give away access to all our installations.
+
+import os
+
+from nacl import encoding, exceptions, secret
+import pendulum
+
+from .db import (
+    run_in_db_thread,
+    load_installation_token,
+    lease_installation_token,
+    save_installation_token,
+    release_installation_token_lease,
+)
+
+__all__ = ["PostgresTokenStore", "TOKEN_STORE_KEY_ENVVAR"]
+
+# Hex-encoded, 32 bytes. Generate one with:
+#   python -c 'import nacl.utils; print(nacl.utils.random(32).hex())'
+TOKEN_STORE_KEY_ENVVAR = "SNEKOMATIC_TOKEN_STORE_KEY"
+
+
+class PostgresTokenStore:
+    """A token store for GithubApp(token_store=...), backed by Postgres."""
+
+    def __init__(self, key=None):
+        if key is None:
+            key = os.environ[TOKEN_STORE_KEY_ENVVAR]
+        self._box = secret.SecretBox(key, encoder=encoding.HexEncoder)
+
+    async def load(self, installation_id):
+        stored = await run_in_db_thread(
+            load_installation_token, installation_id
+        )
+        if stored is None:
+            return None
+        ciphertext, expires_at = stored
+        try:
+            token = self._box.decrypt(ciphertext).decode("ascii")
+        except exceptions.CryptoError:
+            # Probably the key changed. No big deal; we'll mint a new one.
+            print(f"{installation_id}: Can't decrypt stored token; ignoring")
+            return None
+        return token, pendulum.instance(expires_at)
+
+    async def try_lease(self, installation_id, lease_seconds):
+        return await run_in_db_thread(
+            lease_installation_token, installation_id, lease_seconds
+        )
+
+    async def save(self, installation_id, token, expires_at):
+        await run_in_db_thread(
+            save_installation_token,
+            installation_id,
+            bytes(self._box.encrypt(token.encode("ascii"))),
+            expires_at,
+        )
+
+    async def release(self, installation_id):
+        await run_in_db_thread(
+            release_installation_token_lease, installation_id
+        )
@@ -0,0 +1,318 @@
+# Lightweight tracing for webhook deliveries.
+#
+# Each delivery gets a trace, and everything it causes -- handlers, Github
+# API requests, token renewals, database transactions -- is recorded as a
+# span within that trace, so when a delivery is slow you can see where the
+# time went. Spans are handed to exporters as they finish; there's one that
+# writes JSON lines to a local file, and one that sends batches to an
+# OpenTelemetry (OTLP/HTTP) collector.
+#
+# The current span lives in a contextvar, and trio copies contextvars into
+# new tasks, so spans in spawned handlers automatically end up as children
+# of the delivery's span. Outside of a trace (e.g. retry_txn at startup), or
+# if there are no exporters configured, span() and start_span() don't record
+# anything and cost next to nothing.
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import hashlib
+import json
+import secrets
+import time
+
+import anyio
+import asks
+import attr
+
+__all__ = [
+    "trace",
+    "span",
+    "start_span",
+    "current_span",
+    "add_exporter",
+    "remove_exporter",
+    "JsonlExporter",
+    "OtlpExporter",
+]
+
+_current_span = ContextVar("snekomatic.tracing.current_span", default=None)
+_exporters = []
+
+
+def add_exporter(exporter):
+    """Start sending finished spans to exporter.export(span_dict)."""
+    _exporters.append(exporter)
+
+
+def remove_exporter(exporter):
+    _exporters.remove(exporter)
+
+
+def _trace_id(key):
+    # OpenTelemetry wants 16 bytes of hex. Deriving it from the delivery id
+    # means a redelivery lands in the same trace.
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+
+@attr.s(eq=False)
+class Span:
+    name = attr.ib()
+    trace_id = attr.ib()
+    delivery_id = attr.ib()
+    parent_id = attr.ib()
+    attributes = attr.ib(factory=dict)
+    span_id = attr.ib(factory=lambda: secrets.token_hex(8))
+    start = attr.ib(factory=time.time)
+    _start_counter = attr.ib(factory=time.perf_counter)
+    duration = attr.ib(default=None)
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def child(self, name, **attributes):
+        return Span(
+            name, self.trace_id, self.delivery_id, self.span_id, attributes
+        )
+
+    def finish(self, **attributes):
+        # Idempotent, so error paths can call it without worrying about
+        # whether it's already been called.
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._start_counter
+        self.attributes.update(attributes)
+        record = {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "delivery_id": self.delivery_id,
+            "start": self.start,
+            "duration": self.duration,
+            "attributes": self.attributes,
+        }
+        for exporter in _exporters:
+            try:
+                exporter.export(record)
+            except Exception as exc:
+                print(f"Failed to export span to {exporter!r}: {exc!r}")
+
+
+class _NullSpan:
+    def set(self, **attributes):
+        pass
+
+    def child(self, name, **attributes):
+        return self
+
+    def finish(self, **attributes):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def current_span():
+    """The innermost open span, or a do-nothing stand-in if there isn't one."""
+    span = _current_span.get()
+    if span is None:
+        return _NULL_SPAN
+    return span
+
+
+@contextmanager
+def _activate(span):
+    if span is _NULL_SPAN:
+        yield span
+        return
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as exc:
+        span.set(error=repr(exc))
+        raise
+    finally:
+        _current_span.reset(token)
+        span.finish()
+
+
+def trace(name, delivery_id, **attributes):
+    """Start a new trace for a delivery, with 'name' as its root span.
+
+    Use as a context manager. Everything inside it (including in tasks it
+    spawns) records spans into this trace.
+
+    """
+    if not _exporters:
+        return _activate(_NULL_SPAN)
+    return _activate(
+        Span(name, _trace_id(delivery_id), delivery_id, None, attributes)
+    )
+
+
+def span(name, *, parent=None, **attributes):
+    """Record a span for the enclosed block, as a child of 'parent'.
+
+    'parent' defaults to the current span. If we're not in a trace, this
+    does nothing.
+
+    """
+    if parent is None:
+        parent = current_span()
+    return _activate(parent.child(name, **attributes))
+
+
+def start_span(name, **attributes):
+    """Like span(), but for when a 'with' block doesn't fit.
+
+    Returns a span that's a child of the current span, but doesn't become the
+    current span itself. Call .finish() on it when you're done.
+
+    """
+    return current_span().child(name, **attributes)
+
+
+@attr.s
+class JsonlExporter:
+    """Appends each span to 'path' as a line of JSON.
+
+    Like OtlpExporter, spans are buffered, and written out by run() (in a
+    worker thread, so the disk never holds up the event loop), which you
+    should start in the background.
+
+    """
+
+    path = attr.ib()
+    interval = attr.ib(default=1)
+    max_buffered = attr.ib(default=10000)
+    _buffer = attr.ib(factory=list)
+    dropped = attr.ib(default=0)
+
+    def export(self, record):
+        if len(self._buffer) >= self.max_buffered:
+            self.dropped += 1
+            return
+        self._buffer.append(record)
+
+    def _write(self, records):
+        with open(self.path, "a") as f:
+            for record in records:
+                f.write(json.dumps(record, default=str) + "\n")
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        records, self._buffer = self._buffer, []
+        try:
+            await anyio.run_in_thread(self._write, records)
+        except OSError as exc:
+            print(f"Failed to write {len(records)} spans: {exc!r}")
+
+    async def run(self):
+        while True:
+            await anyio.sleep(self.interval)
+            await self.flush()
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(record):
+    attributes = dict(record["attributes"])
+    attributes["delivery_id"] = record["delivery_id"]
+    start_ns = int(record["start"] * 1e9)
+    end_ns = start_ns + int(record["duration"] * 1e9)
+    otlp = {
+        "traceId": record["trace_id"],
+        "spanId": record["span_id"],
+        "name": record["name"],
+        # SPAN_KIND_INTERNAL
+        "kind": 1,
+        "startTimeUnixNano": str(start_ns),
+        "endTimeUnixNano": str(end_ns),
+        "attributes": [
+            {"key": key, "value": _otlp_value(value)}
+            for (key, value) in attributes.items()
+        ],
+        # STATUS_CODE_ERROR or STATUS_CODE_UNSET
+        "status": {"code": 2 if "error" in attributes else 0},
+    }
+    if record["parent_id"] is not None:
+        otlp["parentSpanId"] = record["parent_id"]
+    return otlp
+
+
+@attr.s
+class OtlpExporter:
+    """Sends spans to an OpenTelemetry collector's OTLP/HTTP endpoint.
+
+    Spans are buffered, and sent in batches by run(), which you should start
+    in the background. If the collector falls behind, we drop spans rather
+    than letting the buffer grow without bound.
+
+    """
+
+    # e.g. http://localhost:4318/v1/traces
+    endpoint = attr.ib()
+    service_name = attr.ib(default="snekomatic")
+    interval = attr.ib(default=5)
+    max_buffered = attr.ib(default=10000)
+    _buffer = attr.ib(factory=list)
+    dropped = attr.ib(default=0)
+
+    def export(self, record):
+        if len(self._buffer) >= self.max_buffered:
+            self.dropped += 1
+            return
+        self._buffer.append(record)
+
+    def _payload(self, records):
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": self.service_name},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "snekomatic.tracing"},
+                            "spans": [_otlp_span(r) for r in records],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    async def run(self):
+        session = asks.Session(connections=1)
+        while True:
+            await anyio.sleep(self.interval)
+            if not self._buffer:
+                continue
+            records, self._buffer = self._buffer, []
+            try:
+                response = await session.post(
+                    self.endpoint,
+                    headers={"content-type": "application/json"},
+                    data=json.dumps(self._payload(records), default=str),
+                )
+            except Exception as exc:
+                print(f"Failed to send {len(records)} spans: {exc!r}")
+                continue
+            if response.status_code >= 300:
+                print(
+                    f"OTLP collector rejected {len(records)} spans: "
+                    f"{response.status_code}"
+                )
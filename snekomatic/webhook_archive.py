@@ -0,0 +1,138 @@
+# Recording webhook deliveries, so we can replay them later.
+#
+# When something is slow in production, the hard part is reproducing the
+# load that made it slow. So if you set SNEKOMATIC_WEBHOOK_ARCHIVE, every
+# verified delivery gets appended to an archive file, and then
+# 'python -m snekomatic.replay' can play them back against a test instance,
+# with the same timing (or faster).
+#
+# Each delivery is written as its own little gzip member, holding one line of
+# JSON. Concatenated gzip members are still a valid gzip file, so the archive
+# can be read with plain 'zcat', and if we crash halfway through a write, we
+# only lose that one delivery. When the file gets too big, it's rotated out
+# to archive.1 (and archive.1 to archive.2, etc.), the same as
+# logging.handlers.RotatingFileHandler.
+#
+# Github is waiting for our response while we record a delivery, so
+# recording only puts it in a buffer; WebhookArchive.run writes the buffer
+# out in a worker thread.
+
+import gzip
+import json
+import os
+import time
+import zlib
+
+import attr
+import trio
+
+__all__ = [
+    "WebhookArchive",
+    "read_webhook_archive",
+    "WEBHOOK_ARCHIVE_ENVVAR",
+]
+
+# Setting this to a path turns on capture
+WEBHOOK_ARCHIVE_ENVVAR = "SNEKOMATIC_WEBHOOK_ARCHIVE"
+
+
+# The signature is useless once the secret changes, and replay re-signs
+# anyway. Everything else in the request (IP addresses, Heroku's routing
+# headers, ...) is none of our business.
+def _should_record(header):
+    header = header.lower()
+    return header == "content-type" or header.startswith("x-github-")
+
+
+@attr.s
+class WebhookArchive:
+    """An archive for GithubApp(webhook_archive=...).
+
+    Appends deliveries to 'path', and once it's grown past max_bytes, rotates
+    it, keeping at most 'backups' old files around. Deliveries are buffered
+    until the next flush(); run() flushes every 'interval' seconds, and you
+    should start it in the background. If the disk falls behind, we drop
+    deliveries rather than letting the buffer grow without bound.
+
+    """
+
+    path = attr.ib()
+    max_bytes = attr.ib(default=64 * 2 ** 20)
+    backups = attr.ib(default=5)
+    interval = attr.ib(default=1)
+    max_buffered = attr.ib(default=1000)
+    _buffer = attr.ib(factory=list)
+    dropped = attr.ib(default=0)
+
+    def record(self, headers, body):
+        try:
+            body = body.decode("utf-8")
+        except UnicodeDecodeError:
+            # The signature checked out, so it's Github's problem, not ours;
+            # but we archive JSON text, so there's no room for it.
+            print("Not archiving webhook delivery: body isn't UTF-8")
+            return
+        entry = {
+            "received_at": time.time(),
+            "headers": {
+                key.lower(): value
+                for (key, value) in headers.items()
+                if _should_record(key)
+            },
+            "body": body,
+        }
+        if len(self._buffer) >= self.max_buffered:
+            self.dropped += 1
+            return
+        self._buffer.append(entry)
+
+    def _write(self, entries):
+        for entry in entries:
+            blob = gzip.compress(json.dumps(entry).encode("utf-8") + b"\n")
+            with open(self.path, "ab") as f:
+                f.write(blob)
+                size = f.tell()
+            if size >= self.max_bytes:
+                self._rotate()
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        entries, self._buffer = self._buffer, []
+        try:
+            await trio.to_thread.run_sync(self._write, entries)
+        except OSError as exc:
+            # Not worth crashing over
+            print(f"Failed to archive {len(entries)} deliveries: {exc!r}")
+
+    async def run(self):
+        while True:
+            await trio.sleep(self.interval)
+            await self.flush()
+
+
+def read_webhook_archive(path):
+    """Yields the recorded deliveries in 'path', oldest first.
+
+    Each one is a dict with "received_at" (a Unix timestamp), "headers" and
+    "body" (a str). If the last delivery was only half-written, it's skipped.
+
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                if line.endswith("\n"):
+                    yield json.loads(line)
+        # gzip raises a plain OSError for garbage where it expected a
+        # header (BadGzipFile, a subclass, is new in Python 3.8)
+        except (EOFError, zlib.error, OSError):
+            print(f"{path}: archive is truncated; stopping early")
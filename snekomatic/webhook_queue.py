@@ -0,0 +1,145 @@
+# Durable ingestion for Github webhooks.
+#
+# Github gives up on a webhook delivery if we don't respond within 10
+# seconds, and our handlers can easily take longer than that (they make
+# Github API calls, talk to the database, etc.). So instead of dispatching
+# deliveries while Github waits, we can check the signature, stash the
+# delivery in a Postgres table, and respond immediately. Then a pool of
+# consumer tasks drains the table and runs the usual GithubRoutes handlers.
+#
+# Because the queue lives in the database, a delivery that was accepted
+# survives the dyno restarting, and if there are multiple dynos they'll share
+# the work.
+
+import anyio
+import anyio.exceptions
+import pendulum
+import trio
+
+from .db import (
+    run_in_db_thread,
+    enqueue_webhook,
+    claim_queued_webhook,
+    finish_queued_webhook,
+)
+from .gh import _leaf_exceptions
+from .util import Pulse
+
+__all__ = ["enqueue_webhook_delivery", "run_webhook_consumers"]
+
+# How long a consumer gets to work on a delivery before we decide it must
+# have died, and let someone else have a try.
+LEASE_SECONDS = 5 * 60
+# After this many failed attempts, we give up on a delivery. Otherwise a
+# single bad delivery would keep crashing our handlers forever.
+MAX_ATTEMPTS = 5
+# Enqueues from this process wake the consumers immediately, but enqueues
+# from other dynos and expired leases can only be noticed by polling.
+POLL_INTERVAL = 5
+
+_NEW_WORK = Pulse()
+
+
+async def enqueue_webhook_delivery(gh_app, headers, body):
+    # We check the signature here, *before* it goes into the database, so the
+    # queue only ever contains genuine deliveries. Likewise for redeliveries,
+    # and for deliveries that nothing is listening for.
+    event = gh_app.verify_webhook(headers, body)
+    gh_app.archive_delivery(headers, body)
+    if not gh_app.wants_event_type(event.event):
+        return
+    if await gh_app.is_duplicate_delivery(event):
+        return
+    headers = {key.lower(): value for (key, value) in headers.items()}
+    try:
+        await run_in_db_thread(
+            enqueue_webhook, event.delivery_id, event.event, headers, body
+        )
+    except BaseException:
+        # Github will redeliver it, and we want that to go through
+        await gh_app.forget_delivery(event.delivery_id)
+        raise
+    print(
+        f"GH webhook queued: type={event.event}, delivery id={event.delivery_id}"
+    )
+    _NEW_WORK.pulse()
+
+
+async def _poke_periodically():
+    while True:
+        await trio.sleep(POLL_INTERVAL)
+        _NEW_WORK.pulse()
+
+
+async def _consume(gh_app, consumer_number):
+    async for _ in _NEW_WORK.subscribe():
+        while True:
+            # If the database is having a bad moment, wait for the next poke
+            # rather than letting the error take down all the consumers.
+            try:
+                queued = await run_in_db_thread(
+                    claim_queued_webhook, LEASE_SECONDS
+                )
+            except Exception as exc:
+                print(
+                    f"Consumer {consumer_number}: couldn't claim a delivery: "
+                    f"{exc!r}"
+                )
+                break
+            if queued is None:
+                break
+            print(
+                f"Consumer {consumer_number}: dispatching queued delivery "
+                f"{queued.delivery_id} (attempt {queued.attempts})"
+            )
+            try:
+                age = (pendulum.now() - queued.received_at).total_seconds()
+                await gh_app.dispatch_webhook_inline(
+                    queued.headers, queued.body, age=age
+                )
+            except anyio.exceptions.ExceptionGroup as group:
+                # Several handlers failed at once. That's a BaseException, so
+                # it needs its own clause, or it would take down all the
+                # consumers -- unless we're being cancelled, of course.
+                leaves = list(_leaf_exceptions(group))
+                cancelled = anyio.get_cancelled_exc_class()
+                if any(isinstance(exc, cancelled) for exc in leaves):
+                    raise
+                for exc in leaves:
+                    gh_app.on_dispatch_error(exc)
+                failure = group
+            except Exception as exc:
+                failure = exc
+            else:
+                failure = None
+            if failure is not None:
+                print(
+                    f"Consumer {consumer_number}: delivery "
+                    f"{queued.delivery_id} failed: {failure!r}"
+                )
+                if queued.attempts < MAX_ATTEMPTS:
+                    # Leave it in the queue; once the lease expires, it will
+                    # be retried.
+                    continue
+                print(f"Giving up on delivery {queued.delivery_id}")
+                # ...but if someone redelivers it by hand, let it through
+                await gh_app.forget_delivery(queued.delivery_id)
+            try:
+                await run_in_db_thread(finish_queued_webhook, queued.id)
+            except Exception as exc:
+                # It stays in the queue, and gets dispatched again once the
+                # lease expires.
+                print(
+                    f"Consumer {consumer_number}: couldn't finish delivery "
+                    f"{queued.delivery_id}: {exc!r}"
+                )
+
+
+async def run_webhook_consumers(
+    gh_app, count, *, task_status=trio.TASK_STATUS_IGNORED
+):
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(_poke_periodically)
+        for i in range(count):
+            nursery.start_soon(_consume, gh_app, i)
+        task_status.started()
@@ -22,11 +22,11 @@ import os
 import json
 from base64 import b64encode
 from nacl import encoding, public
-from .gh import GithubRoutes
+from .gh import GithubRoutes, PRIORITY_BACKGROUND
 from .persistent import PDict
 from .app import github_app
 from .util import hash_json
-from .db import already_check_and_set
+from .db import already_check_and_set, run_in_db_thread
 
 __all__ = ["worker_routes", "run_worker_task_idem"]
 
@@ -70,7 +70,9 @@ async def setup_worker_tasks():
     if DID_SETUP_WORKER_TASKS_THIS_RUN:
         return
     repo = os.environ["SNEKOMATIC_WORKER_REPO"]
-    gh_client = await github_app.client_for_repo(repo)
+    gh_client = await github_app.client_for_repo(
+        repo, route="worker-task-setup"
+    )
 
     secrets = {
         "GITHUB_USER_AGENT": github_app.user_agent,
@@ -102,11 +104,15 @@ async def setup_worker_tasks():
 # *different* 'args' dict.
 async def start_worker_task_idem(args):
     task_id = hash_json(args)
-    if already_check_and_set("worker-task-started", task_id):
+    if await run_in_db_thread(
+        already_check_and_set, "worker-task-started", task_id
+    ):
         return task_id
 
     worker_repo = os.environ["SNEKOMATIC_WORKER_REPO"]
-    client = await github_app.client_for_repo(worker_repo)
+    client = await github_app.client_for_repo(
+        worker_repo, route="worker-task-start"
+    )
 
     await client.post(
         f"/repos/{worker_repo}/dispatches",
@@ -136,7 +142,7 @@ async def run_worker_task_idem(args, *, task_status):
     conclusion = await get_check_suite_conclusion(
         os.environ["SNEKOMATIC_WORKER_REPO"], check_suite_id
     )
-    pdict.update({"conclusion": conclusion})
+    await pdict.aupdate({"conclusion": conclusion})
 
 
 @worker_routes.route_webhook("check_run")
@@ -157,7 +163,7 @@ async def worker_task_check_run_event(event_type, payload, gh_client):
 
     (_, task_id) = name.split("-", 1)
 
-    PDict("worker-task", task_id).update(
+    await PDict("worker-task", task_id).aupdate(
         {
             "repo": repo,
             "check-suite-id": glom(payload, "check_run.check_suite.id"),
@@ -184,7 +190,9 @@ async def get_check_suite_conclusion(repo, check_suite_id):
 async def check_suite_result_background_poller(
     repo, check_suite_id, interval
 ):
-    gh_client = await github_app.client_for_repo(repo)
+    gh_client = await github_app.client_for_repo(
+        repo, priority=PRIORITY_BACKGROUND, route="check-suite-poller"
+    )
     while True:
         response = await gh_client.getitem(
             "/repos/{+repo}/check-suites/{check_suite_id}",
@@ -192,7 +200,7 @@ async def check_suite_result_background_poller(
             accept="application/vnd.github.antiope-preview+json",
         )
         if glom(response, "status") == "completed":
-            PDict("check-suite.completed", str(check_suite_id)).update(
+            await PDict("check-suite.completed", str(check_suite_id)).aupdate(
                 {"conclusion": glom(response, "conclusion")}
             )
             return
@@ -204,6 +212,6 @@ async def check_suite_result_background_poller(
 async def check_suite_result_monitor(event_type, payload, gh_client):
     check_suite_id = glom(payload, "check_suite.id")
     conclusion = glom(payload, "check_suite.conclusion")
-    PDict("check-suite.completed", str(check_suite_id)).update(
+    await PDict("check-suite.completed", str(check_suite_id)).aupdate(
         {"conclusion": conclusion}
     )
@@ -1,14 +1,31 @@
 import os
+import pendulum
 import psycopg2
 import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
 import trio
+from snekomatic import db, tracing
 from snekomatic.db import (
     _get_session,
     already_check_and_set,
     retry_txn,
+    run_in_db_thread,
+    run_txn,
     Already,
+    enqueue_webhook,
+    claim_queued_webhook,
+    finish_queued_webhook,
+    delivery_check_and_set,
+    expire_seen_deliveries,
+    SeenDelivery,
+    load_cached_response,
+    save_cached_response,
+    expire_cached_responses,
 )
 
+from .util import mock_time
+
 
 @pytest.mark.skipif(
     "DESTRUCTIVE_TESTING_RESET_DB" in os.environ,
@@ -61,6 +78,127 @@ async def test_retry_txn_serializability(heroku_style_pg):
     assert found_already_there == 1
 
 
+class ListExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, record):
+        self.spans.append(record)
+
+
+async def test_retry_txn_tracing_and_metrics(heroku_style_pg):
+    attempts_before = db.DB_TRANSACTION_ATTEMPTS.value()
+    failures_before = db.DB_SERIALIZATION_FAILURES.value()
+    exporter = ListExporter()
+    tracing.add_exporter(exporter)
+
+    async def task_fn(delivery_id):
+        with tracing.trace("webhook", delivery_id):
+            with retry_txn() as attempts:
+                for session in attempts:
+                    obj = (
+                        session.query(Already)
+                        .filter_by(domain="d", item="i")
+                        .one_or_none()
+                    )
+                    await trio.sleep(1)
+                    if obj is None:
+                        session.add(Already(domain="d", item="i"))
+
+    try:
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(task_fn, "a")
+            nursery.start_soon(task_fn, "b")
+    finally:
+        tracing.remove_exporter(exporter)
+
+    assert db.DB_TRANSACTION_ATTEMPTS.value() == attempts_before + 3
+    assert db.DB_SERIALIZATION_FAILURES.value() == failures_before + 1
+    outcomes = sorted(
+        (
+            span["delivery_id"],
+            span["attributes"]["attempt"],
+            span["attributes"]["outcome"],
+        )
+        for span in exporter.spans
+        if span["name"] == "db.transaction"
+    )
+    assert outcomes in (
+        [
+            ("a", 1, "committed"),
+            ("b", 1, "serialization_failure"),
+            ("b", 2, "committed"),
+        ],
+        [
+            ("a", 1, "serialization_failure"),
+            ("a", 2, "committed"),
+            ("b", 1, "committed"),
+        ],
+    )
+
+
+async def test_run_txn(heroku_style_pg):
+    # Connecting and checking the schema happens on first use
+    assert not await run_in_db_thread(already_check_and_set, "d", "i")
+    assert await run_in_db_thread(already_check_and_set, "d", "i")
+
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await trio.sleep(0.01)
+            ticks += 1
+
+    def slow_count(session, domain):
+        session.execute(text("SELECT pg_sleep(0.5)"))
+        return session.query(Already).filter_by(domain=domain).count()
+
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(ticker)
+        # Both run at once, and the event loop keeps going meanwhile
+        start = trio.current_time()
+        async with trio.open_nursery() as inner:
+            inner.start_soon(run_txn, slow_count, "d")
+            inner.start_soon(run_txn, slow_count, "d")
+        assert trio.current_time() - start < 0.9
+        assert ticks >= 20
+        assert await run_txn(slow_count, "d") == 1
+        assert await run_txn(slow_count, "other") == 0
+        nursery.cancel_scope.cancel()
+
+
+def test_retry_serialization_failures(monkeypatch):
+    class FakeFailure(Exception):
+        pass
+
+    # Real SerializationFailures only come from Postgres
+    monkeypatch.setattr(
+        db,
+        "_is_serialization_failure",
+        lambda exc: isinstance(exc.orig, FakeFailure),
+    )
+    calls = 0
+
+    @db.retry_serialization_failures
+    def flaky(value):
+        nonlocal calls
+        calls += 1
+        if calls < 3:
+            raise OperationalError("SELECT 1", {}, FakeFailure())
+        return value
+
+    assert flaky("ok") == "ok"
+    assert calls == 3
+
+    @db.retry_serialization_failures
+    def broken():
+        raise OperationalError("SELECT 1", {}, ValueError())
+
+    with pytest.raises(OperationalError):
+        broken()
+
+
 def test_retry_txn_error_on_early_exit(heroku_style_pg):
     with pytest.raises(AssertionError):
         with retry_txn() as attempts:
@@ -80,3 +218,68 @@ def test_already_check_and_set(heroku_style_pg):
 
     assert not already_check_and_set("d1", "i2")
     assert already_check_and_set("d1", "i2")
+
+
+def test_webhook_queue(heroku_style_pg):
+    assert claim_queued_webhook(60) is None
+
+    enqueue_webhook("d1", "ping", {"x-github-event": "ping"}, b"body1")
+    enqueue_webhook("d2", "ping", {}, b"body2")
+
+    # Deliveries come out in order
+    first = claim_queued_webhook(60)
+    assert first.delivery_id == "d1"
+    assert first.event_type == "ping"
+    assert first.headers == {"x-github-event": "ping"}
+    assert first.body == b"body1"
+    assert first.attempts == 1
+
+    second = claim_queued_webhook(60)
+    assert second.delivery_id == "d2"
+
+    # Both are leased now, so there's nothing left to claim
+    assert claim_queued_webhook(60) is None
+
+    finish_queued_webhook(first.id)
+
+    # Once the lease expires, the unfinished one can be claimed again
+    with mock_time(pendulum.now().add(seconds=61)):
+        again = claim_queued_webhook(60)
+    assert again.delivery_id == "d2"
+    assert again.attempts == 2
+
+    finish_queued_webhook(again.id)
+    with mock_time(pendulum.now().add(minutes=10)):
+        assert claim_queued_webhook(60) is None
+
+
+def test_delivery_check_and_set(heroku_style_pg):
+    assert not delivery_check_and_set("d1", 60)
+    assert delivery_check_and_set("d1", 60)
+    assert not delivery_check_and_set("d2", 60)
+
+    # Entries expire
+    with mock_time(pendulum.now().add(seconds=61)):
+        assert not delivery_check_and_set("d1", 60)
+        assert delivery_check_and_set("d1", 60)
+
+    with mock_time(pendulum.now().add(minutes=10)):
+        expire_seen_deliveries()
+    with retry_txn() as attempts:
+        for session in attempts:
+            remaining = session.query(SeenDelivery).count()
+    assert remaining == 0
+
+
+def test_cached_response(heroku_style_pg):
+    assert load_cached_response("1", "/foo") is None
+    save_cached_response("1", "/foo", b"first")
+    save_cached_response("2", "/foo", b"other")
+    assert load_cached_response("1", "/foo") == b"first"
+    save_cached_response("1", "/foo", b"second")
+    assert load_cached_response("1", "/foo") == b"second"
+    assert load_cached_response("2", "/foo") == b"other"
+
+    with mock_time(pendulum.now().add(seconds=61)):
+        expire_cached_responses(60)
+    assert load_cached_response("1", "/foo") is None
@@ -2,12 +2,16 @@ import pytest
 
 import asks
 import attr
+import cachetools
+import functools
+from snekomatic import gh
 from snekomatic.gh import (
     BaseGithubClient,
     GithubApp,
     reply_url,
     reaction_url,
     get_comment_body,
+    parse_commands,
 )
 import gidgethub
 from gidgethub.sansio import accept_format
@@ -16,9 +20,21 @@ import trio
 import pendulum
 import os
 import json
+import jwt
+import random
+import re
 from pathlib import Path
-
-from .util import fake_webhook, save_environ
+from urllib.parse import parse_qs, urlparse
+
+from .util import (
+    FakeGithubSession,
+    FakeResponse,
+    fake_webhook,
+    mock_time,
+    save_environ,
+    sign_webhook,
+    SlowGithubSession,
+)
 from .credentials import *
 
 SAMPLE_DATA_DIR = Path(__file__).absolute().parent / "sample-data"
@@ -151,11 +167,12 @@ async def test_github_app_webhook_routing(autojump_clock):
 
     app.add_webhook(issue_created, "issue", action="created")
 
-    with pytest.raises(TypeError):
-
-        @app.route_webhook("pull_request", action="created", user="njsmith")
-        async def unnused(event_type, payload, client):  # pragma: no cover
-            pass
+    # Multiple restrictions, including nested fields
+    @app.route_webhook(
+        "pull_request", action="created", **{"sender.login": "njsmith"}
+    )
+    async def pull_request_created_by_njs(event_type, payload, client):
+        record.append(("pull_request_created_by_njs", event_type))
 
     ################################################################
 
@@ -219,6 +236,32 @@ async def test_github_app_webhook_routing(autojump_clock):
 
     ################################################################
 
+    # All restrictions have to match
+    for login in ["njsmith", "someone-else"]:
+        await app.dispatch_webhook(
+            *fake_webhook(
+                "pull_request",
+                {
+                    "action": "created",
+                    "sender": {"login": login},
+                    "installation": {"id": "xyzzy"},
+                },
+                secret=TEST_WEBHOOK_SECRET,
+            )
+        )
+
+    assert sorted(r[0] for r in record) == [
+        "pull_request_all",
+        "pull_request_all",
+        "pull_request_created",
+        "pull_request_created",
+        "pull_request_created_by_njs",
+    ]
+
+    record.clear()
+
+    ################################################################
+
     # Wrong secret
     with pytest.raises(gidgethub.ValidationFailure):
         await app.dispatch_webhook(
@@ -260,6 +303,22 @@ async def test_github_app_webhook_routing(autojump_clock):
 
     record.clear()
 
+    ################################################################
+
+    # Nothing is listening for 'push' webhooks, so we don't even decode the
+    # payload (which would fail here)
+    headers, _ = fake_webhook("push", {}, secret=TEST_WEBHOOK_SECRET)
+    body = b"this is not json"
+    headers["x-hub-signature"] = sign_webhook(body, TEST_WEBHOOK_SECRET)
+    await app.dispatch_webhook(headers, body)
+
+    assert not record
+
+    # ...but if someone is listening, then we do
+    headers["x-github-event"] = "pull_request"
+    with pytest.raises(gidgethub.BadRequest):
+        await app.dispatch_webhook(headers, body)
+
 
 async def test_github_app_webhook_client_works():
     app = GithubApp(
@@ -291,6 +350,1459 @@ async def test_github_app_webhook_client_works():
     assert handler_ran
 
 
+async def test_github_app_dispatch_scheduler(nursery, autojump_clock):
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+        dispatch_delays={"issues": 5},
+    )
+
+    record = []
+
+    @app.route_webhook("pull_request")
+    async def pull_request(event_type, payload, client):
+        record.append((event_type, trio.current_time()))
+        await trio.sleep(10)
+
+    @app.route_webhook("issues")
+    async def issues(event_type, payload, client):
+        record.append((event_type, trio.current_time()))
+
+    @app.route_webhook("check_suite")
+    async def check_suite(event_type, payload, client):
+        record.append((event_type, trio.current_time()))
+
+    assert app.dispatch_delay("pull_request", "opened") == 1
+    assert app.dispatch_delay("issues", "opened") == 5
+    assert app.dispatch_delay("check_suite", "completed") == 0
+    assert app.dispatch_delay("check_suite", "requested") == 1
+
+    await nursery.start(app.run_dispatch_scheduler)
+
+    start = trio.current_time()
+    # (Actions that can't carry /-commands, since these payloads don't have
+    # comment bodies)
+    for event_type, action in [
+        ("issues", "labeled"),
+        ("pull_request", "synchronize"),
+        ("check_suite", "completed"),
+    ]:
+        await app.dispatch_webhook(
+            *fake_webhook(
+                event_type,
+                {
+                    "action": action,
+                    "installation": {"id": TEST_INSTALLATION_ID},
+                },
+                secret=TEST_WEBHOOK_SECRET,
+            )
+        )
+    # dispatch_webhook returned immediately, without waiting for any delays
+    assert trio.current_time() == start
+
+    stats = (await app.stats())["scheduler"]
+    assert stats["depth"] == 3
+    assert stats["in_progress"] == 0
+
+    await trio.sleep(2)
+    assert record == [
+        ("check_suite", start + 0),
+        ("pull_request", start + 1),
+    ]
+    stats = (await app.stats())["scheduler"]
+    assert stats["depth"] == 1
+    # The pull_request handler is still sleeping
+    assert stats["in_progress"] == 1
+
+    await trio.sleep(20)
+    assert record[-1] == ("issues", start + 5)
+    stats = (await app.stats())["scheduler"]
+    assert stats["depth"] == 0
+    assert stats["in_progress"] == 0
+
+
+async def test_dispatch_scheduler_survives_handler_errors(
+    nursery, autojump_clock
+):
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+    )
+    errors = []
+    app.on_dispatch_error = errors.append
+
+    @app.route_webhook("issues")
+    async def first(event_type, payload, client):
+        raise ValueError("first")
+
+    @app.route_webhook("issues")
+    async def second(event_type, payload, client):
+        raise KeyError("second")
+
+    await nursery.start(app.run_dispatch_scheduler)
+
+    for _ in range(2):
+        await app.dispatch_webhook(
+            *fake_webhook(
+                "issues",
+                {"action": "labeled", "installation": {"id": 1}},
+                secret=TEST_WEBHOOK_SECRET,
+            )
+        )
+        await trio.sleep(5)
+
+    # Both handlers' errors were reported, both times; the second delivery
+    # shows the scheduler was still running after the first.
+    assert sorted(type(exc).__name__ for exc in errors) == [
+        "KeyError",
+        "KeyError",
+        "ValueError",
+        "ValueError",
+    ]
+    assert (await app.stats())["admission"]["admitted"] == 0
+
+
+async def test_github_app_admission_control(nursery, autojump_clock):
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+        max_in_flight=1,
+        max_waiting=1,
+        overload_retry_after=17,
+    )
+
+    release = trio.Event()
+    record = []
+
+    @app.route_webhook("pull_request")
+    async def pull_request(event_type, payload, client):
+        record.append(payload["number"])
+        await release.wait()
+
+    @app.route_webhook("issues", max_concurrency=1)
+    async def issues(event_type, payload, client):
+        record.append(payload["number"])
+        await release.wait()
+
+    def make_webhook(event_type, number):
+        return fake_webhook(
+            event_type,
+            {"number": number, "installation": {"id": TEST_INSTALLATION_ID}},
+            secret=TEST_WEBHOOK_SECRET,
+        )
+
+    nursery.start_soon(app.dispatch_webhook, *make_webhook("pull_request", 1))
+    nursery.start_soon(app.dispatch_webhook, *make_webhook("pull_request", 2))
+    await trio.sleep(5)
+    # One is running, and one is waiting for it to finish
+    assert len(record) == 1
+    with pytest.raises(gh.Overloaded) as excinfo:
+        await app.dispatch_webhook(*make_webhook("pull_request", 3))
+    assert excinfo.value.retry_after == 17
+    stats = (await app.stats())["admission"]
+    assert stats["admitted"] == 2
+    assert stats["shed"] == 1
+    assert stats["in_flight"] == 1
+    assert stats["waiting"] == 1
+
+    release.set()
+    await trio.sleep(5)
+    assert sorted(record) == [1, 2]
+    stats = (await app.stats())["admission"]
+    assert stats["admitted"] == 0
+    assert stats["in_flight"] == 0
+    assert stats["waiting"] == 0
+
+    # Per-handler limits
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+    )
+    app.add_webhook(issues, "issues", max_concurrency=1)
+    release = trio.Event()
+    record.clear()
+    for number in [1, 2]:
+        nursery.start_soon(
+            app.dispatch_webhook, *make_webhook("issues", number)
+        )
+    await trio.sleep(5)
+    assert len(record) == 1
+    handler_stats = (await app.stats())["admission"]["handlers"]
+    assert handler_stats[gh._handler_name(issues)] == {
+        "in_flight": 1,
+        "waiting": 1,
+    }
+    release.set()
+    await trio.sleep(5)
+    assert sorted(record) == [1, 2]
+
+    # A handler can only have one limit
+    with pytest.raises(ValueError):
+        app.add_webhook(issues, "pull_request", max_concurrency=2)
+
+
+@attr.s
+class FakeTokenStore:
+    tokens = attr.ib(factory=dict)
+    leases = attr.ib(factory=set)
+
+    async def load(self, installation_id):
+        return self.tokens.get(installation_id)
+
+    async def try_lease(self, installation_id, lease_seconds):
+        if installation_id in self.leases:
+            return False
+        self.leases.add(installation_id)
+        return True
+
+    async def save(self, installation_id, token, expires_at):
+        self.tokens[installation_id] = (token, expires_at)
+        self.leases.discard(installation_id)
+
+    async def release(self, installation_id):
+        self.leases.discard(installation_id)
+
+
+async def test_github_app_token_store(autojump_clock):
+    store = FakeTokenStore()
+    minted = []
+
+    def make_app():
+        app = GithubApp(
+            user_agent=TEST_USER_AGENT,
+            app_id=TEST_APP_ID,
+            private_key=TEST_PRIVATE_KEY,
+            webhook_secret=TEST_WEBHOOK_SECRET,
+            token_store=store,
+        )
+
+        async def fake_mint_token(installation_id):
+            minted.append(installation_id)
+            await trio.sleep(5)
+            if installation_id == 666:
+                raise RuntimeError("nope")
+            return f"token-{len(minted)}", pendulum.now().add(hours=1)
+
+        app._mint_token = fake_mint_token
+        return app
+
+    # Two "processes" need a token at the same time, but only one of them
+    # mints it
+    app1 = make_app()
+    app2 = make_app()
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(app1.token_for, 123)
+        nursery.start_soon(app2.token_for, 123)
+    assert minted == [123]
+    assert await app1.token_for(123) == "token-1"
+    assert await app2.token_for(123) == "token-1"
+
+    # And a new process can pick it up
+    app3 = make_app()
+    assert await app3.token_for(123) == "token-1"
+    assert minted == [123]
+    assert (await app3.stats())["tokens"]["from_store"] == 1
+
+    # If minting fails, the lease is released
+    with pytest.raises(RuntimeError):
+        await app1.token_for(666)
+    assert not store.leases
+
+    # ...and so is saving it
+    async def broken_save(installation_id, token, expires_at):
+        raise RuntimeError("database is down")
+
+    store.save = broken_save
+    with pytest.raises(RuntimeError):
+        await app1.token_for(456)
+    assert not store.leases
+
+
+async def test_github_app_installation_cache(autojump_clock):
+    installations = {"org/a": 1, "org/b": 1, "org/c": 2}
+    api = "https://api.github.com"
+
+    def handler(method, url, headers, body):
+        path = url[len(api) :]
+        if path.startswith("/app/installations/"):
+            installation_id = path.split("/")[3]
+            expires_at = pendulum.now().add(hours=1)
+            return (
+                201,
+                {},
+                {
+                    "token": f"token-for-{installation_id}",
+                    "expires_at": expires_at.to_iso8601_string(),
+                },
+            )
+        if path.startswith("/repos/"):
+            repo = path[len("/repos/") : -len("/installation")]
+            return 200, {}, {"id": installations[repo]}
+        if path.startswith("/installation/repositories"):
+            installation_id = int(headers["authorization"].split("-")[-1])
+            repos = sorted(
+                repo
+                for (repo, id) in installations.items()
+                if id == installation_id
+            )
+            # One repo per page, to exercise pagination
+            query = parse_qs(urlparse(path).query)
+            page = int(query.get("page", ["1"])[0])
+            response_headers = {}
+            if page < len(repos):
+                next_url = f"{api}/installation/repositories?page={page + 1}"
+                response_headers["link"] = f'<{next_url}>; rel="next"'
+            return (
+                200,
+                response_headers,
+                {
+                    "total_count": len(repos),
+                    "repositories": [{"full_name": repos[page - 1]}],
+                },
+            )
+        assert False, url
+
+    session = FakeGithubSession(handler)
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+        session=session,
+    )
+
+    def repo_lookups():
+        return [url for (_, url) in session.requests if "/repos/" in url]
+
+    def list_requests():
+        return [
+            url
+            for (_, url) in session.requests
+            if "/installation/repositories" in url
+        ]
+
+    # repo -> installation only hits the API once (repo names are
+    # case-insensitive)
+    assert await app.installation_id_for_repo("org/a") == 1
+    assert await app.installation_id_for_repo("Org/A") == 1
+    client = await app.client_for_repo("org/a")
+    assert client.installation_id == 1
+    assert len(repo_lookups()) == 1
+
+    # installation -> repos too, and it fills in repo -> installation
+    assert await app.repos_for_installation(1) == ["org/a", "org/b"]
+    assert await app.repos_for_installation(1) == ["org/a", "org/b"]
+    assert len(list_requests()) == 2
+    assert await app.installation_id_for_repo("org/b") == 1
+    assert await app.installation_id_for_repo("org/c") == 2
+    assert len(repo_lookups()) == 2
+
+    async def send(event_type, payload):
+        await app.dispatch_webhook(
+            *fake_webhook(event_type, payload, secret=TEST_WEBHOOK_SECRET)
+        )
+
+    # Moving a repo to another installation invalidates both sides
+    installations["org/b"] = 2
+    await send(
+        "installation_repositories",
+        {
+            "action": "removed",
+            "installation": {"id": 1},
+            "repositories_removed": [{"full_name": "org/b"}],
+        },
+    )
+    assert await app.installation_id_for_repo("org/b") == 2
+    assert await app.repos_for_installation(1) == ["org/a"]
+    assert len(repo_lookups()) == 3
+    assert len(list_requests()) == 3
+
+    # Uninstalling forgets everything about the installation
+    await send(
+        "installation", {"action": "deleted", "installation": {"id": 2}}
+    )
+    assert await app.installation_id_for_repo("org/c") == 2
+    assert len(repo_lookups()) == 4
+
+    assert (await app.stats())["installations"] == {
+        "hits": 4,
+        "misses": 6,
+        "invalidations": 2,
+    }
+
+
+async def test_asks_handles_304(nursery):
+    # https://github.com/theelous3/asks/issues/133
+    async def serve(stream):
+        while await stream.receive_some(10000):
+            await stream.send_all(
+                b"HTTP/1.1 304 Not Modified\r\n"
+                b'ETag: "abc"\r\n'
+                b"Content-Length: 0\r\n\r\n"
+            )
+
+    listeners = await nursery.start(trio.serve_tcp, serve, 0)
+    port = listeners[0].socket.getsockname()[1]
+    session = asks.Session()
+    for _ in range(2):
+        response = await session.get(
+            f"http://127.0.0.1:{port}/", headers={"If-None-Match": '"abc"'}
+        )
+        assert response.status_code == 304
+
+
+async def test_github_app_response_cache(autojump_clock):
+    api = "https://api.github.com"
+    etags = {"/small": '"small-1"', "/big": '"big-1"'}
+    sent_etags = []
+
+    def handler(method, url, headers, body):
+        path = url[len(api) :]
+        if path.startswith("/app/installations/"):
+            expires_at = pendulum.now().add(hours=1)
+            return (
+                201,
+                {},
+                {"token": "t", "expires_at": expires_at.to_iso8601_string()},
+            )
+        sent_etags.append(headers.get("if-none-match"))
+        etag = etags[path]
+        if headers.get("if-none-match") == etag:
+            return 304, {"etag": etag}, None
+        padding = "x" * (5000 if path == "/big" else 1000)
+        return 200, {"etag": etag}, {"etag": etag, "padding": padding}
+
+    class DictBackend:
+        def __init__(self):
+            self.saved = {}
+
+        async def load(self, segment, url):
+            return self.saved.get((segment, url))
+
+        async def save(self, segment, url, entry):
+            self.saved[segment, url] = entry
+
+    backend = DictBackend()
+
+    def make_app():
+        return GithubApp(
+            user_agent=TEST_USER_AGENT,
+            app_id=TEST_APP_ID,
+            private_key=TEST_PRIVATE_KEY,
+            webhook_secret=TEST_WEBHOOK_SECRET,
+            session=FakeGithubSession(handler),
+            # Room for two small responses, but not three
+            cache_max_bytes=2500,
+            response_cache_backend=backend,
+        )
+
+    app = make_app()
+    client = app.client_for_installation_id(1)
+    first = await client.getitem("/small")
+    assert first["etag"] == '"small-1"'
+    # Second time is a conditional request, and Github says 304
+    assert await client.getitem("/small") == first
+    assert sent_etags == [None, '"small-1"']
+
+    # Once it changes, we get the new version
+    etags["/small"] = '"small-2"'
+    assert (await client.getitem("/small"))["etag"] == '"small-2"'
+    assert sent_etags[-1] == '"small-1"'
+
+    # Other installations (and the app itself) have their own cache entries
+    await app.client_for_installation_id(2).getitem("/small")
+    await app.app_client.getitem("/small")
+    assert sent_etags[-2:] == [None, None]
+
+    # Responses that are too big for the whole cache just aren't cached
+    await client.getitem("/big")
+    await client.getitem("/big")
+    assert sent_etags[-2:] == [None, None]
+
+    stats = (await app.stats())["response_cache"]
+    assert stats["not_modified"] == 1
+    assert stats["conditional_requests"] == 2
+    assert stats["entries"] == 2
+    assert stats["bytes"] <= 2500
+
+    # The backend has everything, so a new process gets 304s right away
+    assert (1, api + "/small") in backend.saved
+    app2 = make_app()
+    sent_etags.clear()
+    assert (await app2.client_for_installation_id(1).getitem("/small"))[
+        "etag"
+    ] == '"small-2"'
+    assert sent_etags == ['"small-2"']
+    assert (await app2.stats())["response_cache"]["backend_loads"] == 1
+
+
+async def test_github_app_rate_limit_scheduler(nursery, autojump_clock):
+    start = pendulum.now()
+    reset = start.add(hours=1).int_timestamp
+    quota = {"remaining": 4}
+    secondary_limited = []
+
+    def handler(method, url, headers, body):
+        if "/app/installations/" in url:
+            expires_at = start.add(hours=2).to_iso8601_string()
+            return 201, {}, {"token": "t", "expires_at": expires_at}
+        if url.endswith("/limited") and not secondary_limited:
+            secondary_limited.append(url)
+            return 403, {"retry-after": "60"}, {"message": "slow down"}
+        quota["remaining"] -= 1
+        rate_headers = {
+            "x-ratelimit-limit": "5000",
+            "x-ratelimit-remaining": str(quota["remaining"]),
+            "x-ratelimit-reset": str(reset),
+        }
+        return 200, rate_headers, {"ok": True}
+
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+        session=FakeGithubSession(handler),
+        rate_limit_reserve=2,
+    )
+
+    with mock_time(start):
+        t0 = trio.current_time()
+        client = app.client_for_installation_id(1)
+        await client.getitem("/a")
+        await trio.sleep(60)
+        # Down to the reserve now
+        await client.getitem("/a")
+
+        done = []
+
+        async def background_get():
+            background_client = app.client_for_installation_id(
+                1, priority=gh.PRIORITY_BACKGROUND
+            )
+            await background_client.getitem("/b")
+            done.append(trio.current_time())
+
+        nursery.start_soon(background_get)
+        await trio.sleep(10)
+        assert not done
+        stats = (await app.stats())["rate_limits"]
+        assert stats["waiting"] == 1
+        assert stats["installations"]["1"]["waiting"] == 1
+        assert stats["installations"]["1"]["remaining"] == 2
+        # Our clock moved on, but Github's didn't
+        # (Github's reset time only has 1 second resolution)
+        assert stats["installations"]["1"]["resets_in"] == pytest.approx(
+            3600 + 60 - 70, abs=1
+        )
+        # 1 request in 70 seconds, 2 left -> 140 seconds
+        assert stats["installations"]["1"]["exhausts_in"] == pytest.approx(
+            140
+        )
+
+        # Interactive requests can dip into the reserve
+        interactive_client = app.client_for_installation_id(
+            1, priority=gh.PRIORITY_INTERACTIVE
+        )
+        await interactive_client.getitem("/a")
+        assert not done
+
+        # Once the quota resets, the background request goes through
+        quota["remaining"] = 5000
+        await trio.sleep(3601)
+        assert done == [pytest.approx(t0 + 70 + 3600, abs=1)]
+
+        # Secondary rate limits are retried after Retry-After
+        before = trio.current_time()
+        assert await client.getitem("/limited") == {"ok": True}
+        assert trio.current_time() - before == pytest.approx(60)
+        stats = (await app.stats())["rate_limits"]
+        assert stats["retry_afters"] == 1
+        assert stats["throttled"] == 2
+        assert stats["waiting"] == 0
+
+
+async def test_github_app_rate_limits_per_resource(autojump_clock):
+    reset = pendulum.now().add(hours=1).int_timestamp
+
+    def handler(method, url, headers, body):
+        if "/app/installations/" in url:
+            expires_at = pendulum.now().add(hours=2).to_iso8601_string()
+            return 201, {}, {"token": "t", "expires_at": expires_at}
+        if url.endswith("/graphql"):
+            # Nearly out of GraphQL points...
+            resource, remaining = "graphql", "1"
+            response = {"data": {"viewer": {"login": "snekomatic"}}}
+        else:
+            # ...but plenty of core quota left
+            resource, remaining = "core", "4000"
+            response = {"ok": True}
+        rate_headers = {
+            "x-ratelimit-limit": "5000",
+            "x-ratelimit-remaining": remaining,
+            "x-ratelimit-reset": str(reset),
+            "x-ratelimit-resource": resource,
+        }
+        return 200, rate_headers, response
+
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+        session=FakeGithubSession(handler),
+    )
+    client = app.client_for_installation_id(
+        1, priority=gh.PRIORITY_BACKGROUND
+    )
+    await client.getitem("/a")
+    await client.graphql("query { viewer { login } }")
+
+    # REST requests don't wait for the GraphQL quota to reset
+    before = trio.current_time()
+    await client.getitem("/a")
+    assert trio.current_time() == before
+    stats = (await app.stats())["rate_limits"]
+    assert stats["installations"]["1"]["remaining"] == 4000
+    assert stats["installations"]["1/graphql"]["remaining"] == 1
+    assert stats["throttled"] == 0
+
+
+async def test_github_app_coalesces_gets(autojump_clock):
+    def handler(method, url, headers, body):
+        if "/app/installations/" in url:
+            expires_at = pendulum.now().add(hours=1).to_iso8601_string()
+            token = "token-for-" + url.split("/")[-2]
+            return 201, {}, {"token": token, "expires_at": expires_at}
+        if url.endswith("/missing"):
+            return 404, {}, {"message": "Not Found"}
+        return 200, {}, {"url": url, "accept": headers["accept"]}
+
+    session = SlowGithubSession(handler)
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+        session=session,
+    )
+    # Make sure the token is already there, so the requests all start at
+    # the same time
+    await app.token_for(1)
+    session.requests.clear()
+
+    results = []
+    errors = []
+
+    async def get(installation_id, url, **kwargs):
+        client = app.client_for_installation_id(installation_id)
+        try:
+            results.append(await client.getitem(url, **kwargs))
+        except gidgethub.BadRequest as exc:
+            errors.append(exc)
+
+    async with trio.open_nursery() as nursery:
+        for _ in range(5):
+            nursery.start_soon(get, 1, "/same")
+        # Different Accept
+        nursery.start_soon(
+            functools.partial(
+                get, 1, "/same", accept=accept_format(version="preview")
+            )
+        )
+        # Opted out
+        nursery.start_soon(functools.partial(get, 1, "/same", coalesce=False))
+        # Errors fan out too
+        for _ in range(3):
+            nursery.start_soon(get, 1, "/missing")
+
+    api = "https://api.github.com"
+    assert sorted(session.requests) == [
+        ("GET", api + "/missing"),
+        ("GET", api + "/same"),
+        ("GET", api + "/same"),
+        ("GET", api + "/same"),
+    ]
+    assert len(results) == 7
+    assert len(errors) == 3
+    assert (await app.stats())["coalescing"] == {
+        "requests": 3,
+        "coalesced": 6,
+        "in_flight": 0,
+    }
+
+    # Different installations have different credentials, so they don't
+    # share requests
+    session.requests.clear()
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(get, 1, "/same")
+        nursery.start_soon(get, 2, "/same")
+    assert [r for r in session.requests if r[1].endswith("/same")] == [
+        ("GET", api + "/same")
+    ] * 2
+
+    # Nor do requests with different priorities, or charged to different
+    # routes
+    async def get_with(url, **kwargs):
+        client = app.client_for_installation_id(1, **kwargs)
+        results.append(await client.getitem(url))
+
+    session.requests.clear()
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(get_with, "/same")
+        nursery.start_soon(
+            functools.partial(
+                get_with, "/same", priority=gh.PRIORITY_INTERACTIVE
+            )
+        )
+        nursery.start_soon(functools.partial(get_with, "/same", route="a"))
+        nursery.start_soon(functools.partial(get_with, "/same", route="a"))
+    assert len(session.requests) == 3
+
+    # And requests that aren't in flight at the same time aren't merged
+    session.requests.clear()
+    await get(1, "/same")
+    await get(1, "/same")
+    assert len(session.requests) == 2
+
+
+async def test_getiter_prefetch(autojump_clock):
+    api = "https://api.github.com"
+    pages = 10
+    cursor_pages = False
+
+    def handler(method, url, headers, body):
+        query = parse_qs(urlparse(url).query)
+        page = int(query.get("page", ["1"])[0])
+        links = []
+        if page < pages:
+            links.append(
+                f'<{api}/items?page={page + 1}&per_page=2>; rel="next"'
+            )
+            if not cursor_pages:
+                links.append(
+                    f'<{api}/items?page={pages}&per_page=2>; rel="last"'
+                )
+        if page > 1:
+            links.append(f'<{api}/items?page=1&per_page=2>; rel="first"')
+        response_headers = {"link": ", ".join(links)} if links else {}
+        return 200, response_headers, [2 * page - 1, 2 * page]
+
+    session = SlowGithubSession(handler)
+    client = BaseGithubClient(session, requester=TEST_USER_AGENT)
+
+    async def get_all(**kwargs):
+        start = trio.current_time()
+        items = [item async for item in client.getiter("/items", **kwargs)]
+        return items, trio.current_time() - start
+
+    # The first page tells us there are 9 more, which we get 4 at a time
+    items, elapsed = await get_all(prefetch=4)
+    assert items == list(range(1, 2 * pages + 1))
+    assert elapsed == pytest.approx(1 + 3)
+    assert len(session.requests) == pages
+
+    # If you stop early, we don't fetch the rest
+    session.requests.clear()
+    async for item in client.getiter("/items", prefetch=4):
+        if item == 3:
+            break
+    assert len(session.requests) == 1 + 4
+
+    # Without prefetching, or without a "last" link, it's one page at a time
+    items, elapsed = await get_all(prefetch=1)
+    assert items == list(range(1, 2 * pages + 1))
+    assert elapsed == pytest.approx(pages)
+    cursor_pages = True
+    items, elapsed = await get_all(prefetch=4)
+    assert items == list(range(1, 2 * pages + 1))
+    assert elapsed == pytest.approx(pages)
+    cursor_pages = False
+
+    # If the listing grows while we're fetching it, we still get all of it
+    async for item in client.getiter("/items", prefetch=4):
+        if item == 1:
+            pages = 12
+    assert item == 24
+
+
+async def test_github_app_graphql_batching(autojump_clock):
+    queries = []
+
+    def handler(method, url, headers, body):
+        if "/app/installations/" in url:
+            expires_at = pendulum.now().add(hours=1).to_iso8601_string()
+            return 201, {}, {"token": "t", "expires_at": expires_at}
+        assert (method, url) == ("POST", "https://api.github.com/graphql")
+        query = json.loads(body)["query"]
+        queries.append(query)
+        data = {}
+        errors = []
+        for alias, login in re.findall(
+            r'(q\d+): user\(login: ("(?:[^"\\]|\\.)*")\)', query
+        ):
+            login = json.loads(login)
+            if login == "ghost":
+                data[alias] = None
+                errors.append({"path": [alias], "message": "no such user"})
+            else:
+                data[alias] = {"login": login}
+        return 200, {}, {"data": data, "errors": errors}
+
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+        session=SlowGithubSession(handler),
+        graphql_max_batch=4,
+    )
+    await app.token_for(1)
+
+    results = {}
+
+    async def lookup(login):
+        client = app.client_for_installation_id(1)
+        try:
+            results[login] = await client.graphql_lookup(
+                "user(login: $login) { login }", login=login
+            )
+        except gh.GraphQLError as exc:
+            results[login] = exc
+
+    logins = ["alice", "bob", 'quote"y', "ghost", "carol", "dave"]
+    async with trio.open_nursery() as nursery:
+        for login in logins:
+            nursery.start_soon(lookup, login)
+
+    # Two batches, because there's only room for 4 in each
+    assert len(queries) == 2
+    assert queries[0].startswith("query {\n  q0: user(login: ")
+    for login in logins:
+        if login == "ghost":
+            assert isinstance(results[login], gh.GraphQLError)
+            assert str(results[login]) == "no such user"
+        else:
+            assert results[login] == {"login": login}
+    assert (await app.stats())["graphql"] == {
+        "lookups": 6,
+        "batches": 2,
+        "largest_batch": 4,
+    }
+
+    # Lookups that aren't concurrent go on their own
+    await lookup("erin")
+    assert len(queries) == 3
+
+    # Plain queries work too
+    client = app.client_for_installation_id(1)
+    data = await client.graphql(
+        'query { q0: user(login: "frank") { login } }'
+    )
+    assert data == {"q0": {"login": "frank"}}
+    with pytest.raises(gh.GraphQLError):
+        await client.graphql('query { q0: user(login: "ghost") { login } }')
+
+
+async def test_github_app_retries_and_hedging(autojump_clock):
+    # For each request to /x: (seconds to respond, status or exception)
+    script = []
+    requests = []
+
+    class ScriptedSession:
+        async def request(self, method, url, *, headers, data):
+            json_headers = {"content-type": "application/json"}
+            if "/app/installations/" in url:
+                expires_at = pendulum.now().add(hours=1).to_iso8601_string()
+                content = json.dumps({"token": "t", "expires_at": expires_at})
+                return FakeResponse(201, json_headers, content.encode())
+            requests.append(method)
+            delay, outcome = script.pop(0) if script else (1, 200)
+            await trio.sleep(delay)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return FakeResponse(outcome, json_headers, b'{"ok": true}')
+
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+        session=ScriptedSession(),
+        request_timeout=10,
+        hedge_requests=True,
+    )
+    await app.token_for(1)
+    client = app.client_for_installation_id(1)
+    metrics_before = {
+        "status": gh.GITHUB_REQUEST_RETRIES.value("status"),
+        "error": gh.GITHUB_REQUEST_RETRIES.value("error"),
+        "timeout": gh.GITHUB_REQUEST_RETRIES.value("timeout"),
+        "timeouts": gh.GITHUB_REQUEST_TIMEOUTS.value(),
+        "won": gh.GITHUB_REQUEST_HEDGES.value("won"),
+    }
+
+    async def attempt(async_fn, *args, **kwargs):
+        requests.clear()
+        start = trio.current_time()
+        await async_fn("/x", *args, **kwargs)
+        return len(requests), trio.current_time() - start
+
+    # Server errors and connection errors get retried
+    script[:] = [(1, 502)]
+    assert (await attempt(client.getitem))[0] == 2
+    script[:] = [(1, OSError("connection reset"))]
+    assert (await attempt(client.getitem))[0] == 2
+    # ...but only for requests that are safe to repeat
+    script[:] = [(1, 502)]
+    with pytest.raises(gidgethub.GitHubBroken):
+        await attempt(client.post, data={})
+    assert len(requests) == 1
+    # ...and only so many times
+    script[:] = [(1, 503)] * 3
+    with pytest.raises(gidgethub.GitHubBroken):
+        await attempt(client.getitem)
+    assert len(requests) == 3
+
+    # Attempts that take too long count as errors
+    script[:] = [(60, 200)]
+    count, elapsed = await attempt(client.getitem)
+    assert count == 2
+    assert elapsed < 15
+
+    # Once we know how long GETs usually take, slow ones get hedged
+    assert (await app.stats())["requests"]["hedge_after"] is None
+    # (With the fake clock, the usual requests take exactly as long as the
+    # hedging delay, so they'd be hedged too.)
+    app._retry_policy.hedge = False
+    for _ in range(20):
+        await client.getitem("/x")
+    app._retry_policy.hedge = True
+    assert (await app.stats())["requests"]["hedge_after"] == pytest.approx(1)
+    script[:] = [(100, 200)]
+    count, elapsed = await attempt(client.getitem)
+    assert count == 2
+    assert elapsed == pytest.approx(2)
+
+    stats = (await app.stats())["requests"]
+    assert stats["retries"] == 5
+    assert stats["timeouts"] == 1
+    assert stats["hedges"] == 1
+    assert stats["hedge_wins"] == 1
+
+    # And the same goes for /metrics
+    assert {
+        "status": gh.GITHUB_REQUEST_RETRIES.value("status") - 3,
+        "error": gh.GITHUB_REQUEST_RETRIES.value("error") - 1,
+        "timeout": gh.GITHUB_REQUEST_RETRIES.value("timeout") - 1,
+        "timeouts": gh.GITHUB_REQUEST_TIMEOUTS.value() - 1,
+        "won": gh.GITHUB_REQUEST_HEDGES.value("won") - 1,
+    } == metrics_before
+
+
+def test_url_template():
+    api = "https://api.github.com"
+    for url, template in [
+        (
+            api + "/repos/python-trio/trio/issues/123/comments?per_page=100",
+            "/repos/{owner}/{repo}/issues/{id}/comments",
+        ),
+        (
+            "/app/installations/1541311/access_tokens",
+            "/app/installations/{id}/access_tokens",
+        ),
+        (
+            api + "/orgs/python-trio/memberships/njsmith",
+            "/orgs/{org}/memberships/{user}",
+        ),
+        (
+            "/repos/a/b/actions/secrets/public-key",
+            "/repos/{owner}/{repo}/actions/secrets/public-key",
+        ),
+        (
+            "/repos/a/b/actions/secrets/SECRET",
+            "/repos/{owner}/{repo}/actions/secrets/{name}",
+        ),
+        (
+            "/repos/a/b/commits/" + "a1" * 20,
+            "/repos/{owner}/{repo}/commits/{sha}",
+        ),
+        ("/installation/repositories", "/installation/repositories"),
+    ]:
+        assert gh._url_template(url) == template
+
+
+async def test_github_app_metrics(autojump_clock):
+    def handler(method, url, headers, body):
+        if "/app/installations/" in url:
+            expires_at = pendulum.now().add(hours=1).to_iso8601_string()
+            return 201, {}, {"token": "t", "expires_at": expires_at}
+        if url.endswith("/missing"):
+            return 404, {}, {"message": "Not Found"}
+        return 200, {}, {}
+
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+        session=SlowGithubSession(handler),
+    )
+
+    @app.route_webhook("issues")
+    async def good_handler(event_type, payload, client):
+        await client.getitem("/repos/a/b/issues/1")
+
+    @app.route_webhook("issues")
+    async def bad_handler(event_type, payload, client):
+        # Give good_handler a chance to finish before we crash
+        await trio.sleep(5)
+        await client.getitem("/repos/a/b/issues/2/missing")
+
+    requests = gh.GITHUB_REQUESTS
+    handlers = gh.HANDLER_DURATION
+    issue = ("GET", "/repos/{owner}/{repo}/issues/{id}")
+    missing = ("GET", "/repos/{owner}/{repo}/issues/{id}/missing")
+    token = ("POST", "/app/installations/{id}/access_tokens", "201")
+    good = ("issues", gh._handler_name(good_handler))
+    bad = ("issues", gh._handler_name(bad_handler))
+    before = {
+        "ok": requests.count(*issue, "200"),
+        "missing": requests.count(*missing, "404"),
+        "token": requests.count(*token),
+        "minted": gh.GITHUB_TOKENS.value("minted"),
+    }
+
+    # Signing the app JWT happens in a thread, which doesn't mix well with
+    # the autojump clock, so get the token out of the way first.
+    await app.token_for(1)
+    assert requests.count(*token) == before["token"] + 1
+    assert gh.GITHUB_TOKENS.value("minted") == before["minted"] + 1
+
+    with pytest.raises(gidgethub.BadRequest):
+        await app.dispatch_webhook(
+            *fake_webhook(
+                "issues",
+                {"installation": {"id": 1}},
+                secret=TEST_WEBHOOK_SECRET,
+            )
+        )
+
+    assert requests.count(*issue, "200") == before["ok"] + 1
+    assert requests.count(*missing, "404") == before["missing"] + 1
+    assert handlers.count(*good, "ok") == 1
+    assert handlers.count(*bad, "error") == 1
+
+
+async def test_github_app_route_quotas(autojump_clock):
+    def handler(method, url, headers, body):
+        if "/app/installations/" in url:
+            expires_at = pendulum.now().add(hours=1).to_iso8601_string()
+            return 201, {}, {"token": "t", "expires_at": expires_at}
+        if headers.get("if-none-match") == '"x"':
+            return 304, {"etag": '"x"'}, None
+        return 200, {"etag": '"x"'}, {"url": url}
+
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+        session=FakeGithubSession(handler),
+        route_budget_action="defer",
+    )
+    await app.token_for(1)
+
+    finished_at = {}
+
+    @app.route_webhook("issues")
+    async def chatty(event_type, payload, client):
+        for i in range(3):
+            await client.getitem(f"/chatty/{i}")
+        finished_at["chatty"] = trio.current_time()
+
+    @app.route_webhook("issues")
+    async def quiet(event_type, payload, client):
+        await client.getitem("/quiet")
+        finished_at["quiet"] = trio.current_time()
+
+    chatty_name = gh._handler_name(chatty)
+    quiet_name = gh._handler_name(quiet)
+    app.route_quotas.budgets[chatty_name] = 2
+
+    start = trio.current_time()
+    await app.dispatch_webhook(
+        *fake_webhook(
+            "issues", {"installation": {"id": 1}}, secret=TEST_WEBHOOK_SECRET
+        )
+    )
+    # chatty's third request waited for the next hour; quiet wasn't held up
+    assert finished_at["chatty"] - start >= 60 * 60
+    assert finished_at["quiet"] - start < 60
+
+    # Requests outside a handler can name themselves, or go unattributed
+    app._installation_cache.remember_repo(
+        app._installation_cache.generation, "a/b", 1
+    )
+    poller = await app.client_for_repo("a/b", route="poller")
+    await poller.getitem("/polled")
+    # 304s are free
+    await poller.getitem("/polled")
+    await app.client_for_installation_id(1).getitem("/other")
+
+    report = await app.quota_report()
+    routes = {r["route"]: r for r in report["1"]["top_routes"]}
+    assert routes[chatty_name]["spent_this_hour"] == 1
+    assert routes[chatty_name]["spent"] == 3
+    assert routes[chatty_name]["budget"] == 2
+    assert routes[chatty_name]["deferred"] == 1
+    assert routes[quiet_name]["spent"] == 1
+    assert routes["poller"]["sent"] == 2
+    assert routes["poller"]["spent"] == 1
+    assert routes["poller"]["not_modified"] == 1
+    assert routes[gh.UNATTRIBUTED]["spent"] == 1
+    top = (await app.quota_report(top=1))["1"]["top_routes"]
+    # Ties in this hour go to whoever has spent more overall
+    assert [r["route"] for r in top] == [chatty_name]
+    assert app.route_quotas.stats()["rejected"] == 0
+
+    # By default, over-budget requests fail fast
+    assert gh.RouteQuotas().action == "reject"
+    app.route_quotas.action = "reject"
+    app.route_quotas.budgets["poller"] = 2
+    await poller.getitem("/polled-again")
+    with pytest.raises(gh.BudgetExceeded) as exc_info:
+        await poller.getitem("/polled-once-more")
+    assert exc_info.value.route == "poller"
+    assert exc_info.value.installation == "1"
+    assert 0 < exc_info.value.retry_after <= 60 * 60
+
+    with pytest.raises(ValueError):
+        GithubApp(route_budget_action="ignore")
+
+
+async def test_github_app_client_pool(autojump_clock):
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+        client_pool_size=3,
+    )
+
+    clients = []
+
+    @app.route_webhook("issues")
+    async def handler(event_type, payload, client):
+        clients.append(client)
+
+    for _ in range(2):
+        await app.dispatch_webhook(
+            *fake_webhook(
+                "issues",
+                {"installation": {"id": 1}},
+                secret=TEST_WEBHOOK_SECRET,
+            )
+        )
+    # Both deliveries got the same client
+    assert clients[0] is clients[1]
+    assert app.client_for_installation_id(1) is clients[0]
+    # Different priorities and routes get their own
+    interactive = app.client_for_installation_id(
+        1, priority=gh.PRIORITY_INTERACTIVE
+    )
+    assert interactive is not clients[0]
+    assert interactive.priority == gh.PRIORITY_INTERACTIVE
+    poller = app.client_for_installation_id(1, route="poller")
+    assert poller.route == "poller"
+    assert app.client_for_installation_id(2) is not clients[0]
+    assert (await app.stats())["clients"]["pooled"] == 3
+
+    # Uninstalling drops the installation's clients
+    await app.dispatch_webhook(
+        *fake_webhook(
+            "installation",
+            {"action": "deleted", "installation": {"id": 1}},
+            secret=TEST_WEBHOOK_SECRET,
+        )
+    )
+    assert app.client_for_installation_id(1) is not clients[0]
+
+    # Idle clients expire
+    now = [0]
+    pool = gh.ClientPool(cachetools.TTLCache(10, 60, timer=lambda: now[0]))
+    first = pool.get(1, object)
+    now[0] = 50
+    assert pool.get(1, object) is first
+    now[0] = 100
+    assert pool.get(1, object) is first
+    now[0] = 200
+    assert pool.get(1, object) is not first
+    assert pool.stats() == {"pooled": 1, "created": 2, "reused": 2}
+
+
+async def test_github_app_jwt_cache(autojump_clock):
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+    )
+
+    start = pendulum.now()
+    with mock_time(start):
+        tokens = []
+
+        async def get_jwt():
+            tokens.append(await app.app_jwt())
+
+        # A burst of app-level requests only signs one JWT
+        async with trio.open_nursery() as nursery:
+            for _ in range(10):
+                nursery.start_soon(get_jwt)
+        assert len(set(tokens)) == 1
+        assert (await app.stats())["app_jwt"] == {"signed": 1, "reused": 9}
+
+        claims = jwt.decode(tokens[0], verify=False)
+        assert claims["iss"] == TEST_APP_ID
+        assert claims["iat"] <= start.int_timestamp
+        assert claims["exp"] <= start.add(minutes=10).int_timestamp
+
+    # Still good for a while
+    with mock_time(start.add(minutes=7)):
+        assert await app.app_jwt() == tokens[0]
+    # But eventually gets replaced
+    with mock_time(start.add(minutes=9)):
+        assert await app.app_jwt() != tokens[0]
+    assert (await app.stats())["app_jwt"] == {"signed": 2, "reused": 10}
+
+
+async def test_github_app_token_refresher(nursery, autojump_clock):
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+    )
+    minted = []
+    fail = False
+
+    async def fake_mint_token(installation_id):
+        minted.append(installation_id)
+        await trio.sleep(2)
+        if fail:
+            raise RuntimeError("nope")
+        return f"token-{len(minted)}", pendulum.now().add(hours=1)
+
+    app._mint_token = fake_mint_token
+
+    start = pendulum.now()
+    # Installation 2 was last used long ago, so the refresher ignores it
+    with mock_time(start.subtract(hours=2)):
+        assert await app.token_for(2) == "token-1"
+    with mock_time(start):
+        assert await app.token_for(1) == "token-2"
+    await nursery.start(app.run_token_refresher)
+
+    # Nothing is due yet
+    with mock_time(start.add(minutes=30)):
+        await trio.sleep(120)
+    assert minted == [2, 1]
+
+    # Due, but the refresh fails; token_for still has a usable token
+    fail = True
+    with mock_time(start.add(minutes=55)):
+        await trio.sleep(120)
+        assert await app.token_for(1) == "token-2"
+    fail = False
+    stats = (await app.stats())["tokens"]
+    assert stats["background_failures"] > 0
+    assert stats["background_refreshes"] == 0
+
+    # Once Github cooperates again, it gets renewed in the background, and
+    # the request path doesn't wait
+    with mock_time(start.add(minutes=56)):
+        await trio.sleep(120)
+        mint_count = len(minted)
+        assert await app.token_for(1) == f"token-{mint_count}"
+    assert len(minted) == mint_count
+    assert minted.count(2) == 1
+    stats = (await app.stats())["tokens"]
+    assert stats["background_refreshes"] == 1
+    assert stats["last_refresh_seconds"] == pytest.approx(2, abs=0.1)
+    assert stats["on_demand_refreshes"] == 2
+
+
+async def test_github_app_token_refresher_concurrency(
+    nursery, autojump_clock
+):
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+    )
+    minting = 0
+    max_minting = 0
+    start = pendulum.now()
+
+    async def fake_mint_token(installation_id):
+        nonlocal minting, max_minting
+        minting += 1
+        max_minting = max(max_minting, minting)
+        try:
+            # Once the tokens are due, installation 0 hangs
+            if installation_id == 0 and pendulum.now() > start:
+                await trio.sleep_forever()
+            await trio.sleep(2)
+            return f"token-{installation_id}", pendulum.now().add(hours=1)
+        finally:
+            minting -= 1
+
+    app._mint_token = fake_mint_token
+
+    count = 2 * gh.TOKEN_REFRESH_CONCURRENCY
+    with mock_time(start):
+        for installation_id in range(count):
+            await app.token_for(installation_id)
+    max_minting = 0
+    await nursery.start(app.run_token_refresher)
+
+    with mock_time(start.add(minutes=55)):
+        # Long enough for one pass, but not the next one
+        await trio.sleep(
+            gh.TOKEN_REFRESH_INTERVAL + gh.TOKEN_REFRESH_TIMEOUT + 30
+        )
+    assert max_minting == gh.TOKEN_REFRESH_CONCURRENCY
+    # The pass finished, even though one renewal never did
+    stats = (await app.stats())["tokens"]
+    assert stats["background_refreshes"] == count - 1
+    assert stats["background_failures"] == 1
+    assert app._installation_tokens[0].refresh_event is None
+
+
+async def test_github_app_delivery_dedup(autojump_clock):
+    backend_seen = {"from-another-process"}
+
+    async def backend(delivery_id):
+        if delivery_id in backend_seen:
+            return True
+        backend_seen.add(delivery_id)
+        return False
+
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+        dedup_cache_size=1,
+        delivery_dedup_backend=backend,
+    )
+
+    record = []
+
+    @app.route_webhook("pull_request")
+    async def handler(event_type, payload, client):
+        record.append(payload["number"])
+
+    def make_webhook(number):
+        return fake_webhook(
+            "pull_request",
+            {"number": number, "installation": {"id": TEST_INSTALLATION_ID}},
+            secret=TEST_WEBHOOK_SECRET,
+        )
+
+    first = make_webhook(1)
+    await app.dispatch_webhook(*first)
+    # Redelivery is caught by the in-memory cache
+    await app.dispatch_webhook(*first)
+    assert record == [1]
+
+    # A new delivery pushes the first one out of the (tiny) memory cache, but
+    # the backend still remembers it
+    await app.dispatch_webhook(*make_webhook(2))
+    await app.dispatch_webhook(*first)
+    assert record == [1, 2]
+
+    # And the backend can know about deliveries we've never seen
+    headers, body = make_webhook(3)
+    headers["x-github-delivery"] = "from-another-process"
+    await app.dispatch_webhook(headers, body)
+    assert record == [1, 2]
+
+    assert (await app.stats())["dedup"] == {
+        "memory_hits": 1,
+        "backend_hits": 2,
+        "misses": 2,
+    }
+
+
+async def test_github_app_delivery_dedup_forgets_failures(autojump_clock):
+    backend_seen = set()
+    backend_broken = False
+
+    async def backend(delivery_id):
+        if backend_broken:
+            raise RuntimeError("database is down")
+        if delivery_id in backend_seen:
+            return True
+        backend_seen.add(delivery_id)
+        return False
+
+    async def forget_backend(delivery_id):
+        backend_seen.discard(delivery_id)
+
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+        delivery_dedup_backend=backend,
+        delivery_dedup_forget=forget_backend,
+    )
+
+    record = []
+
+    @app.route_webhook("pull_request")
+    async def handler(event_type, payload, client):
+        record.append(payload["number"])
+        if len(record) == 1:
+            raise ValueError("flaky handler")
+
+    webhook = fake_webhook(
+        "pull_request",
+        {"number": 1, "installation": {"id": TEST_INSTALLATION_ID}},
+        secret=TEST_WEBHOOK_SECRET,
+    )
+
+    # The handler fails, so Github will redeliver it, and the redelivery
+    # isn't dropped as a duplicate
+    with pytest.raises(ValueError):
+        await app.dispatch_webhook(*webhook)
+    assert backend_seen == set()
+    await app.dispatch_webhook(*webhook)
+    assert record == [1, 1]
+    assert backend_seen == {webhook[0]["x-github-delivery"]}
+
+    # Same if we can't even check whether it's a duplicate
+    backend_broken = True
+    headers, body = webhook
+    headers["x-github-delivery"] = "another-delivery"
+    with pytest.raises(RuntimeError):
+        await app.dispatch_webhook(headers, body)
+    backend_broken = False
+    await app.dispatch_webhook(headers, body)
+    assert record == [1, 1, 1]
+
+
 @attr.s
 class WebhookScenario(object):
     test_data = attr.ib()
@@ -445,13 +1957,17 @@ command_scenarios = [
 ]
 
 
+@pytest.mark.parametrize("command_scanner", [False, True])
 @pytest.mark.parametrize("scenario", command_scenarios)
-async def test_github_app_command_routing(autojump_clock, scenario):
+async def test_github_app_command_routing(
+    autojump_clock, scenario, command_scanner
+):
     app = GithubApp(
         user_agent=TEST_USER_AGENT,
         app_id=TEST_APP_ID,
         private_key=TEST_PRIVATE_KEY,
         webhook_secret=TEST_WEBHOOK_SECRET,
+        command_scanner=command_scanner,
     )
 
     test_payload = get_sample_data("issue-created-webhook")
@@ -471,3 +1987,133 @@ async def test_github_app_command_routing(autojump_clock, scenario):
     )
 
     assert sorted(got_commands) == sorted(scenario.expected_commands)
+
+
+@pytest.mark.parametrize(
+    "body",
+    [scenario.body or "" for scenario in command_scenarios]
+    + [
+        "",
+        "no slashes here",
+        "a path: /usr/bin/python",
+        "x\n\xa0/test-command nbsp",
+        "x\r/test-command cr-only",
+        "x\x0c/test-command form-feed",
+        "[x] /test-command checkbox",
+        "\\/test-command escaped",
+        "&#47;test-command entity",
+    ],
+)
+def test_parse_commands_fast_path_matches_markdown(body):
+    gh._PARSED_COMMANDS_CACHE.clear()
+    expected = list(gh._parse_commands_markdown(body))
+    assert list(parse_commands(body)) == expected
+    # Second time comes from the cache (if it needed parsing at all)
+    assert list(parse_commands(body)) == expected
+
+
+# Bits of markdown that are interesting to the scanner: things that open and
+# close blocks, things that look like commands, and near-misses for both.
+_SCAN_COMMANDS_ATOMS = [
+    "",
+    "",
+    "",
+    "  ",
+    "text",
+    "foo bar",
+    "/cmd a",
+    " /cmd",
+    "/cmd *b*",
+    "    /cmd",
+    "\t/cmd",
+    "/",
+    "/cmd\\",
+    "\\/cmd",
+    "`/cmd`",
+    "[x] /cmd",
+    "```",
+    "````",
+    "~~~",
+    "``` py",
+    "```a`b",
+    "   ```",
+    "    ```",
+    "\t```",
+    "- item",
+    "-",
+    "* x",
+    "+ y",
+    "1. one",
+    "2) two",
+    "  - nested",
+    "> q",
+    "> /cmd",
+    ">",
+    "# head",
+    "===",
+    "---",
+    "***",
+    "a | b",
+    "--|--",
+    "<!--",
+    "-->",
+    "<!-- x -->",
+    "<div>",
+    "</div>",
+    "<span>",
+    "  <!--",
+    "<script>",
+    "</script>",
+    "</pre>",
+    "<STYLE>",
+    "<?php",
+    "?>",
+    "<!X",
+    "<![CDATA[",
+    "]]>",
+    "<textarea>",
+    "[foo]: /url",
+    "[foo]",
+    "www.x.com",
+    "a@b.com",
+    "http://x",
+    "&amp;",
+    "/cmd www.x",
+    "\u3000/cmd",
+    "x\xa0",
+]
+
+
+def _random_markdown(rng):
+    lines = []
+    for _ in range(rng.randint(1, 15)):
+        prefix = rng.choice(["", "", "", "", " ", "    ", "> ", "- "])
+        lines.append(prefix + rng.choice(_SCAN_COMMANDS_ATOMS))
+    body = "\n".join(lines)
+    if rng.random() < 0.1:
+        body = body.replace("\n", "\r\n")
+    return body
+
+
+def test_scan_commands_matches_markdown():
+    rng = random.Random(0)
+    for _ in range(1000):
+        body = _random_markdown(rng)
+        try:
+            expected = list(gh._parse_commands_markdown(body))
+        except Exception:
+            # Some versions of marko crash on some of this garbage; nothing
+            # to compare against.
+            continue
+        assert list(gh._scan_commands(body)) == expected, body
+
+
+def test_scan_commands_huge_body():
+    # The scanner only hands the paragraphs that might contain commands to
+    # the markdown parser.
+    body = "\n\n".join(
+        ["Some *discussion* of `/usr/bin` and [links](https://example.com)"]
+        * 10000
+        + ["<!--\n\n/cmd in-comment\n-->", "/cmd 1", "/cmd *2*\n/cmd 3"]
+    )
+    assert list(gh._scan_commands(body)) == [["/cmd", "1"], ["/cmd", "3"]]
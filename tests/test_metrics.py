@@ -0,0 +1,62 @@
+import threading
+
+import pytest
+
+from snekomatic.metrics import Counter, Histogram, Registry
+
+
+def test_counter():
+    registry = Registry()
+    counter = Counter("things_total", "Things", ["kind"], registry=registry)
+    counter.inc("a")
+    counter.inc("a")
+    counter.inc('we"ird\n', amount=3)
+    assert counter.value("a") == 2
+    assert counter.value("b") == 0
+    assert registry.render() == (
+        "# HELP things_total Things\n"
+        "# TYPE things_total counter\n"
+        'things_total{kind="a"} 2.0\n'
+        'things_total{kind="we\\"ird\\n"} 3.0\n'
+    )
+
+    with pytest.raises(ValueError):
+        Counter("things_total", "Duplicate", registry=registry)
+
+
+def test_histogram():
+    registry = Registry()
+    histogram = Histogram(
+        "latency_seconds", "Latency", buckets=[1, 0.1], registry=registry
+    )
+    for value in [0.05, 0.1, 0.5, 2]:
+        histogram.observe(value)
+    assert histogram.count() == 4
+    assert registry.render() == (
+        "# HELP latency_seconds Latency\n"
+        "# TYPE latency_seconds histogram\n"
+        'latency_seconds_bucket{le="0.1"} 2\n'
+        'latency_seconds_bucket{le="1.0"} 3\n'
+        'latency_seconds_bucket{le="+Inf"} 4\n'
+        "latency_seconds_sum 2.65\n"
+        "latency_seconds_count 4\n"
+    )
+
+
+def test_recording_from_threads():
+    counter = Counter("c_total", "C", registry=None)
+    histogram = Histogram("h_seconds", "H", buckets=[1], registry=None)
+
+    def record():
+        for _ in range(10000):
+            counter.inc()
+            histogram.observe(0.5)
+
+    threads = [threading.Thread(target=record) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert counter.value() == 80000
+    assert histogram.count() == 80000
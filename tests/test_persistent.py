@@ -29,7 +29,9 @@ def test_unify():
     ) == {"a": 1, "b": 3, "subdict": {"s1": 2, "s2": 4}}
 
 
-async def test_PDict(heroku_style_pg, nursery, autojump_clock):
+# Subscribers read from the database in worker threads, which the autojump
+# clock can't see, so this runs in real time.
+async def test_PDict(heroku_style_pg, nursery):
     snapshots = {}
 
     async def collect_snapshots(domain, item, key):
@@ -117,3 +119,17 @@ async def test_PDict(heroku_style_pg, nursery, autojump_clock):
         "d1-i2": [{}],
         "d2-i1": [{}, {"another": "PDict"}],
     }
+
+    # aupdate is the same, but for async code
+    await PDict("d2", "i1").aupdate({"more": "data"})
+    with pytest.raises(ValueError):
+        await PDict("d2", "i1").aupdate({"more": "conflicts"})
+    with pytest.raises(TypeError):
+        await PDict("d2", "i1").aupdate(["not", "a", "dict"])
+
+    await trio.sleep(1)
+    assert snapshots["d2-i1"] == [
+        {},
+        {"another": "PDict"},
+        {"another": "PDict", "more": "data"},
+    ]
@@ -0,0 +1,62 @@
+import json
+
+import trio
+
+from snekomatic.replay import replay
+
+
+def record(received_at, repo, n):
+    payload = {"n": n}
+    if repo is not None:
+        payload["repository"] = {"full_name": repo}
+    return {
+        "received_at": received_at,
+        "headers": {"x-github-event": "push"},
+        "body": json.dumps(payload),
+    }
+
+
+RECORDS = [
+    record(1000, "a/a", 0),
+    record(1001, "b/b", 1),
+    record(1002, "a/a", 2),
+    record(1004, None, 3),
+    record(1004, "b/b", 4),
+]
+
+
+async def test_replay(autojump_clock):
+    for speed, expected in [
+        # Repo a/a's first delivery takes 3 seconds, so its second one has to
+        # wait; everything else goes out on schedule.
+        (1, [(0, 0), (1, 1), (3, 2), (4, 3), (4, 4)]),
+        (2, [(0, 0), (0.5, 1), (2, 3), (2, 4), (3, 2)]),
+        (None, [(0, 0), (0, 1), (0, 3), (0, 4), (3, 2)]),
+    ]:
+        sent = []
+        start = trio.current_time()
+
+        async def send(record):
+            n = json.loads(record["body"])["n"]
+            sent.append((trio.current_time() - start, n))
+            if n == 0:
+                await trio.sleep(3)
+
+        await replay(RECORDS, send, speed=speed)
+        assert sorted(sent) == expected
+
+
+async def test_replay_concurrency(autojump_clock):
+    in_flight = 0
+    max_in_flight = 0
+
+    async def send(record):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await trio.sleep(1)
+        in_flight -= 1
+
+    records = [record(0, f"repo/{i}", i) for i in range(10)]
+    await replay(records, send, speed=None, concurrency=3)
+    assert max_in_flight == 3
@@ -0,0 +1,42 @@
+import pendulum
+
+from snekomatic.db import (
+    lease_installation_token,
+    load_installation_token,
+)
+from snekomatic.token_store import PostgresTokenStore
+
+KEY = "ab" * 32
+OTHER_KEY = "cd" * 32
+
+
+async def test_postgres_token_store(heroku_style_pg):
+    store = PostgresTokenStore(KEY)
+    assert await store.load(123) is None
+
+    assert await store.try_lease(123, 60)
+    # Someone else has it
+    assert not await store.try_lease(123, 60)
+    await store.release(123)
+    assert await store.try_lease(123, 60)
+
+    expires_at = pendulum.now().add(hours=1)
+    await store.save(123, "v1.sekrit", expires_at)
+    # Saving drops the lease
+    assert await store.try_lease(123, 60)
+    await store.release(123)
+
+    token, loaded_expires_at = await store.load(123)
+    assert token == "v1.sekrit"
+    assert loaded_expires_at == expires_at
+
+    # The token isn't stored in the clear
+    ciphertext, _ = load_installation_token(123)
+    assert b"sekrit" not in ciphertext
+
+    # With the wrong key, it's just ignored
+    assert await PostgresTokenStore(OTHER_KEY).load(123) is None
+
+    # Leases expire
+    assert lease_installation_token(456, -1)
+    assert lease_installation_token(456, 60)
@@ -0,0 +1,215 @@
+import json
+
+import pendulum
+import pytest
+import trio
+
+from snekomatic import tracing
+from snekomatic.gh import GithubApp
+from .util import FakeGithubSession, fake_webhook
+from .credentials import *
+
+
+class ListExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, record):
+        self.spans.append(record)
+
+
+@pytest.fixture
+def exported():
+    exporter = ListExporter()
+    tracing.add_exporter(exporter)
+    try:
+        yield exporter.spans
+    finally:
+        tracing.remove_exporter(exporter)
+
+
+def by_name(spans):
+    return {span["name"]: span for span in spans}
+
+
+async def test_spans_follow_tasks(exported, autojump_clock):
+    async def child(n):
+        with tracing.span("child", n=n):
+            await trio.sleep(n)
+
+    with tracing.trace("root", "delivery-1", kind="test"):
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(child, 1)
+            nursery.start_soon(child, 2)
+        attempt = tracing.start_span("manual")
+        attempt.finish(outcome="ok")
+        attempt.finish(outcome="ignored")
+
+    assert [span["name"] for span in exported] == [
+        "child",
+        "child",
+        "manual",
+        "root",
+    ]
+    root = exported[-1]
+    assert root["parent_id"] is None
+    assert root["attributes"] == {"kind": "test"}
+    for span in exported:
+        assert span["delivery_id"] == "delivery-1"
+        assert span["trace_id"] == root["trace_id"]
+        assert len(span["trace_id"]) == 32
+    for span in exported[:3]:
+        assert span["parent_id"] == root["span_id"]
+    assert [span["attributes"] for span in exported[:3]] == [
+        {"n": 1},
+        {"n": 2},
+        {"outcome": "ok"},
+    ]
+
+    # Outside of a trace, nothing gets recorded
+    exported.clear()
+    with tracing.span("orphan") as span:
+        span.set(ignored=True)
+    tracing.start_span("orphan").finish()
+    assert exported == []
+
+
+def test_span_records_errors(exported):
+    with pytest.raises(KeyError):
+        with tracing.trace("root", "delivery-2"):
+            with tracing.span("child"):
+                raise KeyError("oops")
+    assert [span["attributes"] for span in exported] == [
+        {"error": "KeyError('oops')"},
+        {"error": "KeyError('oops')"},
+    ]
+
+
+def test_no_exporters():
+    with tracing.trace("root", "delivery-3") as root:
+        assert tracing.current_span() is root
+        with tracing.span("child") as child:
+            assert child is root
+
+
+async def test_jsonl_exporter(tmp_path):
+    path = tmp_path / "spans.jsonl"
+    exporter = tracing.JsonlExporter(path, max_buffered=2)
+    tracing.add_exporter(exporter)
+    try:
+        with tracing.trace("root", "delivery-4"):
+            with tracing.span("child"):
+                pass
+        # Spans wait in the buffer until the next flush...
+        assert not path.exists()
+        await exporter.flush()
+        # ...which appends them
+        with tracing.trace("root", "delivery-5"):
+            with tracing.span("child"):
+                with tracing.span("grandchild"):
+                    pass
+        await exporter.flush()
+    finally:
+        tracing.remove_exporter(exporter)
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [line["name"] for line in lines] == [
+        "child",
+        "root",
+        "grandchild",
+        "child",
+    ]
+    # The buffer only had room for two
+    assert exporter.dropped == 1
+
+
+def test_otlp_payload():
+    exporter = tracing.OtlpExporter("http://localhost:4318/v1/traces")
+    tracing.add_exporter(exporter)
+    try:
+        with tracing.trace("root", "delivery-5"):
+            with tracing.span("child", status=404, retried=False):
+                pass
+    finally:
+        tracing.remove_exporter(exporter)
+    payload = exporter._payload(exporter._buffer)
+    [resource_spans] = payload["resourceSpans"]
+    [scope_spans] = resource_spans["scopeSpans"]
+    child, root = scope_spans["spans"]
+    assert child["parentSpanId"] == root["spanId"]
+    assert "parentSpanId" not in root
+    assert child["traceId"] == root["traceId"]
+    assert int(child["endTimeUnixNano"]) >= int(child["startTimeUnixNano"])
+    assert child["attributes"] == [
+        {"key": "status", "value": {"intValue": "404"}},
+        {"key": "retried", "value": {"boolValue": False}},
+        {"key": "delivery_id", "value": {"stringValue": "delivery-5"}},
+    ]
+
+
+async def test_github_app_traces_deliveries(
+    exported, nursery, autojump_clock
+):
+    def handler(method, url, headers, body):
+        if "/app/installations/" in url:
+            expires_at = pendulum.now().add(hours=1).to_iso8601_string()
+            return 201, {}, {"token": "t", "expires_at": expires_at}
+        return 200, {}, {}
+
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+        session=FakeGithubSession(handler),
+    )
+    done = trio.Event()
+
+    @app.route_webhook("issues")
+    async def issues_handler(event_type, payload, client):
+        await client.getitem("/repos/a/b/issues/1")
+        done.set()
+
+    # Handlers run later, in the scheduler's task, but still end up in the
+    # delivery's trace
+    await nursery.start(app.run_dispatch_scheduler)
+    headers, body = fake_webhook(
+        "issues", {"installation": {"id": 1}}, secret=TEST_WEBHOOK_SECRET
+    )
+    await app.dispatch_webhook(headers, body)
+    await done.wait()
+    await trio.sleep(1)
+
+    spans = by_name(exported)
+    assert set(spans) == {
+        "webhook",
+        "dispatch",
+        "handler",
+        "github.token_refresh",
+        "github.request",
+    }
+    for span in exported:
+        assert span["delivery_id"] == headers["x-github-delivery"]
+    assert spans["webhook"]["attributes"] == {"event": "issues"}
+    assert spans["dispatch"]["parent_id"] == spans["webhook"]["span_id"]
+    assert spans["handler"]["parent_id"] == spans["dispatch"]["span_id"]
+    assert spans["handler"]["attributes"]["handler"].endswith(
+        "issues_handler"
+    )
+    # The token refresh's own request to Github is in there too
+    requests = [span for span in exported if span["name"] == "github.request"]
+    assert [span["attributes"] for span in requests] == [
+        {
+            "method": "POST",
+            "url": "/app/installations/{id}/access_tokens",
+            "status": "201",
+        },
+        {
+            "method": "GET",
+            "url": "/repos/{owner}/{repo}/issues/{id}",
+            "status": "200",
+        },
+    ]
+    assert (
+        requests[0]["parent_id"] == spans["github.token_refresh"]["span_id"]
+    )
+    assert requests[1]["parent_id"] == spans["handler"]["span_id"]
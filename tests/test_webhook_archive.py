@@ -0,0 +1,98 @@
+import gzip
+import json
+
+from snekomatic.gh import GithubApp
+from snekomatic.webhook_archive import WebhookArchive, read_webhook_archive
+from .util import fake_webhook
+from .credentials import *
+
+
+async def test_github_app_archives_deliveries(tmp_path, autojump_clock):
+    path = tmp_path / "archive"
+    archive = WebhookArchive(path)
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+        webhook_archive=archive,
+    )
+
+    @app.route_webhook("pull_request")
+    async def handler(event_type, payload, client):
+        pass
+
+    deliveries = [
+        fake_webhook(
+            "pull_request",
+            {"number": 1, "installation": {"id": TEST_INSTALLATION_ID}},
+            secret=TEST_WEBHOOK_SECRET,
+        ),
+        # Nobody's listening for these, but they still count as load
+        fake_webhook("push", {"ref": "master"}, secret=TEST_WEBHOOK_SECRET),
+    ]
+    for headers, body in deliveries:
+        await app.dispatch_webhook(headers, body)
+    # Nothing touches the disk until the archive is flushed
+    assert not path.exists()
+    await archive.flush()
+
+    records = list(read_webhook_archive(path))
+    assert len(records) == 2
+    for record, (headers, body) in zip(records, deliveries):
+        assert record["body"] == body.decode("utf-8")
+        assert record["headers"] == {
+            "x-github-event": headers["x-github-event"],
+            "x-github-delivery": headers["x-github-delivery"],
+            "content-type": "application/json",
+        }
+    assert records[0]["received_at"] <= records[1]["received_at"]
+    # It's just gzipped JSON lines
+    with gzip.open(path, "rt") as f:
+        assert [json.loads(line) for line in f] == records
+
+
+async def test_webhook_archive_rotation(tmp_path):
+    path = tmp_path / "archive"
+    archive = WebhookArchive(path, max_bytes=1, backups=2)
+    for i in range(5):
+        archive.record({"x-github-event": "push"}, str(i).encode("ascii"))
+    await archive.flush()
+    assert not path.exists()
+    assert [r["body"] for r in read_webhook_archive(f"{path}.1")] == ["4"]
+    assert [r["body"] for r in read_webhook_archive(f"{path}.2")] == ["3"]
+    assert not (tmp_path / "archive.3").exists()
+
+
+async def test_webhook_archive_truncated(tmp_path):
+    path = tmp_path / "archive"
+    archive = WebhookArchive(path)
+    archive.record({"x-github-event": "push"}, b"complete")
+    await archive.flush()
+    size = path.stat().st_size
+    archive.record({"x-github-event": "push"}, b"half-written" * 100)
+    await archive.flush()
+    with open(path, "r+b") as f:
+        f.truncate(size + 20)
+
+    records = list(read_webhook_archive(path))
+    assert [r["body"] for r in records] == ["complete"]
+
+
+async def test_webhook_archive_skips_undecodable_bodies(tmp_path):
+    path = tmp_path / "archive"
+    archive = WebhookArchive(path)
+    archive.record({"x-github-event": "push"}, b"\xff\xfe not utf-8")
+    archive.record({"x-github-event": "push"}, b"fine")
+    await archive.flush()
+    assert [r["body"] for r in read_webhook_archive(path)] == ["fine"]
+
+
+async def test_webhook_archive_buffer_limit(tmp_path):
+    path = tmp_path / "archive"
+    archive = WebhookArchive(path, max_buffered=2)
+    for i in range(3):
+        archive.record({"x-github-event": "push"}, str(i).encode("ascii"))
+    assert archive.dropped == 1
+    await archive.flush()
+    assert [r["body"] for r in read_webhook_archive(path)] == ["0", "1"]
@@ -0,0 +1,128 @@
+import pytest
+import trio
+import gidgethub
+
+from snekomatic.db import claim_queued_webhook
+from snekomatic import webhook_queue
+from snekomatic.gh import GithubApp
+from snekomatic.webhook_queue import (
+    enqueue_webhook_delivery,
+    run_webhook_consumers,
+)
+from .util import fake_webhook
+from .credentials import *
+
+
+# No autojump_clock here: the database calls happen in worker threads, and
+# the autojump clock can't tell that we're waiting for them.
+async def test_webhook_consumers(heroku_style_pg, nursery):
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+        dispatch_delays={"pull_request": 0},
+    )
+
+    seen = []
+    finished = trio.Event()
+
+    @app.route_webhook("pull_request")
+    async def handler(event_type, payload, client):
+        seen.append(payload["number"])
+        if len(seen) == 4:
+            finished.set()
+
+    await nursery.start(run_webhook_consumers, app, 2)
+
+    for i in range(3):
+        await enqueue_webhook_delivery(
+            app,
+            *fake_webhook(
+                "pull_request",
+                {"number": i, "installation": {"id": TEST_INSTALLATION_ID}},
+                secret=TEST_WEBHOOK_SECRET,
+            ),
+        )
+
+    # Redeliveries are dropped before they reach the queue
+    headers, body = fake_webhook(
+        "pull_request",
+        {"number": 0, "installation": {"id": TEST_INSTALLATION_ID}},
+        secret=TEST_WEBHOOK_SECRET,
+    )
+    await enqueue_webhook_delivery(app, headers, body)
+    await enqueue_webhook_delivery(app, headers, body)
+
+    with trio.fail_after(10):
+        await finished.wait()
+    assert sorted(seen) == [0, 0, 1, 2]
+    # And they were all removed from the queue (once the consumers have had
+    # a moment to get back from their handlers)
+    await trio.sleep(1)
+    assert claim_queued_webhook(60) is None
+
+    # Bad signatures are rejected up front, and never make it into the queue
+    with pytest.raises(gidgethub.ValidationFailure):
+        await enqueue_webhook_delivery(
+            app,
+            *fake_webhook(
+                "pull_request",
+                {"number": 3, "installation": {"id": TEST_INSTALLATION_ID}},
+                secret="trust me",
+            ),
+        )
+    assert claim_queued_webhook(60) is None
+
+
+async def test_webhook_consumers_survive_grouped_failures(
+    heroku_style_pg, nursery, monkeypatch
+):
+    monkeypatch.setattr(webhook_queue, "MAX_ATTEMPTS", 1)
+    app = GithubApp(
+        user_agent=TEST_USER_AGENT,
+        app_id=TEST_APP_ID,
+        private_key=TEST_PRIVATE_KEY,
+        webhook_secret=TEST_WEBHOOK_SECRET,
+        dispatch_delays={"pull_request": 0},
+    )
+
+    errors = []
+    app.on_dispatch_error = errors.append
+    survived = trio.Event()
+
+    # Two handlers fail on the same delivery, so the consumer gets them as
+    # an ExceptionGroup
+    @app.route_webhook("pull_request")
+    async def first(event_type, payload, client):
+        if payload["number"] == 0:
+            raise ValueError("first")
+        survived.set()
+
+    @app.route_webhook("pull_request")
+    async def second(event_type, payload, client):
+        if payload["number"] == 0:
+            raise KeyError("second")
+
+    await nursery.start(run_webhook_consumers, app, 1)
+
+    for i in range(2):
+        await enqueue_webhook_delivery(
+            app,
+            *fake_webhook(
+                "pull_request",
+                {"number": i, "installation": {"id": TEST_INSTALLATION_ID}},
+                secret=TEST_WEBHOOK_SECRET,
+            ),
+        )
+
+    # The consumer reported both errors, and carried on to the next delivery
+    with trio.fail_after(10):
+        await survived.wait()
+    assert sorted(type(exc).__name__ for exc in errors) == [
+        "KeyError",
+        "ValueError",
+    ]
+    # And it gave up on the bad one, rather than leaving it to be retried
+    await trio.sleep(1)
+    assert claim_queued_webhook(60) is None
@@ -3,8 +3,11 @@ import hmac
 import json
 import secrets
 import asks
+import attr
 from contextlib import contextmanager
 import pendulum
+import trio
+
 
 # Partial duplicate of gidgethub.sansio.validate_event
 def sign_webhook(body: bytes, secret: str):
@@ -43,3 +46,50 @@ def mock_time(t):
         yield
     finally:
         pendulum.set_test_now()
+
+
+@attr.s
+class FakeResponse:
+    status_code = attr.ib()
+    headers = attr.ib()
+    content = attr.ib()
+
+
+@attr.s
+class FakeGithubSession:
+    """Stands in for the asks.Session that GithubApp talks to Github with.
+
+    The handler gets (method, url, headers, body) and returns (status,
+    headers, data); data is JSON-encoded for you (None means no body).
+    Every request is recorded in .requests as a (method, url) pair.
+
+    """
+
+    handler = attr.ib()
+    requests = attr.ib(factory=list)
+
+    async def request(self, method, url, *, headers, data):
+        self.requests.append((method, url))
+        status, response_headers, response_data = self.handler(
+            method, url, headers, data
+        )
+        response_headers = {
+            "content-type": "application/json; charset=utf-8",
+            **response_headers,
+        }
+        if response_data is None:
+            content = b""
+        else:
+            content = json.dumps(response_data).encode("utf-8")
+        return FakeResponse(status, response_headers, content)
+
+
+@attr.s
+class SlowGithubSession(FakeGithubSession):
+    """A FakeGithubSession where every request takes 'delay' seconds."""
+
+    delay = attr.ib(default=1)
+
+    async def request(self, *args, **kwargs):
+        await trio.sleep(self.delay)
+        return await super().request(*args, **kwargs)